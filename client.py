@@ -1,10 +1,105 @@
+import asyncio
+import json
+import queue
+import random
+import sys
 import time
 import _thread as thread
 
+from datetime import datetime
+
 import click
 import termcolor
 import websocket
 
+# Messages per sendmessage frame, keeps a batch well under the 32 KB WebSocket frame limit of API Gateway
+MAX_BATCH = 25
+
+# Reconnect backoff of the asyncio client in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+
+def decode(message):
+    """
+    Decode a frame from the server. Binary frames are MessagePack, text frames are JSON or plain text notices.
+
+    :param message: Frame received
+    :return: Frame dict, or None for plain text
+    """
+    if isinstance(message, bytes):
+        # msgpack is only needed when the client asked for it
+        import msgpack
+
+        return msgpack.unpackb(message, raw=False)
+    try:
+        frame = json.loads(message)
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) else None
+
+
+def format_message(message):
+    """
+    Render a message envelope as a line of text
+
+    :param message: Envelope dict with sender, timestamp, seq, room and body
+    :return: String
+    """
+    if not message.get('sender'):
+        return message['body']
+    now = datetime.fromtimestamp(message['timestamp'] / 1000.0).strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{now} {message['sender']}] {message['body']}"
+
+
+def render(message):
+    """
+    Turn a frame from the server into display text. Chat messages arrive in frames where every message carries its
+    sequence number as cursor, notices arrive as plain text.
+
+    :param message: Frame received
+    :return: (text, highest cursor of the frame or None)
+    """
+    frame = decode(message)
+    if frame is None or 'messages' not in frame:
+        return message, None
+
+    text = frame.get('welcome', '') + '\n'.join(format_message(m) for m in frame['messages'])
+    cursors = [m['seq'] for m in frame['messages']]
+    return text, max(cursors) if cursors else None
+
+
+class HistoryChunks(object):
+    """
+    Puts the chunks of a history delivery back in order. A chunk is released as soon as every earlier chunk has
+    arrived, so the history is rendered while the rest of it is still on its way.
+    """
+
+    def __init__(self):
+        self.expected = 0
+        self.pending = {}
+
+    def add(self, message):
+        """
+        :param message: Frame received
+        :return: List of frames that can be rendered now, in order
+        """
+        frame = decode(message)
+        if frame is None or 'chunk' not in frame:
+            return [message]
+
+        self.pending[frame['chunk']] = (frame, message)
+        ready = []
+        while self.expected in self.pending:
+            frame, message = self.pending.pop(self.expected)
+            ready.append(message)
+            self.expected += 1
+            if frame.get('last'):
+                # The next sendnotify starts a new delivery at chunk 0
+                self.expected = 0
+                break
+        return ready
+
 
 def on_message(ws, message):
     """
@@ -14,7 +109,7 @@ def on_message(ws, message):
     :param message: Message received
     :return:
     """
-    print(termcolor.colored(message, "green"))
+    print(termcolor.colored(render(message)[0], "green"))
 
 
 def on_error(ws, error):
@@ -39,39 +134,279 @@ def on_close(ws):
     ws.close()
 
 
-def on_open(ws):
+def encode(messages):
+    """
+    Encode messages as a single sendmessage frame
+
+    :param messages: List of message strings
+    :return: JSON string
+    """
+    if len(messages) == 1:
+        return json.dumps({'action': 'sendmessage', 'message': messages[0]})
+    return json.dumps({'action': 'sendmessage', 'messages': messages})
+
+
+def collect(outbox, window=0.0, limit=MAX_BATCH):
     """
-    Handle on_open event
+    Wait for the next message and take the messages queued within the coalescing window after it
+
+    :param outbox: Queue of message strings
+    :param window: Seconds to wait for more messages, 0 sends every message on its own
+    :param limit: Maximum number of messages in a batch
+    :return: List of message strings
+    """
+    messages = [outbox.get()]
+    if window <= 0:
+        return messages
+
+    deadline = time.monotonic() + window
+    while len(messages) < limit:
+        remaining = deadline - time.monotonic()
+        try:
+            messages.append(outbox.get(timeout=remaining) if remaining > 0 else outbox.get_nowait())
+        except queue.Empty:
+            break
+    return messages
+
+
+def sender(ws, outbox, window=0.0):
+    """
+    Send queued messages until the connection is closed
 
     :param ws: websocket instance
+    :param outbox: Queue of message strings
+    :param window: Coalescing window in seconds
     :return:
     """
+    while True:
+        ws.send(encode(collect(outbox, window)))
+
+
+def on_open(ws, window=0.0):
+    """
+    Handle on_open event. Typed lines are queued and sent by a separate sender thread, so input is never blocked by
+    the network.
+
+    :param ws: websocket instance
+    :param window: Seconds to coalesce messages typed in quick succession into one frame
+    :return:
+    """
+    outbox = queue.Queue()
+
     def run():
-        ws.send('{"action": "sendnotify"}')
+        ws.send(json.dumps({'action': 'sendnotify'}))
+        thread.start_new_thread(sender, (ws, outbox, window))
 
         while True:
             message = input()
             print("\033[A\033[A")  # clear the entered input
-            data = f'{{"action": "sendmessage", "message": "{message}"}}'
-            ws.send(data)
-            time.sleep(1)
+            outbox.put(message)
     thread.start_new_thread(run, ())
 
 
+def websocket_url(server_url, username, room=None, encoding=None):
+    """
+    Build the connect url of a user
+
+    :param server_url: WebSocket server url
+    :param username: A username to chat
+    :param room: Optional chat room name
+    :param encoding: Optional frame encoding, json or msgpack
+    :return: Url string
+    """
+    ws_url = f"{server_url}?username={username}"
+    if room:
+        ws_url = f"{ws_url}&room={room}"
+    if encoding:
+        ws_url = f"{ws_url}&encoding={encoding}"
+    return ws_url
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Reconnect delay with full jitter, so sessions dropped together do not reconnect together
+
+    :param attempt: Number of failed attempts so far, starting at 0
+    :param base: Delay of the first attempt in seconds
+    :param cap: Maximum delay in seconds
+    :return: Seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Session(object):
+    """
+    One chat user of the asyncio client. It reconnects with jittered exponential backoff and re-issues sendnotify
+    after every connect, with the cursor of the last message it has seen so only missed messages are sent again.
+    """
+
+    def __init__(self, url, outbox=None, interval=None, on_message=None, connect=None):
+        """
+        :param url: Connect url of the user
+        :param outbox: Optional asyncio.Queue of messages to send
+        :param interval: Optional seconds between generated messages, for simulated users
+        :param on_message: Optional callback for received messages
+        :param connect: Optional connect function, defaults to websockets.connect
+        """
+        self.url = url
+        self.outbox = outbox
+        self.interval = interval
+        self.on_message = on_message
+        self.connect = connect
+        self.sent = 0
+        self.received = 0
+        self.reconnects = 0
+        self.cursor = 0
+        self.closed = False
+
+    async def run(self, max_attempts=None):
+        """
+        Keep the session connected until close() is called
+
+        :param max_attempts: Optional number of consecutive failed connects before giving up
+        :return:
+        """
+        # websockets is only needed by the asyncio client
+        import websockets
+        from websockets.exceptions import WebSocketException
+
+        connect = self.connect or websockets.connect
+        attempt = 0
+        while not self.closed:
+            try:
+                async with connect(self.url) as ws:
+                    attempt = 0
+                    await self.serve(ws)
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                self.report_error(e)
+
+            if self.closed:
+                break
+            if max_attempts is not None and attempt >= max_attempts:
+                raise ConnectionError(f"Gave up on {self.url} after {attempt} attempts")
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
+            self.reconnects += 1
+
+    async def serve(self, ws):
+        await ws.send(json.dumps({'action': 'sendnotify', 'since': self.cursor}))
+        writer = asyncio.ensure_future(self.write(ws))
+        history = HistoryChunks()
+        try:
+            async for message in ws:
+                self.received += 1
+                for ready in history.add(message):
+                    text, cursor = render(ready)
+                    self.cursor = max(self.cursor, cursor or 0)
+                    if self.on_message:
+                        self.on_message(text)
+        finally:
+            writer.cancel()
+
+    async def write(self, ws):
+        while True:
+            if self.outbox is not None:
+                messages = [await self.outbox.get()]
+                while len(messages) < MAX_BATCH and not self.outbox.empty():
+                    messages.append(self.outbox.get_nowait())
+            else:
+                await asyncio.sleep(self.interval * random.uniform(0.5, 1.5))
+                messages = [f"message {self.sent + 1}"]
+            await ws.send(encode(messages))
+            self.sent += len(messages)
+
+    def report_error(self, error):
+        if self.on_message:
+            print(termcolor.colored(f"Disconnected: {error}", "red"))
+
+    def close(self):
+        self.closed = True
+
+
+async def read_input(outbox):
+    """
+    Feed typed lines into the outbox without blocking the event loop
+
+    :param outbox: asyncio.Queue
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        message = await loop.run_in_executor(None, sys.stdin.readline)
+        if not message:
+            break
+        print("\033[A\033[A")  # clear the entered input
+        await outbox.put(message.rstrip('\n'))
+
+
+async def report_sessions(sessions, every=10.0):
+    while True:
+        await asyncio.sleep(every)
+        print(json.dumps({
+            'sessions': len(sessions),
+            'sent': sum(session.sent for session in sessions),
+            'received': sum(session.received for session in sessions),
+            'reconnects': sum(session.reconnects for session in sessions),
+        }))
+
+
+async def run_sessions(server_url, username, room=None, sessions=1, interval=5.0, encoding=None, connect=None):
+    """
+    Run the asyncio client. A single session is interactive, more sessions are simulated users named
+    <username>-<n> that send a message every interval seconds on average.
+
+    :param server_url: WebSocket server url
+    :param username: A username to chat
+    :param room: Optional chat room name
+    :param sessions: Number of sessions
+    :param interval: Average seconds between messages of a simulated user
+    :param encoding: Optional frame encoding, json or msgpack
+    :param connect: Optional connect function, defaults to websockets.connect
+    :return:
+    """
+    if sessions == 1:
+        outbox = asyncio.Queue()
+        session = Session(websocket_url(server_url, username, room, encoding), outbox=outbox,
+                          on_message=lambda message: print(termcolor.colored(message, "green")), connect=connect)
+        await asyncio.gather(session.run(), read_input(outbox))
+        return
+
+    simulated = [Session(websocket_url(server_url, f"{username}-{i}", room, encoding), interval=interval,
+                         connect=connect) for i in range(sessions)]
+    await asyncio.gather(report_sessions(simulated), *[session.run() for session in simulated])
+
+
 @click.command()
 @click.option("--server-url", default="wss://nss4v73glk.execute-api.ap-southeast-1.amazonaws.com/Prod", help="Websocket Server URL")
 @click.option("--username", prompt="Your username", help="Your chat username")
-def main(server_url, username):
+@click.option("--room", default=None, help="Chat room to join, defaults to the global room")
+@click.option("--coalesce-ms", default=0, help="Send messages typed within this many milliseconds as one batch")
+@click.option("--asyncio", "use_asyncio", is_flag=True, help="Use the asyncio client, which reconnects on failures")
+@click.option("--sessions", default=1, help="Simulated users to run with the asyncio client")
+@click.option("--interval", default=5.0, help="Average seconds between messages of a simulated user")
+@click.option("--encoding", type=click.Choice(['json', 'msgpack']), default=None,
+              help="Frame encoding to ask the server for, msgpack needs the msgpack package")
+def main(server_url, username, room, coalesce_ms, use_asyncio, sessions, interval, encoding):
     """
     Main method to start chat client.
 
     :param server_url: WebSocket server url
     :param username: A username to chat
+    :param room: Optional chat room name
+    :param coalesce_ms: Coalescing window in milliseconds, 0 sends every message on its own
+    :param use_asyncio: Run the asyncio client, implied by more than one session
+    :param sessions: Number of simulated users
+    :param interval: Average seconds between messages of a simulated user
+    :param encoding: Optional frame encoding
     :return:
     """
-    ws_url = f"{server_url}?username={username}"
+    if use_asyncio or sessions > 1:
+        asyncio.run(run_sessions(server_url, username, room, sessions, interval, encoding))
+        return
+
+    ws_url = websocket_url(server_url, username, room, encoding)
     ws = websocket.WebSocketApp(ws_url, on_message=on_message, on_error=on_error, on_close=on_close)
-    ws.on_open = on_open
+    ws.on_open = lambda ws: on_open(ws, coalesce_ms / 1000.0)
     ws.run_forever()
 
 
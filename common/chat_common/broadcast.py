@@ -0,0 +1,184 @@
+import os
+import time
+
+from chat_common import concurrency, envelope, metrics
+
+DELIVERED = 'delivered'
+GONE = 'gone'
+THROTTLED = 'throttled'
+FAILED = 'failed'
+
+THROTTLE_ERROR_CODES = ('LimitExceededException', 'ThrottlingException', 'TooManyRequestsException')
+
+
+class BroadcastResult(object):
+    """
+    Per-connection outcome of a broadcast.
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.elapsed = 0.0
+
+    def record(self, connection_id, status):
+        self.statuses[connection_id] = status
+
+    def connections(self, status):
+        """
+        List connection ids that ended with the given status
+
+        :param status: One of DELIVERED, GONE, THROTTLED or FAILED
+        :return: List of connection ids
+        """
+        return [connection_id for connection_id, s in self.statuses.items() if s == status]
+
+    @property
+    def delivered(self):
+        return self.connections(DELIVERED)
+
+    @property
+    def gone(self):
+        return self.connections(GONE)
+
+    @property
+    def throttled(self):
+        return self.connections(THROTTLED)
+
+    @property
+    def failed(self):
+        return self.connections(FAILED)
+
+    @property
+    def undelivered(self):
+        return [connection_id for connection_id, s in self.statuses.items() if s != DELIVERED]
+
+    def summary(self):
+        """
+        Count connections per status
+
+        :return: Dict of status to count
+        """
+        counts = {DELIVERED: 0, GONE: 0, THROTTLED: 0, FAILED: 0}
+        for status in self.statuses.values():
+            counts[status] += 1
+        return counts
+
+
+def classify_error(error):
+    """
+    Map an exception raised by post_to_connection to a broadcast status
+
+    :param error: Exception instance
+    :return: GONE, THROTTLED or FAILED
+    """
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status_code = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+    if code == 'GoneException' or status_code == 410:
+        return GONE
+    if code in THROTTLE_ERROR_CODES or status_code == 429:
+        return THROTTLED
+    return FAILED
+
+
+def max_workers():
+    return int(os.environ.get('BROADCAST_MAX_WORKERS', '16'))
+
+
+def timeout():
+    value = os.environ.get('BROADCAST_TIMEOUT')
+    return float(value) if value else None
+
+
+def endpoint_failed(status, error):
+    """
+    Whether a failed call says something about the endpoint rather than the connection: a server error or no answer
+    at all. Client errors other than throttling are left out, they do not open the circuit.
+
+    :param status: Broadcast status of the call
+    :param error: Exception raised by the call, or None
+    :return: Boolean
+    """
+    if status != FAILED:
+        return False
+    status_code = (getattr(error, 'response', None) or {}).get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status_code is None or status_code >= 500
+
+
+def post(apigatewaymanagementapi, connection_id, data, controller=None):
+    """
+    Post data to a single connection
+
+    :param apigatewaymanagementapi: apigatewaymanagemntapi client
+    :param connection_id: Connection id string
+    :param data: String message
+    :param controller: Optional concurrency.Controller that admits the call and learns from its outcome
+    :return: Broadcast status
+    """
+    token = None
+    if controller is not None:
+        try:
+            token = controller.acquire()
+        except concurrency.CircuitOpen:
+            metrics.count('shed')
+            return FAILED
+
+    status, error = DELIVERED, None
+    try:
+        apigatewaymanagementapi.post_to_connection(Data=data, ConnectionId=connection_id)
+    except Exception as e:
+        print(e)
+        status, error = classify_error(e), e
+    finally:
+        if controller is not None:
+            controller.release(token, throttled=status == THROTTLED, failed=endpoint_failed(status, error))
+    return status
+
+
+def send_to_all(apigatewaymanagementapi, connection_ids, data, workers=None, deadline=None):
+    """
+    Send message to all connections in parallel using a bounded thread pool
+
+    :param apigatewaymanagementapi: apigatewaymanagemntapi client
+    :param connection_ids: List of connection ids from DDB
+    :param data: String message, or an envelope.Frame which is sent in the encoding of each connection
+    :param workers: Maximum number of concurrent posts, defaults to BROADCAST_MAX_WORKERS
+    :param deadline: Seconds to wait for outstanding posts, defaults to BROADCAST_TIMEOUT. Posts that have not
+    completed in time are reported as failed.
+    The number of posts in flight is adapted by the client's concurrency.Controller, posts shed while its circuit
+    is open are reported as failed.
+    :return: BroadcastResult
+    """
+    # concurrent.futures is imported on first use so importing a handler stays cheap
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    workers = workers or max_workers()
+    deadline = deadline if deadline is not None else timeout()
+    result = BroadcastResult()
+    if not connection_ids:
+        return result
+
+    controller = concurrency.controller(apigatewaymanagementapi, workers)
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(connection_ids)))
+    futures = {}
+    for item in connection_ids:
+        payload = data.encoded(envelope.of(item)) if isinstance(data, envelope.Frame) else data
+        futures[executor.submit(post, apigatewaymanagementapi, item['connectionId']['S'], payload, controller)] = \
+            item['connectionId']['S']
+    started = time.monotonic()
+    done, not_done = wait(futures, timeout=deadline)
+
+    for future in done:
+        result.record(futures[future], future.result())
+    for future in not_done:
+        future.cancel()
+        result.record(futures[future], FAILED)
+
+    executor.shutdown(wait=not not_done)
+    result.elapsed = time.monotonic() - started
+    for status, count in result.summary().items():
+        metrics.count(status, count)
+    for name, value in controller.snapshot().items():
+        metrics.gauge(name, value)
+    return result
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+import weakref
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Per-container controllers, keyed by management API client. Clients are cached per endpoint, so every endpoint keeps
+# its limit and circuit across invocations.
+_controllers = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def min_workers():
+    return int(os.environ.get('BROADCAST_MIN_WORKERS', '1'))
+
+
+def failure_threshold():
+    return int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+
+
+def cooldown():
+    return float(os.environ.get('CIRCUIT_COOLDOWN', '10'))
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit is open
+    """
+
+
+class Controller(object):
+    """
+    AIMD concurrency limit and circuit breaker for the calls to one endpoint. Every call that gets an answer raises
+    the limit by 1/limit, about one per round of calls, and a throttled call halves it. Only the first throttle of a
+    round halves the limit, the other calls of the same round were started before it and tell nothing new. After
+    failure_threshold consecutive server errors or timeouts the circuit opens and calls fail fast for cooldown
+    seconds, then a single probe call decides whether it closes again.
+    """
+
+    def __init__(self, maximum, minimum=1, failure_threshold=5, cooldown=10.0, clock=time.monotonic):
+        """
+        :param maximum: Upper bound and starting value of the limit
+        :param minimum: Lower bound of the limit
+        :param failure_threshold: Consecutive failures that open the circuit
+        :param cooldown: Seconds the circuit stays open
+        :param clock: Monotonic clock, replaced by tests
+        """
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(maximum)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.inflight = 0
+        self.round = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a call fits in the limit
+
+        :return: Round token to pass to release
+        :raises CircuitOpen: When the circuit is open, or half open with its probe call in flight
+        """
+        with self.condition:
+            while True:
+                if self.state == OPEN:
+                    remaining = self.cooldown - (self.clock() - self.opened_at)
+                    if remaining > 0:
+                        raise CircuitOpen(f"circuit open for another {remaining:.1f}s")
+                    self.state = HALF_OPEN
+                if self.state == HALF_OPEN:
+                    if self.inflight:
+                        raise CircuitOpen('circuit half open, waiting for the probe call')
+                    break
+                if self.inflight < int(self.limit):
+                    break
+                self.condition.wait()
+            self.inflight += 1
+            return self.round
+
+    def release(self, token, throttled=False, failed=False):
+        """
+        Account for a finished call
+
+        :param token: Round token returned by acquire
+        :param throttled: The endpoint throttled the call
+        :param failed: The endpoint failed with a server error or did not answer
+        :return: None
+        """
+        with self.condition:
+            self.inflight -= 1
+            if throttled:
+                if token == self.round:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.round += 1
+                if self.state == HALF_OPEN:
+                    # The endpoint answered the probe, the circuit closes with a clean failure count
+                    self.state = CLOSED
+                    self.failures = 0
+            elif failed:
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    self.state = OPEN
+                    self.opened_at = self.clock()
+                    self.failures = 0
+            else:
+                self.failures = 0
+                self.state = CLOSED
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def snapshot(self):
+        """
+        :return: Dict with the current limit and whether the circuit is open, for the metrics line
+        """
+        with self.condition:
+            return {'concurrencyLimit': round(self.limit, 3), 'circuitOpen': int(self.state != CLOSED)}
+
+
+def controller(client, maximum):
+    """
+    Controller of a management API client, created on first use
+
+    :param client: apigatewaymanagemntapi client
+    :param maximum: Upper bound of the concurrency limit, the size of the caller's thread pool
+    :return: Controller
+    """
+    with _lock:
+        if client not in _controllers:
+            _controllers[client] = Controller(maximum, min_workers(), failure_threshold(), cooldown())
+        return _controllers[client]
+
+
+def reset():
+    """
+    Drop the per-container controllers, used by tests
+    """
+    with _lock:
+        _controllers.clear()
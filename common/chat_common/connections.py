@@ -0,0 +1,267 @@
+import os
+import time
+
+from chat_common import broadcast, counters, envelope, expiry, ratelimit, rooms, storage
+
+# Attribute of a connection item holding the epoch seconds its $connect stored it
+CONNECTED_AT = 'connectedAt'
+
+# Per-container cache of room members, keyed by room and then by connection id
+_cache = {}
+
+
+def table_name():
+    return os.environ.get('CONNECTION_TABLE_NAME')
+
+
+def cache_ttl():
+    return float(os.environ.get('CONNECTION_CACHE_TTL', '5'))
+
+
+def connection_ttl():
+    """
+    Seconds a connection item lives, API Gateway closes every WebSocket connection after two hours
+    """
+    return int(os.environ.get('CONNECTION_TTL', '7200'))
+
+
+def live_count(room=rooms.DEFAULT_ROOM):
+    """
+    Name of the sharded counter holding the number of connections in a room, the connections_removed trigger of the
+    SQLite backend builds the same name
+    """
+    return f"connections:{room}"
+
+
+def scan(dynamodb):
+    """
+    Read every connection, connections past their expiry are left out
+
+    :param dynamodb: DDB client or storage backend
+    :return: List of connection items
+    """
+    now = time.time()
+    return [item for item in storage.of(dynamodb).all_connections() if not expiry.expired(item, now)]
+
+
+def query(dynamodb, room=rooms.DEFAULT_ROOM):
+    """
+    Read the connections of one room. Connections past their expiry that the table's TTL has not reaped yet are left
+    out and removed, so their room's live count goes down with them.
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :return: List of connection items
+    """
+    now = time.time()
+    items, expired = [], []
+    for item in storage.of(dynamodb).room_connections(room):
+        (expired if expiry.expired(item, now) else items).append(item)
+    if expired:
+        purge(dynamodb, expired)
+    return items
+
+
+def cached(connection_id):
+    """
+    Connection item from the per-container cache of any room. The username and room of a connection never change, so
+    a cached item stays valid for as long as the connection is open, whatever the age of the cache.
+
+    :param connection_id: Connection id string
+    :return: Connection item or None
+    """
+    for members in _cache.values():
+        item = members['items'].get(connection_id)
+        if item:
+            return item
+    return None
+
+
+def get_many(dynamodb, connection_ids):
+    """
+    Look up connections by id. Connections in the per-container cache cost nothing, the others are read from the
+    storage backend in one batch.
+
+    :param dynamodb: DDB client or storage backend
+    :param connection_ids: List of connection id strings
+    :return: Dict of connection items keyed by connection id, connections that do not exist or are past their expiry
+    are left out
+    """
+    now = time.time()
+    found = {}
+    missing = []
+    for connection_id in dict.fromkeys(connection_ids):
+        item = cached(connection_id)
+        if item:
+            found[connection_id] = item
+        else:
+            missing.append(connection_id)
+
+    if missing:
+        for item in storage.of(dynamodb).get_connections(missing):
+            if expiry.expired(item, now):
+                continue
+            found[item['connectionId']['S']] = item
+            if rooms.of(item) in _cache:
+                _cache[rooms.of(item)]['items'][item['connectionId']['S']] = item
+
+    return found
+
+
+def get(dynamodb, connection_id):
+    """
+    Look up one connection, from the per-container cache when this container has seen it
+
+    :param dynamodb: DDB client or storage backend
+    :param connection_id: Connection id string
+    :return: Connection item or None
+    """
+    return get_many(dynamodb, [connection_id]).get(connection_id)
+
+
+def count(dynamodb, room=rooms.DEFAULT_ROOM):
+    """
+    Number of live connections in a room, read from the sharded live-count counter
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :return: Integer count
+    """
+    return counters.total(dynamodb, live_count(room))
+
+
+def get_connections(dynamodb, room=rooms.DEFAULT_ROOM, live=None):
+    """
+    List the connections of a room, served from the per-container cache while it is younger than
+    CONNECTION_CACHE_TTL and its size matches the live count. Connections this container removed may still be in the
+    count until the connections table stream has taken them off. Otherwise the room index is queried again.
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :param live: Optional live count of the room when the caller has already read it
+    :return: List of connection items
+    """
+    cached = _cache.get(room)
+    if cached is None or time.monotonic() - cached['loaded_at'] >= cache_ttl() or \
+            not len(cached['items']) <= (count(dynamodb, room) if live is None else live) <= \
+            len(cached['items']) + len(cached['removed']):
+        cached = {
+            'items': {item['connectionId']['S']: item for item in query(dynamodb, room)},
+            'removed': set(),
+            'loaded_at': time.monotonic()
+        }
+        _cache[room] = cached
+    return list(cached['items'].values())
+
+
+def register(dynamodb, connection_id, username, room=rooms.DEFAULT_ROOM, encoding=None, now=None):
+    """
+    Store a new connection and count it as live in its room. The item expires after CONNECTION_TTL, so a connection
+    that never gets its $disconnect is reaped by the table's TTL.
+
+    :param dynamodb: DDB client or storage backend
+    :param connection_id: Connection id string
+    :param username: Chat username
+    :param room: Room name
+    :param encoding: Optional frame encoding negotiated by the client, JSON when omitted
+    :param now: Optional epoch seconds, defaults to now
+    :return: Connection item
+    """
+    now = int(now or time.time())
+    item = {'connectionId': {'S': connection_id}, 'username': {'S': username}, 'room': {'S': room},
+            CONNECTED_AT: {'N': str(now)}, expiry.ATTRIBUTE: expiry.value(connection_ttl(), now)}
+    if encoding and encoding != envelope.JSON:
+        item['encoding'] = {'S': encoding}
+    storage.of(dynamodb).put_connection(item)
+    counters.add(dynamodb, live_count(room), 1)
+
+    if room in _cache:
+        _cache[room]['items'][connection_id] = item
+    return item
+
+
+def unregister(dynamodb, connection_id):
+    """
+    Remove a connection. The storage takes it off the live count of its room once the item is gone, so a connection
+    that was already purged is not counted twice.
+
+    :param dynamodb: DDB client or storage backend
+    :param connection_id: Connection id string
+    :return: The removed connection item or None
+    """
+    item = storage.of(dynamodb).delete_connection(connection_id)
+    forget([connection_id])
+    return item
+
+
+def forget(connection_ids):
+    """
+    Drop connection ids from the per-container cache, together with the rate limit bucket copies of the connections
+
+    :param connection_ids: List of connection id strings
+    :return: None
+    """
+    for cached in _cache.values():
+        for connection_id in connection_ids:
+            if cached['items'].pop(connection_id, None) is not None:
+                cached['removed'].add(connection_id)
+    ratelimit.forget(connection_ids)
+
+
+def purge(dynamodb, items):
+    """
+    Remove stale connections in batches. The storage takes the ones that still existed off the live counts of their
+    rooms, so a connection whose $disconnect already unregistered it, or that another purge removed first, is not
+    taken off the count twice.
+
+    :param dynamodb: DDB client or storage backend
+    :param items: List of connection items
+    :return: List of connection ids that could not be removed
+    """
+    connection_ids = list(dict.fromkeys(item['connectionId']['S'] for item in items))
+    unremoved = storage.of(dynamodb).delete_connections(connection_ids)
+    forget(connection_ids)
+
+    return unremoved
+
+
+def send_to_all(dynamodb, apigatewaymanagementapi, items, data):
+    """
+    Post to connections and purge the ones API Gateway reports gone
+
+    :param dynamodb: DDB client or storage backend
+    :param apigatewaymanagementapi: apigatewaymanagementapi client
+    :param items: List of connection items
+    :param data: String, bytes or Frame
+    :return: BroadcastResult
+    """
+    result = broadcast.send_to_all(apigatewaymanagementapi, items, data)
+    if result.gone:
+        gone = set(result.gone)
+        purge(dynamodb, [item for item in items if item['connectionId']['S'] in gone])
+
+    return result
+
+
+def uncount(dynamodb, items):
+    """
+    Take removed connections off the live counts of their rooms. Called by the consumer of the connections table
+    stream once for every item that was deleted, whether by unregister, purge or the table's TTL.
+
+    :param dynamodb: DDB client or storage backend
+    :param items: List of removed connection items
+    :return: None
+    """
+    removed = {}
+    for item in items:
+        removed[rooms.of(item)] = removed.get(rooms.of(item), 0) + 1
+    for room, removed_count in removed.items():
+        counters.add(dynamodb, live_count(room), -removed_count)
+    forget([item['connectionId']['S'] for item in items])
+
+
+def reset():
+    """
+    Drop the per-container cache, used by tests
+    """
+    _cache.clear()
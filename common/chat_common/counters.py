@@ -0,0 +1,105 @@
+import os
+import random
+import time
+
+from chat_common import storage
+
+MESSAGE_COUNT = 'messages'
+
+# Per-container deltas that have not been written yet, keyed by counter name
+_pending = {}
+_last_flush = {'at': time.monotonic()}
+
+
+def shard_count():
+    return int(os.environ.get('COUNTER_SHARDS', '4'))
+
+
+def flush_interval():
+    return float(os.environ.get('COUNTER_FLUSH_INTERVAL', '0'))
+
+
+def shard_keys(name, shards=None):
+    return [f"{name}#{shard}" for shard in range(shards or shard_count())]
+
+
+def add(dynamodb, name, delta, shards=None):
+    """
+    Add delta to a random shard of a write-sharded counter
+
+    :param dynamodb: DDB client or storage backend
+    :param name: Counter name
+    :param delta: Integer to add, may be negative
+    :param shards: Number of shards, defaults to COUNTER_SHARDS
+    :return: None
+    """
+    storage.of(dynamodb).add_counter(random.choice(shard_keys(name, shards)), delta)
+
+
+def total(dynamodb, name, shards=None):
+    """
+    Read a write-sharded counter by summing its shards, read in a single batch
+
+    :param dynamodb: DDB client or storage backend
+    :param name: Counter name
+    :param shards: Number of shards, defaults to COUNTER_SHARDS
+    :return: Integer total
+    """
+    return totals(dynamodb, [name], shards)[name]
+
+
+def totals(dynamodb, names, shards=None):
+    """
+    Read several write-sharded counters in a single batch
+
+    :param dynamodb: DDB client or storage backend
+    :param names: List of counter names
+    :param shards: Number of shards, defaults to COUNTER_SHARDS
+    :return: Dict of integer totals keyed by counter name
+    """
+    counts = {name: 0 for name in names}
+    keys = [key for name in names for key in shard_keys(name, shards)]
+    for key, value in storage.of(dynamodb).get_counters(keys).items():
+        counts[key.rsplit('#', 1)[0]] += value
+    return counts
+
+
+def increment(name, delta=1):
+    """
+    Buffer a counter delta in the container, it is written by the next flush
+
+    :param name: Counter name
+    :param delta: Integer to add
+    :return: None
+    """
+    _pending[name] = _pending.get(name, 0) + delta
+
+
+def flush(dynamodb, force=False):
+    """
+    Write buffered deltas, one update per counter. Unless forced, deltas are only written once COUNTER_FLUSH_INTERVAL
+    seconds have passed since the last flush, an interval of 0 flushes every time.
+
+    :param dynamodb: DDB client or storage backend
+    :param force: Flush regardless of the interval
+    :return: Dict of flushed deltas
+    """
+    if not force and time.monotonic() - _last_flush['at'] < flush_interval():
+        return {}
+
+    flushed = {}
+    for name in list(_pending):
+        delta = _pending.pop(name)
+        if delta:
+            add(dynamodb, name, delta)
+            flushed[name] = delta
+    _last_flush['at'] = time.monotonic()
+    return flushed
+
+
+def reset():
+    """
+    Drop buffered deltas, used by tests
+    """
+    _pending.clear()
+    _last_flush['at'] = time.monotonic()
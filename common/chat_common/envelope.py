@@ -0,0 +1,177 @@
+import json
+import os
+
+from datetime import datetime
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ENCODINGS = (JSON, MSGPACK)
+
+# Room for a MessagePack array header to grow while messages are added to a chunk
+CHUNK_OVERHEAD = 5
+
+
+def chunk_size():
+    return int(os.environ.get('HISTORY_CHUNK_BYTES', '32768'))
+
+
+def validate(encoding):
+    """
+    Check the frame encoding a client asked for when connecting
+
+    :param encoding: Encoding name, empty for the default
+    :return: Encoding name
+    """
+    if not encoding:
+        return JSON
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported encoding {encoding}, use one of {', '.join(ENCODINGS)}")
+    return encoding
+
+
+def of(item):
+    """
+    Frame encoding of a connection item, connections without one get JSON
+
+    :param item: Connection item from DDB
+    :return: Encoding name
+    """
+    return item.get('encoding', {}).get('S', JSON)
+
+
+def create(seq, room, sender, body, timestamp):
+    """
+    Build the envelope of a chat message
+
+    :param seq: Sequence number of the message in its room, also the client's cursor
+    :param room: Room name
+    :param sender: Username of the sender
+    :param body: Message text
+    :param timestamp: Server time in epoch seconds
+    :return: Envelope dict
+    """
+    return {'seq': seq, 'room': room, 'sender': sender, 'timestamp': int(timestamp * 1000), 'body': body}
+
+
+def from_item(item):
+    """
+    Build the envelope of a stored message. Messages stored before envelopes only have a preformatted data string,
+    which becomes the body.
+
+    :param item: Message item from DDB
+    :return: Envelope dict
+    """
+    return create(
+        int(item['seq']['N']),
+        item.get('room', {}).get('S'),
+        item.get('sender', {}).get('S'),
+        item['body']['S'] if 'body' in item else item['data']['S'],
+        float(item['timestamp']['N']) if 'timestamp' in item else 0
+    )
+
+
+def format(message):
+    """
+    Render an envelope as a line of text for clients that do not read frames
+
+    :param message: Envelope dict
+    :return: String
+    """
+    if not message['sender']:
+        return message['body']
+    now = datetime.fromtimestamp(message['timestamp'] / 1000.0).strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{now} {message['sender']}] {message['body']}"
+
+
+def encode(content, encoding=JSON):
+    """
+    Serialise a frame
+
+    :param content: Frame dict
+    :param encoding: Encoding name
+    :return: JSON string or MessagePack bytes
+    """
+    if encoding == MSGPACK:
+        # msgpack is only imported when a client negotiated it
+        import msgpack
+
+        return msgpack.packb(content, use_bin_type=True)
+    return json.dumps(content, separators=(',', ':'))
+
+
+class Frame(object):
+    """
+    Frame sent to many connections. Each encoding is serialised once and the payload is reused for every recipient.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self._payloads = {}
+
+    def encoded(self, encoding=JSON):
+        if encoding not in self._payloads:
+            self._payloads[encoding] = encode(self.content, encoding)
+        return self._payloads[encoding]
+
+
+def messages(envelopes, **fields):
+    """
+    Frame carrying chat messages
+
+    :param envelopes: List of envelope dicts, oldest first
+    :param fields: Extra top level fields of the frame
+    :return: Frame
+    """
+    fields['messages'] = list(envelopes)
+    return Frame(fields)
+
+
+def chunks(envelopes, encoding=JSON, limit=None, **fields):
+    """
+    Split chat messages into frames that each fit in one post. Every frame carries its position in chunk and the
+    final one has last set, so the client can put them back in order and render each as it arrives.
+
+    :param envelopes: Iterable of envelope dicts, oldest first
+    :param encoding: Encoding name
+    :param limit: Maximum bytes per frame, defaults to HISTORY_CHUNK_BYTES
+    :param fields: Extra top level fields of the first frame
+    :return: Generator of encoded frames
+    """
+    limit = limit or chunk_size()
+    content = dict(fields, chunk=0, last=False, messages=[])
+    size = len(encode(content, encoding)) + CHUNK_OVERHEAD
+    for message in envelopes:
+        # Each message also takes a separator in JSON
+        message_size = len(encode(message, encoding)) + 1
+        if content['messages'] and size + message_size > limit:
+            yield encode(content, encoding)
+            content = {'chunk': content['chunk'] + 1, 'last': False, 'messages': []}
+            size = len(encode(content, encoding)) + CHUNK_OVERHEAD
+        content['messages'].append(message)
+        size += message_size
+
+    content['last'] = True
+    yield encode(content, encoding)
+
+
+def text_chunks(head, lines, limit=None):
+    """
+    Split a text message into posts of at most limit bytes at line boundaries, for clients that do not read frames
+
+    :param head: Text the first post starts with
+    :param lines: Iterable of lines
+    :param limit: Maximum bytes per post, defaults to HISTORY_CHUNK_BYTES
+    :return: Generator of strings
+    """
+    limit = limit or chunk_size()
+    prefix, parts, size = head, [], len(head.encode('utf-8'))
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + (1 if parts else 0)
+        if (prefix or parts) and size + line_size > limit:
+            yield prefix + '\n'.join(parts)
+            prefix, parts, size = '', [], 0
+            line_size = len(line.encode('utf-8'))
+        parts.append(line)
+        size += line_size
+
+    yield prefix + '\n'.join(parts)
@@ -0,0 +1,27 @@
+import time
+
+# TTL attribute of the connections and messages tables, DynamoDB deletes items some time after it has passed
+ATTRIBUTE = 'expires'
+
+
+def value(ttl, now=None):
+    """
+    TTL attribute value of an item written now
+
+    :param ttl: Seconds the item lives
+    :param now: Optional epoch seconds, defaults to now
+    :return: DDB number value with the expiry in epoch seconds
+    """
+    return {'N': str(int(now or time.time()) + int(ttl))}
+
+
+def expired(item, now=None):
+    """
+    Whether an item has passed its expiry. DynamoDB only reaps expired items eventually, so reads leave them out
+    themselves. Items written without an expiry never expire.
+
+    :param item: Item from DDB
+    :param now: Optional epoch seconds, defaults to now
+    :return: Boolean
+    """
+    return ATTRIBUTE in item and int(item[ATTRIBUTE]['N']) <= (now or time.time())
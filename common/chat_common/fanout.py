@@ -0,0 +1,60 @@
+import json
+import os
+import uuid
+
+from chat_common import envelope
+
+
+def queue_url():
+    return os.environ.get('FANOUT_QUEUE_URL')
+
+
+def batch_size():
+    return int(os.environ.get('FANOUT_BATCH_SIZE', '500'))
+
+
+def enqueue(sqs, endpoint_url, data, room):
+    """
+    Queue a message for the fan-out worker. The queue is a FIFO queue and every room is its own message group, so
+    the messages of a room are broadcast in the order they were queued while rooms are broadcast in parallel.
+
+    :param sqs: SQS client
+    :param endpoint_url: Management API endpoint the worker posts to
+    :param data: String message or envelope.Frame
+    :param room: Room the message is broadcast to
+    :return: SQS message id
+    """
+    message = {'endpointUrl': endpoint_url, 'room': room}
+    if isinstance(data, envelope.Frame):
+        message['frame'] = data.content
+    else:
+        message['data'] = data
+    # A new deduplication id per message, so only SDK retries of the same send are dropped by the queue
+    response = sqs.send_message(QueueUrl=queue_url(), MessageBody=json.dumps(message), MessageGroupId=room,
+                                MessageDeduplicationId=uuid.uuid4().hex)
+    return response['MessageId']
+
+
+def payload(message):
+    """
+    Data of a queued message, frames are rebuilt so every encoding is serialised once for the whole room
+
+    :param message: Decoded SQS message body
+    :return: String message or envelope.Frame
+    """
+    if 'frame' in message:
+        return envelope.Frame(message['frame'])
+    return message['data']
+
+
+def batches(connection_ids, size=None):
+    """
+    Split the recipients of a broadcast into batches
+
+    :param connection_ids: List of connection ids from DDB
+    :param size: Batch size, defaults to FANOUT_BATCH_SIZE
+    :return: Generator of connection id lists
+    """
+    size = size or batch_size()
+    for i in range(0, len(connection_ids), size):
+        yield connection_ids[i:i + size]
@@ -0,0 +1,120 @@
+import os
+import time
+
+from chat_common import expiry, rooms, storage
+
+
+def history_size():
+    return int(os.environ.get('MESSAGE_HISTORY_SIZE', '20'))
+
+
+def message_ttl():
+    """
+    Seconds a message stays in the history, 0 keeps it until a newer message takes its slot
+    """
+    return int(os.environ.get('MESSAGE_TTL', '604800'))
+
+
+def slot_key(seq, size=None, room=rooms.DEFAULT_ROOM):
+    """
+    Ring buffer slot that holds the message with the given sequence number
+
+    :param seq: Message sequence number
+    :param size: Ring buffer size, defaults to MESSAGE_HISTORY_SIZE
+    :param room: Room the message belongs to, every room has its own ring buffer
+    :return: Slot key string
+    """
+    return f"{room}#slot#{seq % (size or history_size())}"
+
+
+def sequence_key(room=rooms.DEFAULT_ROOM):
+    return f"sequence#{room}"
+
+
+def next_sequence(dynamodb, room=rooms.DEFAULT_ROOM, count=1):
+    """
+    Atomically allocate the next message sequence numbers of a room
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :param count: Number of sequence numbers to allocate
+    :return: Last allocated sequence number
+    """
+    return storage.of(dynamodb).next_sequence(sequence_key(room), count)
+
+
+def store(dynamodb, body, room=rooms.DEFAULT_ROOM, seq=None, sender=None, timestamp=None):
+    """
+    Write a message into its ring buffer slot, overwriting the oldest message. The write is conditional on the slot
+    holding an older sequence so a slow writer never replaces a newer message. The message expires after MESSAGE_TTL,
+    so the history of a quiet room is emptied by the table's TTL without any delete.
+
+    :param dynamodb: DDB client or storage backend
+    :param body: Message text
+    :param room: Room name
+    :param seq: Sequence number allocated by next_sequence, allocates one when omitted
+    :param sender: Optional username of the sender
+    :param timestamp: Server time in epoch seconds, defaults to now
+    :return: Sequence number of the stored message
+    """
+    seq = seq or next_sequence(dynamodb, room)
+    item = {
+        'myid': {'S': slot_key(seq, room=room)},
+        'room': {'S': room},
+        'seq': {'N': str(seq)},
+        'timestamp': {'N': str(timestamp or time.time())},
+        'body': {'S': body}
+    }
+    if sender:
+        item['sender'] = {'S': sender}
+    if message_ttl() > 0:
+        item[expiry.ATTRIBUTE] = expiry.value(message_ttl())
+    # When a newer message already took this slot, ours has fallen out of the history window and is not written
+    storage.of(dynamodb).put_message(item)
+
+    return seq
+
+
+def store_many(dynamodb, messages, room=rooms.DEFAULT_ROOM, sender=None, timestamp=None):
+    """
+    Write a batch of messages with a single sequence allocation. Messages that would be overwritten by later
+    messages of the same batch are not written.
+
+    :param dynamodb: DDB client or storage backend
+    :param messages: List of message texts, oldest first
+    :param room: Room name
+    :param sender: Optional username of the sender
+    :param timestamp: Server time in epoch seconds, defaults to now
+    :return: List of sequence numbers, one per message
+    """
+    last = next_sequence(dynamodb, room, len(messages))
+    sequences = list(range(last - len(messages) + 1, last + 1))
+    for body, seq in list(zip(messages, sequences))[-history_size():]:
+        store(dynamodb, body, room, seq, sender, timestamp)
+    return sequences
+
+
+def latest(dynamodb, room=rooms.DEFAULT_ROOM, limit=None, since=None):
+    """
+    Fetch the most recent messages of a room. Messages past their expiry that the table's TTL has not reaped yet are
+    left out.
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :param limit: Maximum number of messages, defaults to MESSAGE_HISTORY_SIZE
+    :param since: Optional cursor, only messages with a higher sequence number are returned
+    :return: List of message items, oldest first
+    """
+    now = time.time()
+    items = storage.of(dynamodb).latest_messages(room, limit or history_size(), since)
+    return [item for item in items if not expiry.expired(item, now)]
+
+
+def cursor(item):
+    """
+    Cursor of a message item, the sequence number clients pass back as since
+
+    :param item: Message item
+    :return: Integer
+    """
+    return int(item['seq']['N'])
@@ -0,0 +1,116 @@
+import os
+import time
+
+from chat_common import broadcast, concurrency, connections, expiry, metrics, storage
+
+ALIVE = 'alive'
+GONE = 'gone'
+FAILED = 'failed'
+
+
+def segments():
+    return int(os.environ.get('SWEEP_SEGMENTS', '4'))
+
+
+def grace():
+    return int(os.environ.get('SWEEP_GRACE', '60'))
+
+
+def settled(item, now=None):
+    """
+    Whether a connection is old enough to be checked. A connection is stored during its $connect, before the
+    management API knows it, so a check right then would find it gone. Items stored before connectedAt was written
+    fall back to their expiry, which is only right while CONNECTION_TTL has not changed since.
+
+    :param item: Connection item
+    :param now: Optional epoch seconds, defaults to now
+    :return: Boolean
+    """
+    if connections.CONNECTED_AT in item:
+        connected = int(item[connections.CONNECTED_AT]['N'])
+    elif expiry.ATTRIBUTE in item:
+        connected = int(item[expiry.ATTRIBUTE]['N']) - connections.connection_ttl()
+    else:
+        return True
+    return connected <= (now or time.time()) - grace()
+
+
+def endpoint_url():
+    """
+    Management API endpoint of the WebSocket API, scheduled events do not carry one
+    """
+    return os.environ.get('MANAGEMENT_ENDPOINT_URL')
+
+
+def scan(dynamodb, total_segments=None):
+    """
+    Read every connection with one parallel scan per segment
+
+    :param dynamodb: DDB client or storage backend
+    :param total_segments: Number of segments, defaults to SWEEP_SEGMENTS
+    :return: List of connection items
+    """
+    # concurrent.futures is imported on first use so importing a handler stays cheap
+    from concurrent.futures import ThreadPoolExecutor
+
+    total_segments = total_segments or segments()
+    backend = storage.of(dynamodb)
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        pages = executor.map(lambda segment: backend.scan_connections(segment, total_segments), range(total_segments))
+        # Segments do not overlap, but DynamoDB emulators may return the whole table for each of them
+        return list({item['connectionId']['S']: item for page in pages for item in page}.values())
+
+
+def check(apigatewaymanagementapi, connection_id, controller=None):
+    """
+    Ask the management API whether a connection is still open
+
+    :param apigatewaymanagementapi: apigatewaymanagemntapi client
+    :param connection_id: Connection id string
+    :param controller: Optional concurrency.Controller that admits the call and learns from its outcome
+    :return: ALIVE, GONE, or FAILED when the API could not tell
+    """
+    token = None
+    if controller is not None:
+        try:
+            token = controller.acquire()
+        except concurrency.CircuitOpen:
+            return FAILED
+
+    status, error = broadcast.DELIVERED, None
+    try:
+        apigatewaymanagementapi.get_connection(ConnectionId=connection_id)
+    except Exception as e:
+        status, error = broadcast.classify_error(e), e
+        if status != broadcast.GONE:
+            print(e)
+    finally:
+        if controller is not None:
+            controller.release(token, throttled=status == broadcast.THROTTLED,
+                               failed=broadcast.endpoint_failed(status, error))
+    return {broadcast.DELIVERED: ALIVE, broadcast.GONE: GONE}.get(status, FAILED)
+
+
+def check_all(apigatewaymanagementapi, items, workers=None):
+    """
+    Check connections in parallel using a bounded thread pool, sharing the concurrency.Controller of the client with
+    broadcasts
+
+    :param apigatewaymanagementapi: apigatewaymanagemntapi client
+    :param items: List of connection items
+    :param workers: Maximum number of concurrent checks, defaults to BROADCAST_MAX_WORKERS
+    :return: Dict of status keyed by connection id
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not items:
+        return {}
+    workers = workers or broadcast.max_workers()
+    controller = concurrency.controller(apigatewaymanagementapi, workers)
+    connection_ids = [item['connectionId']['S'] for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(connection_ids))) as executor:
+        statuses = dict(zip(connection_ids, executor.map(
+            lambda connection_id: check(apigatewaymanagementapi, connection_id, controller), connection_ids)))
+    for name, value in controller.snapshot().items():
+        metrics.gauge(name, value)
+    return statuses
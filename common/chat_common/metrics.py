@@ -0,0 +1,180 @@
+import functools
+import json
+import os
+import threading
+import time
+
+from collections import Counter
+
+NAMESPACE = 'SimpleChat'
+
+_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no', 'off')
+
+
+def namespace():
+    return os.environ.get('METRICS_NAMESPACE', NAMESPACE)
+
+
+class Invocation(object):
+    """
+    Timings and AWS call counts of one handler invocation
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.started = time.perf_counter()
+        self.phases = Counter()
+        self.calls = Counter()
+        self.counts = Counter()
+        self.gauges = {}
+        self.error = None
+
+    def elapsed(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def record(self):
+        """
+        Build the log record in CloudWatch Embedded Metric Format, so the values are both searchable in the logs and
+        published as metrics without extra API calls
+
+        :return: Dict
+        """
+        values = {'durationMs': round(self.elapsed(), 3)}
+        values.update({f"{name}Ms": round(ms, 3) for name, ms in self.phases.items()})
+        values.update(self.calls)
+        values.update(self.counts)
+        values.update(self.gauges)
+
+        units = {name: 'Milliseconds' if name.endswith('Ms') else 'Count' for name in values}
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace(),
+                    'Dimensions': [['function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+                }],
+            },
+            'function': self.function,
+        }
+        record.update(values)
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+# The invocation is kept in a module global rather than a thread local so broadcast worker threads add their AWS
+# calls to it. A Lambda container runs one invocation at a time.
+_current = None
+
+
+def current():
+    return _current
+
+
+class phase(object):
+    """
+    Context manager that adds the time spent in the block to a named phase of the current invocation. Phases entered
+    more than once, like the broadcast of every fan-out batch, are summed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        invocation = _current
+        if invocation is not None:
+            invocation.phases[self.name] += (time.perf_counter() - self.started) * 1000
+        return False
+
+
+def count(name, value=1):
+    """
+    Add to a named counter of the current invocation
+
+    :param name: Counter name
+    :param value: Increment
+    :return: None
+    """
+    invocation = _current
+    if invocation is not None:
+        with _lock:
+            invocation.counts[name] += value
+
+
+def gauge(name, value):
+    """
+    Set a named value of the current invocation, the last value set is recorded
+
+    :param name: Gauge name
+    :param value: Value
+    :return: None
+    """
+    invocation = _current
+    if invocation is not None:
+        with _lock:
+            invocation.gauges[name] = value
+
+
+def on_call(model, **kwargs):
+    """
+    botocore before-call hook counting the AWS calls of the current invocation per service and operation
+    """
+    invocation = _current
+    if invocation is not None:
+        name = f"{model.service_model.service_name}.{model.name}"
+        with _lock:
+            invocation.calls[name] += 1
+
+
+def instrument(client):
+    """
+    Register the call counting hook on a boto3 client. Clients without botocore events, like test stubs, are returned
+    unchanged.
+
+    :param client: boto3 client
+    :return: The client
+    """
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is not None:
+        events.register('before-call', on_call, unique_id='chat-common-metrics')
+    return client
+
+
+def emit(invocation):
+    print(json.dumps(invocation.record()))
+
+
+def instrumented(function):
+    """
+    Decorator for a Lambda handler that times the invocation and prints one metrics line when it finishes
+
+    :param function: Function name used as the metric dimension
+    :return: Decorator
+    """
+    def decorator(handle):
+        @functools.wraps(handle)
+        def wrapper(*args, **kwargs):
+            global _current
+            if not enabled():
+                return handle(*args, **kwargs)
+
+            invocation = _current = Invocation(function)
+            try:
+                return handle(*args, **kwargs)
+            except Exception as e:
+                invocation.error = type(e).__name__
+                raise
+            finally:
+                _current = None
+                emit(invocation)
+        return wrapper
+    return decorator
@@ -0,0 +1,132 @@
+import json
+import os
+import time
+
+from chat_common import storage
+
+JOINED = 1
+LEFT = -1
+
+
+def window():
+    return int(os.environ.get('PRESENCE_WINDOW', '2'))
+
+
+def queue_url():
+    """
+    Standard queue of the delayed presence flushes, the FIFO fan-out queue cannot delay single messages
+    """
+    return os.environ.get('PRESENCE_QUEUE_URL')
+
+
+def enabled():
+    """
+    Presence events are coalesced when a window is configured and the presence queue is there to flush it
+
+    :return: Boolean
+    """
+    return window() > 0 and bool(queue_url())
+
+
+def window_key(room):
+    return f"presence#{room}"
+
+
+def stale(opened, now):
+    """
+    Whether a window has been open so long that its flush was lost, for instance because the flush could not be
+    queued or expired in the queue while the fan-out worker was down
+
+    :param opened: Epoch seconds the window was opened
+    :param now: Epoch seconds
+    :return: Boolean
+    """
+    return now - opened >= 2 * max(window(), 1)
+
+
+def queue_flush(sqs, endpoint_url, room, delay):
+    message = {'endpointUrl': endpoint_url, 'room': room, 'presence': True}
+    sqs.send_message(QueueUrl=queue_url(), MessageBody=json.dumps(message), DelaySeconds=delay)
+
+
+def record(dynamodb, sqs, endpoint_url, room, username, change, now=None):
+    """
+    Add a join or leave to the open presence window of a room. Every user keeps a net change, so a user that leaves
+    and joins again within the window cancels out. The event that opens a window queues its flush for the fan-out
+    worker, delayed until the window closes. A window whose flush never came is flushed right away by the first event
+    that finds it stale.
+
+    :param dynamodb: DDB client or storage backend
+    :param sqs: SQS client
+    :param endpoint_url: Management API endpoint the worker posts to
+    :param room: Room name
+    :param username: Chat username
+    :param change: JOINED or LEFT
+    :param now: Optional epoch seconds, defaults to now
+    :return: True when this event queued the flush of the window
+    """
+    now = int(now or time.time())
+    backend = storage.of(dynamodb)
+    opened, created = backend.add_presence(window_key(room), username, change, now)
+    if created:
+        delay = window()
+    elif stale(opened, now) and backend.reopen_presence(window_key(room), opened, now):
+        # Only the event that moved the opening time queues the flush, the others see a fresh window
+        opened, delay = now, 0
+    else:
+        return False
+
+    try:
+        queue_flush(sqs, endpoint_url, room, delay)
+    except Exception:
+        # Leave the window stale, so the next event of the room queues the flush instead
+        backend.reopen_presence(window_key(room), opened, 0)
+        raise
+    return True
+
+
+def changes(window_changes):
+    """
+    Users that joined and left during a window, users whose joins and leaves cancel out are dropped
+
+    :param window_changes: Dict of net changes keyed by username
+    :return: (sorted joined usernames, sorted left usernames)
+    """
+    joined, left = [], []
+    for username, change in window_changes.items():
+        if change > 0:
+            joined.append(username)
+        elif change < 0:
+            left.append(username)
+    return sorted(joined), sorted(left)
+
+
+def text(joined, left):
+    """
+    One presence update for a whole window, a single join or leave reads like the notices sent without coalescing
+
+    :param joined: List of usernames
+    :param left: List of usernames
+    :return: String message
+    """
+    parts = []
+    if joined:
+        parts.append(f"{joined[0]} has joined" if len(joined) == 1 else f"{len(joined)} users joined")
+    if left:
+        parts.append(f"{left[0]} has left" if len(left) == 1 else f"{len(left)} users left")
+    return f"{' and '.join(parts)} the chat room"
+
+
+def flush(dynamodb, room):
+    """
+    Close the presence window of a room. The window is deleted in the same call that reads it, events that arrive
+    afterwards open the next window.
+
+    :param dynamodb: DDB client or storage backend
+    :param room: Room name
+    :return: Presence update string, or None when nothing changed
+    """
+    joined, left = changes(storage.of(dynamodb).take_presence(window_key(room)))
+    if not joined and not left:
+        return None
+    return text(joined, left)
@@ -0,0 +1,215 @@
+import os
+import time
+
+from chat_common import storage
+
+CONNECTION = 'connection'
+ROOM = 'room'
+MAX_ATTEMPTS = 3
+# Bucket copies a container keeps, the least recently used copies are dropped first
+MAX_CACHED_BUCKETS = 10000
+
+# Per-container copy of the buckets this container has seen, keyed by bucket key. Other containers only ever take
+# tokens, so the real bucket never holds more than the copy and a bucket that is empty here is empty everywhere.
+_buckets = {}
+
+
+def limits(scope):
+    """
+    Token bucket settings of a scope
+
+    :param scope: CONNECTION or ROOM
+    :return: (tokens per second, burst size), a rate of 0 disables the limit
+    """
+    if scope == CONNECTION:
+        return (float(os.environ.get('RATE_LIMIT_CONNECTION_RATE', '1')),
+                float(os.environ.get('RATE_LIMIT_CONNECTION_BURST', '5')))
+    return (float(os.environ.get('RATE_LIMIT_ROOM_RATE', '20')),
+            float(os.environ.get('RATE_LIMIT_ROOM_BURST', '50')))
+
+
+def bucket_key(scope, name):
+    return f"ratelimit#{scope}#{name}"
+
+
+def load(dynamodb, key):
+    """
+    Read a bucket, a bucket that does not exist yet is full
+
+    :param dynamodb: DDB client or storage backend
+    :param key: Bucket key
+    :return: Bucket state dict with the tokens and updated timestamp number strings, None for a new bucket
+    """
+    bucket = storage.of(dynamodb).get_bucket(key)
+    if bucket is None:
+        return {'tokens': None, 'updated': None}
+    return {'tokens': bucket[0], 'updated': bucket[1]}
+
+
+def remember(key, state):
+    """
+    Keep a bucket copy as the most recently used one, dropping the oldest copies beyond MAX_CACHED_BUCKETS
+
+    :param key: Bucket key
+    :param state: Bucket state
+    :return: None
+    """
+    _buckets.pop(key, None)
+    _buckets[key] = state
+    while len(_buckets) > MAX_CACHED_BUCKETS:
+        del _buckets[next(iter(_buckets))]
+
+
+def refill(state, rate, burst, now):
+    """
+    Tokens in a bucket at time now
+
+    :param state: Bucket state
+    :param rate: Tokens per second
+    :param burst: Bucket size
+    :param now: Epoch seconds
+    :return: Float
+    """
+    if state['updated'] is None:
+        return burst
+    return min(burst, float(state['tokens']) + max(0.0, now - float(state['updated'])) * rate)
+
+
+def update(dynamodb, key, state, tokens, rate, burst, now):
+    """
+    Write a bucket on the condition that it still holds the state it was read with, so two containers never both
+    spend the same tokens. The bucket expires once it would have refilled, a bucket that is gone is full, so the
+    table's TTL removes buckets of connections that are long gone.
+
+    :param dynamodb: DDB client or storage backend
+    :param key: Bucket key
+    :param state: Bucket state the tokens were worked out from
+    :param tokens: New number of tokens, negative while the bucket is in debt
+    :param rate: Tokens per second
+    :param burst: Bucket size
+    :param now: Epoch seconds
+    :return: The new bucket state, None when another container changed the bucket since it was read
+    """
+    new_state = {'tokens': f"{tokens:.6f}", 'updated': f"{now:.6f}"}
+    previous = None if state['updated'] is None else (state['tokens'], state['updated'])
+    expires = int(now + (burst - tokens) / rate) + 1
+    if not storage.of(dynamodb).put_bucket(key, new_state['tokens'], new_state['updated'], previous, expires):
+        return None
+    remember(key, new_state)
+    return new_state
+
+
+def acquire(dynamodb, scope, name, cost=1, now=None):
+    """
+    Take tokens from a bucket. A warm container uses its copy of the bucket and needs one write, and rejects without
+    any storage call when its copy is already empty. A request larger than the bucket is let through once the bucket
+    is full and leaves it in debt, so it waits as long to refill as the tokens it took would have, and batching never
+    gets past the rate.
+
+    :param dynamodb: DDB client or storage backend
+    :param scope: CONNECTION or ROOM
+    :param name: Connection id or room name
+    :param cost: Number of tokens to take
+    :param now: Optional epoch seconds, defaults to now
+    :return: 0 when the tokens were taken, otherwise the seconds until enough tokens are available
+    """
+    rate, burst = limits(scope)
+    if rate <= 0:
+        return 0
+
+    # Tokens the bucket must hold before the request passes, a full bucket for a request larger than the bucket
+    needed = min(cost, burst)
+    key = bucket_key(scope, name)
+    now = now or time.time()
+    state = _buckets.get(key)
+    if state is None:
+        state = load(dynamodb, key)
+
+    for attempt in range(MAX_ATTEMPTS):
+        tokens = refill(state, rate, burst, now)
+        if tokens < needed:
+            remember(key, state)
+            return (needed - tokens) / rate
+
+        if update(dynamodb, key, state, tokens - cost, rate, burst, now) is None:
+            # Another container took tokens since our copy was made
+            state = load(dynamodb, key)
+            continue
+        return 0
+
+    # Still contended after MAX_ATTEMPTS, the bucket is busy enough to push back
+    _buckets.pop(key, None)
+    return 1 / rate
+
+
+def refund(dynamodb, scope, name, cost=1, now=None):
+    """
+    Give back tokens taken for a request that was rejected after all
+
+    :param dynamodb: DDB client or storage backend
+    :param scope: CONNECTION or ROOM
+    :param name: Connection id or room name
+    :param cost: Number of tokens to give back
+    :param now: Optional epoch seconds, defaults to now
+    :return: None
+    """
+    rate, burst = limits(scope)
+    if rate <= 0:
+        return
+
+    key = bucket_key(scope, name)
+    now = now or time.time()
+    state = _buckets.get(key)
+    if state is None:
+        state = load(dynamodb, key)
+
+    for attempt in range(MAX_ATTEMPTS):
+        if state['updated'] is None:
+            # The bucket is gone and so full already
+            return
+        if update(dynamodb, key, state, min(burst, refill(state, rate, burst, now) + cost), rate, burst, now):
+            return
+        state = load(dynamodb, key)
+
+    # The tokens are lost to a busy bucket, it refills on its own
+    _buckets.pop(key, None)
+
+
+def check(dynamodb, connection_id, room, cost=1):
+    """
+    Apply the per-connection and then the per-room limit to a send. When the room rejects the send, the tokens taken
+    from the connection are given back, a sender does not pay for a message that was neither stored nor broadcast.
+
+    :param dynamodb: DDB client or storage backend
+    :param connection_id: Sender connection id
+    :param room: Room name
+    :param cost: Number of tokens the send takes
+    :return: None when allowed, otherwise a throttle reply dict for the sender
+    """
+    retry_after = acquire(dynamodb, CONNECTION, connection_id, cost)
+    if retry_after:
+        return {'error': 'throttled', 'scope': CONNECTION, 'retryAfter': round(retry_after, 3)}
+
+    retry_after = acquire(dynamodb, ROOM, room, cost)
+    if retry_after:
+        refund(dynamodb, CONNECTION, connection_id, cost)
+        return {'error': 'throttled', 'scope': ROOM, 'retryAfter': round(retry_after, 3)}
+    return None
+
+
+def forget(connection_ids):
+    """
+    Drop the bucket copies of closed connections
+
+    :param connection_ids: List of connection id strings
+    :return: None
+    """
+    for connection_id in connection_ids:
+        _buckets.pop(bucket_key(CONNECTION, connection_id), None)
+
+
+def reset():
+    """
+    Drop the per-container bucket copies, used by tests
+    """
+    _buckets.clear()
@@ -0,0 +1,27 @@
+import re
+
+DEFAULT_ROOM = 'global'
+ROOM_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def validate(room):
+    """
+    Check a room name, an empty name selects the default room
+
+    :param room: Room name from the client
+    :return: Room name
+    """
+    room = room or DEFAULT_ROOM
+    if not ROOM_PATTERN.match(room):
+        raise ValueError(f"Invalid room name: {room}")
+    return room
+
+
+def of(item):
+    """
+    Room a connection or message item belongs to
+
+    :param item: DDB item
+    :return: Room name
+    """
+    return item.get('room', {}).get('S', DEFAULT_ROOM)
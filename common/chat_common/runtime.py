@@ -0,0 +1,83 @@
+import os
+
+from chat_common import metrics, storage
+
+_clients = {}
+
+
+def config():
+    """
+    botocore Config shared by every client. The connection pool is sized for the broadcast thread pool and keep-alive
+    lets warm containers reuse connections across invocations.
+
+    :return: botocore Config
+    """
+    # botocore is imported on first use so importing a handler stays cheap
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=int(os.environ.get('BROADCAST_MAX_WORKERS', '16')),
+        tcp_keepalive=True,
+        connect_timeout=float(os.environ.get('BOTO_CONNECT_TIMEOUT', '2')),
+        read_timeout=float(os.environ.get('BOTO_READ_TIMEOUT', '5')),
+        retries={'mode': 'standard', 'max_attempts': int(os.environ.get('BOTO_MAX_ATTEMPTS', '3'))}
+    )
+
+
+def client(service_name, endpoint_url=None):
+    """
+    Return a boto3 client that is created once per container and reused by later invocations. Its AWS calls are
+    counted in the metrics line of the invocation.
+
+    :param service_name: AWS service name
+    :param endpoint_url: Optional endpoint url, each endpoint gets its own client
+    :return: boto3 client
+    """
+    key = (service_name, endpoint_url)
+    if key not in _clients:
+        import boto3
+
+        _clients[key] = metrics.instrument(boto3.client(service_name, endpoint_url=endpoint_url, config=config()))
+    return _clients[key]
+
+
+def dynamodb():
+    """
+    Storage the functions read and write, the DDB client unless STORAGE_BACKEND selects the SQLite database at
+    SQLITE_PATH. Either is opened once per container.
+
+    :return: DDB client or storage backend
+    """
+    if storage.backend() == storage.SQLITE:
+        key = (storage.SQLITE, storage.sqlite_path())
+        if key not in _clients:
+            from chat_common.storage.sqlite import SQLiteStorage
+
+            _clients[key] = SQLiteStorage(storage.sqlite_path())
+        return _clients[key]
+    return client('dynamodb')
+
+
+def sqs():
+    return client('sqs')
+
+
+def endpoint_url(event):
+    """
+    Management API endpoint of the WebSocket API that sent the event
+
+    :param event: API Gateway WebSocket event
+    :return: Endpoint url string
+    """
+    return f"https://{event['requestContext']['domainName']}/{event['requestContext']['stage']}"
+
+
+def apigatewaymanagementapi(event):
+    return client('apigatewaymanagementapi', endpoint_url=endpoint_url(event))
+
+
+def reset():
+    """
+    Drop cached clients, used by tests
+    """
+    _clients.clear()
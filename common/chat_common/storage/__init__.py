@@ -0,0 +1,201 @@
+import abc
+import os
+
+DYNAMODB = 'dynamodb'
+SQLITE = 'sqlite'
+BACKENDS = (DYNAMODB, SQLITE)
+
+
+def backend():
+    return os.environ.get('STORAGE_BACKEND', DYNAMODB)
+
+
+def sqlite_path():
+    return os.environ.get('SQLITE_PATH', 'chat.db')
+
+
+class Storage(abc.ABC):
+    """
+    Interface of a storage backend. Connections, messages, counters, rate limit buckets and presence windows are only
+    read and written through it. Connection and message items keep the DynamoDB attribute value format, which is what
+    the functions and their callers already read. Every removed connection is taken off the live count of its room
+    exactly once by the storage behind the backend, however the connection was removed. Every method is abstract, so
+    a backend that leaves one out fails when it is created rather than on the first call.
+    """
+
+    @abc.abstractmethod
+    def put_connection(self, item):
+        """
+        :param item: Connection item
+        :return: None
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_connection(self, connection_id):
+        """
+        :param connection_id: Connection id string
+        :return: The removed connection item or None
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_connections(self, connection_ids):
+        """
+        :param connection_ids: List of connection id strings
+        :return: List of connection ids that could not be removed
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_connections(self, connection_ids):
+        """
+        :param connection_ids: List of connection id strings
+        :return: List of connection items, connections that do not exist are left out
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def room_connections(self, room):
+        """
+        :param room: Room name
+        :return: List of connection items of the room
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def all_connections(self):
+        """
+        :return: List of every connection item
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def scan_connections(self, segment, segments):
+        """
+        Read one of several disjoint parts of the connections, so the parts can be read in parallel
+
+        :param segment: Part to read, from 0 to segments - 1
+        :param segments: Number of parts
+        :return: List of connection items of the part
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_counter(self, key, delta):
+        """
+        :param key: Counter key
+        :param delta: Integer to add, may be negative
+        :return: None
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_counters(self, keys):
+        """
+        :param keys: List of counter keys
+        :return: Dict of integer values keyed by counter key, counters that do not exist are left out
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def next_sequence(self, key, count=1):
+        """
+        :param key: Sequence key
+        :param count: Number of sequence numbers to allocate
+        :return: Last allocated sequence number
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put_message(self, item):
+        """
+        Write a message into its slot unless the slot already holds a newer message
+
+        :param item: Message item with myid, room and seq
+        :return: True when the message was written
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def latest_messages(self, room, limit, since=None):
+        """
+        :param room: Room name
+        :param limit: Maximum number of messages
+        :param since: Optional cursor, only messages with a higher sequence number are returned
+        :return: List of the newest message items, oldest first
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_bucket(self, key):
+        """
+        :param key: Bucket key
+        :return: (tokens, updated) number strings, or None for a bucket that does not exist
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put_bucket(self, key, tokens, updated, previous=None, expires=None):
+        """
+        Write a bucket unless it changed since it was read
+
+        :param key: Bucket key
+        :param tokens: Number string
+        :param updated: Number string
+        :param previous: (tokens, updated) the bucket was read with, None for a new bucket
+        :param expires: Optional epoch seconds after which the bucket may be removed
+        :return: True when the bucket was written
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_presence(self, key, username, change, now):
+        """
+        Add a net join or leave of a user to a presence window, opening the window when there is none
+
+        :param key: Window key
+        :param username: Chat username
+        :param change: 1 for a join, -1 for a leave
+        :param now: Epoch seconds
+        :return: (epoch seconds the window was opened, True when this call opened it)
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reopen_presence(self, key, opened, now):
+        """
+        Move the opening time of a presence window unless it changed since it was read
+
+        :param key: Window key
+        :param opened: Epoch seconds the window was read with
+        :param now: New opening time in epoch seconds
+        :return: True when the window was moved
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def take_presence(self, key):
+        """
+        Read and remove a presence window in one step
+
+        :param key: Window key
+        :return: Dict of net changes keyed by username, empty when there was no window
+        """
+        raise NotImplementedError
+
+
+def of(client):
+    """
+    Storage backend of a client passed to a function. Backends are used as they are, any other client is a DynamoDB
+    client.
+
+    :param client: Storage or DDB client
+    :return: Storage
+    """
+    if isinstance(client, Storage):
+        return client
+
+    from chat_common.storage.dynamodb import DynamoDBStorage
+
+    return DynamoDBStorage(client)
@@ -0,0 +1,303 @@
+import os
+import time
+
+from chat_common.storage import Storage
+
+WRITE_BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.05
+ROOM_INDEX = 'room-index'
+HISTORY_INDEX = 'history-index'
+# Attributes the functions read from a connection item, everything else is left in the table
+CONNECTION_ATTRIBUTES = ('connectionId', 'username', 'room', 'encoding', 'connectedAt', 'expires')
+# Prefix of the per-user attributes of a presence window, keeps usernames apart from the window's own attributes
+USER_PREFIX = 'user:'
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def projection(**names):
+    """
+    ProjectionExpression arguments that read only CONNECTION_ATTRIBUTES
+
+    :param names: Extra expression attribute names used by the rest of the request
+    :return: Dict of request arguments
+    """
+    names.update({f"#{attribute}": attribute for attribute in CONNECTION_ATTRIBUTES})
+    return {
+        'ProjectionExpression': ', '.join(f"#{attribute}" for attribute in CONNECTION_ATTRIBUTES),
+        'ExpressionAttributeNames': names
+    }
+
+
+class DynamoDBStorage(Storage):
+    """
+    Storage in the DynamoDB tables of template.yaml. Counters, sequences, rate limit buckets and presence windows share
+    the message counter table. Removed connections are taken off the live counts by the on_expire function, which
+    reads every delete from the connections table's stream.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: DDB client
+        """
+        self.client = client
+
+    @staticmethod
+    def connection_table():
+        return os.environ.get('CONNECTION_TABLE_NAME')
+
+    @staticmethod
+    def message_table():
+        return os.environ.get('MESSAGE_TABLE_NAME')
+
+    @staticmethod
+    def counter_table():
+        return os.environ.get('MSG_COUNTER_TABLE_NAME')
+
+    def put_connection(self, item):
+        self.client.put_item(TableName=self.connection_table(), Item=item)
+
+    def delete_connection(self, connection_id):
+        response = self.client.delete_item(
+            TableName=self.connection_table(),
+            Key={'connectionId': {'S': connection_id}},
+            ReturnValues='ALL_OLD'
+        )
+        return response.get('Attributes') or None
+
+    def delete_connections(self, connection_ids):
+        """
+        BatchWriteItem in chunks of WRITE_BATCH_SIZE, retrying unprocessed items with exponential backoff
+        """
+        unremoved = []
+        for chunk in chunks(list(connection_ids), WRITE_BATCH_SIZE):
+            requests = {self.connection_table(): [
+                {'DeleteRequest': {'Key': {'connectionId': {'S': connection_id}}}} for connection_id in chunk
+            ]}
+            for attempt in range(MAX_ATTEMPTS):
+                response = self.client.batch_write_item(RequestItems=requests)
+                requests = response.get('UnprocessedItems') or {}
+                if not requests:
+                    break
+                time.sleep(BACKOFF_BASE * (2 ** attempt))
+
+            for request in requests.get(self.connection_table(), []):
+                unremoved.append(request['DeleteRequest']['Key']['connectionId']['S'])
+        return unremoved
+
+    def get_connections(self, connection_ids):
+        """
+        BatchGetItem in chunks of GET_BATCH_SIZE, retrying unprocessed keys with exponential backoff
+        """
+        items = []
+        for chunk in chunks(list(connection_ids), GET_BATCH_SIZE):
+            keys = {self.connection_table(): dict(
+                Keys=[{'connectionId': {'S': connection_id}} for connection_id in chunk], **projection())}
+            for attempt in range(MAX_ATTEMPTS):
+                response = self.client.batch_get_item(RequestItems=keys)
+                items.extend(response['Responses'].get(self.connection_table(), []))
+                keys = response.get('UnprocessedKeys')
+                if not keys:
+                    break
+                time.sleep(BACKOFF_BASE * (2 ** attempt))
+            else:
+                raise RuntimeError(f"{len(chunk)} connections could not be read after {MAX_ATTEMPTS} attempts")
+        return items
+
+    def room_connections(self, room):
+        items = []
+        paginator = self.client.get_paginator('query')
+        for page in paginator.paginate(
+            TableName=self.connection_table(),
+            IndexName=ROOM_INDEX,
+            KeyConditionExpression="#room = :room",
+            ExpressionAttributeValues={':room': {'S': room}},
+            **projection()
+        ):
+            items.extend(page['Items'])
+        return items
+
+    def all_connections(self):
+        items = []
+        paginator = self.client.get_paginator('scan')
+        for page in paginator.paginate(TableName=self.connection_table(), **projection()):
+            items.extend(page['Items'])
+        return items
+
+    def scan_connections(self, segment, segments):
+        items = []
+        paginator = self.client.get_paginator('scan')
+        for page in paginator.paginate(TableName=self.connection_table(), Segment=segment, TotalSegments=segments,
+                                       **projection()):
+            items.extend(page['Items'])
+        return items
+
+    def add_counter(self, key, delta):
+        self.client.update_item(
+            TableName=self.counter_table(),
+            Key={'myid': {'S': key}},
+            UpdateExpression="ADD #count :delta",
+            ExpressionAttributeNames={'#count': 'count'},
+            ExpressionAttributeValues={':delta': {'N': str(delta)}}
+        )
+
+    def get_counters(self, keys):
+        """
+        A single BatchGetItem for all keys, the counter table holds at most a few shards per counter. Unprocessed keys
+        are retried with exponential backoff.
+        """
+        request = {self.counter_table(): {
+            'Keys': [{'myid': {'S': key}} for key in keys],
+            'ProjectionExpression': '#myid, #count',
+            'ExpressionAttributeNames': {'#myid': 'myid', '#count': 'count'},
+        }}
+        counts = {}
+        for attempt in range(MAX_ATTEMPTS):
+            response = self.client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(self.counter_table(), []):
+                if 'count' in item:
+                    counts[item['myid']['S']] = int(item['count']['N'])
+            request = response.get('UnprocessedKeys')
+            if not request:
+                return counts
+            time.sleep(BACKOFF_BASE * (2 ** attempt))
+        unread = len(request[self.counter_table()]['Keys'])
+        raise RuntimeError(f"{unread} counters could not be read after {MAX_ATTEMPTS} attempts")
+
+    def next_sequence(self, key, count=1):
+        response = self.client.update_item(
+            TableName=self.counter_table(),
+            Key={'myid': {'S': key}},
+            UpdateExpression="ADD #seq :increment",
+            ExpressionAttributeNames={'#seq': 'seq'},
+            ExpressionAttributeValues={':increment': {'N': str(count)}},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['seq']['N'])
+
+    def put_message(self, item):
+        try:
+            self.client.put_item(
+                TableName=self.message_table(),
+                Item=item,
+                ConditionExpression="attribute_not_exists(#seq) OR #seq < :seq",
+                ExpressionAttributeNames={'#seq': 'seq'},
+                ExpressionAttributeValues={':seq': item['seq']}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def latest_messages(self, room, limit, since=None):
+        """
+        Query the history index newest first. A single Query covers the default history, larger histories are read
+        page by page until limit messages were found.
+        """
+        key_condition = "#room = :room"
+        names = {'#room': 'room'}
+        values = {':room': {'S': room}}
+        if since is not None:
+            key_condition += " AND #seq > :since"
+            names['#seq'] = 'seq'
+            values[':since'] = {'N': str(since)}
+
+        items = []
+        page = {}
+        while len(items) < limit:
+            response = self.client.query(
+                TableName=self.message_table(),
+                IndexName=HISTORY_INDEX,
+                KeyConditionExpression=key_condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ScanIndexForward=False,
+                Limit=limit - len(items),
+                **page
+            )
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            page = {'ExclusiveStartKey': response['LastEvaluatedKey']}
+        return list(reversed(items))
+
+    def get_bucket(self, key):
+        response = self.client.get_item(
+            TableName=self.counter_table(),
+            Key={'myid': {'S': key}},
+            ProjectionExpression='#tokens, #updated',
+            ExpressionAttributeNames={'#tokens': 'tokens', '#updated': 'updated'},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if not item:
+            return None
+        return item['tokens']['N'], item['updated']['N']
+
+    def put_bucket(self, key, tokens, updated, previous=None, expires=None):
+        update = "SET #tokens = :tokens, #updated = :updated"
+        names = {'#tokens': 'tokens', '#updated': 'updated'}
+        values = {':tokens': {'N': tokens}, ':updated': {'N': updated}}
+        if expires is not None:
+            update += ", #expires = :expires"
+            names['#expires'] = 'expires'
+            values[':expires'] = {'N': str(int(expires))}
+        if previous is None:
+            condition = "attribute_not_exists(#updated)"
+        else:
+            condition = "#updated = :previous_updated AND #tokens = :previous_tokens"
+            values[':previous_tokens'] = {'N': previous[0]}
+            values[':previous_updated'] = {'N': previous[1]}
+        try:
+            self.client.update_item(
+                TableName=self.counter_table(),
+                Key={'myid': {'S': key}},
+                UpdateExpression=update,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def add_presence(self, key, username, change, now):
+        response = self.client.update_item(
+            TableName=self.counter_table(),
+            Key={'myid': {'S': key}},
+            UpdateExpression="SET #opened = if_not_exists(#opened, :now) ADD #user :change",
+            ExpressionAttributeNames={'#opened': 'opened', '#user': f"{USER_PREFIX}{username}"},
+            ExpressionAttributeValues={':now': {'N': str(int(now))}, ':change': {'N': str(change)}},
+            ReturnValues='ALL_OLD'
+        )
+        previous = response.get('Attributes', {}).get('opened')
+        if previous is None:
+            return int(now), True
+        return int(previous['N']), False
+
+    def reopen_presence(self, key, opened, now):
+        try:
+            self.client.update_item(
+                TableName=self.counter_table(),
+                Key={'myid': {'S': key}},
+                UpdateExpression="SET #opened = :now",
+                ConditionExpression="#opened = :opened",
+                ExpressionAttributeNames={'#opened': 'opened'},
+                ExpressionAttributeValues={':now': {'N': str(int(now))}, ':opened': {'N': str(int(opened))}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def take_presence(self, key):
+        response = self.client.delete_item(
+            TableName=self.counter_table(),
+            Key={'myid': {'S': key}},
+            ReturnValues='ALL_OLD'
+        )
+        return {name[len(USER_PREFIX):]: int(value['N'])
+                for name, value in (response.get('Attributes') or {}).items() if name.startswith(USER_PREFIX)}
@@ -0,0 +1,281 @@
+import contextlib
+import json
+import sqlite3
+import threading
+
+from chat_common.storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS connections (
+    connection_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    room TEXT NOT NULL,
+    encoding TEXT,
+    connected_at INTEGER,
+    expires INTEGER
+);
+CREATE INDEX IF NOT EXISTS connections_room ON connections (room);
+-- Takes removed connections off the live count of their room, like the stream consumer of the DynamoDB backend. The
+-- key is shard 0 of the sharded counter connections.live_count, which every shard count includes.
+CREATE TRIGGER IF NOT EXISTS connections_removed AFTER DELETE ON connections BEGIN
+    INSERT INTO counters (key, value) VALUES ('connections:' || old.room || '#0', -1)
+    ON CONFLICT (key) DO UPDATE SET value = value + excluded.value;
+END;
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    slot TEXT PRIMARY KEY,
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    sender TEXT,
+    body TEXT NOT NULL,
+    expires INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_history ON messages (room, seq);
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    expires INTEGER
+);
+CREATE INDEX IF NOT EXISTS buckets_expires ON buckets (expires);
+CREATE TABLE IF NOT EXISTS presence_windows (
+    key TEXT PRIMARY KEY,
+    opened INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS presence_changes (
+    key TEXT NOT NULL,
+    username TEXT NOT NULL,
+    change INTEGER NOT NULL,
+    PRIMARY KEY (key, username)
+);
+"""
+# Columns added after a table was first created, (table, column, type), added to databases that predate them
+ADDED_COLUMNS = (
+    ('connections', 'connected_at', 'INTEGER'),
+)
+
+# Statements are constant and take their values as parameters, so sqlite3 prepares each of them once per database
+# connection and reuses it from its statement cache. Lists of keys are passed as one JSON array parameter.
+SELECT_CONNECTIONS = "SELECT connection_id, username, room, encoding, connected_at, expires FROM connections"
+SELECT_CONNECTIONS_BY_ID = SELECT_CONNECTIONS + " WHERE connection_id IN (SELECT value FROM json_each(?))"
+SELECT_CONNECTIONS_BY_ROOM = SELECT_CONNECTIONS + " WHERE room = ?"
+SELECT_CONNECTION = SELECT_CONNECTIONS + " WHERE connection_id = ?"
+SELECT_CONNECTIONS_BY_SEGMENT = SELECT_CONNECTIONS + " WHERE rowid % ? = ?"
+INSERT_CONNECTION = """
+INSERT OR REPLACE INTO connections (connection_id, username, room, encoding, connected_at, expires)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+DELETE_CONNECTION = "DELETE FROM connections WHERE connection_id = ?"
+DELETE_CONNECTIONS = "DELETE FROM connections WHERE connection_id IN (SELECT value FROM json_each(?))"
+ADD_COUNTER = """
+INSERT INTO counters (key, value) VALUES (?, ?)
+ON CONFLICT (key) DO UPDATE SET value = value + excluded.value
+"""
+SELECT_COUNTER = "SELECT value FROM counters WHERE key = ?"
+SELECT_COUNTERS = "SELECT key, value FROM counters WHERE key IN (SELECT value FROM json_each(?))"
+PUT_MESSAGE = """
+INSERT INTO messages (slot, room, seq, timestamp, sender, body, expires) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (slot) DO UPDATE SET
+    room = excluded.room, seq = excluded.seq, timestamp = excluded.timestamp, sender = excluded.sender,
+    body = excluded.body, expires = excluded.expires
+WHERE messages.seq < excluded.seq
+"""
+SELECT_MESSAGES = """
+SELECT slot, room, seq, timestamp, sender, body, expires FROM messages
+WHERE room = ? AND seq > ?
+ORDER BY seq DESC LIMIT ?
+"""
+SELECT_BUCKET = "SELECT tokens, updated FROM buckets WHERE key = ?"
+INSERT_BUCKET = """
+INSERT INTO buckets (key, tokens, updated, expires) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO NOTHING
+"""
+UPDATE_BUCKET = "UPDATE buckets SET tokens = ?, updated = ?, expires = ? WHERE key = ? AND tokens = ? AND updated = ?"
+DELETE_EXPIRED_BUCKETS = "DELETE FROM buckets WHERE expires <= ?"
+OPEN_PRESENCE = "INSERT INTO presence_windows (key, opened) VALUES (?, ?) ON CONFLICT (key) DO NOTHING"
+ADD_PRESENCE = """
+INSERT INTO presence_changes (key, username, change) VALUES (?, ?, ?)
+ON CONFLICT (key, username) DO UPDATE SET change = change + excluded.change
+"""
+SELECT_PRESENCE_WINDOW = "SELECT opened FROM presence_windows WHERE key = ?"
+REOPEN_PRESENCE = "UPDATE presence_windows SET opened = ? WHERE key = ? AND opened = ?"
+SELECT_PRESENCE = "SELECT username, change FROM presence_changes WHERE key = ?"
+DELETE_PRESENCE_CHANGES = "DELETE FROM presence_changes WHERE key = ?"
+DELETE_PRESENCE_WINDOW = "DELETE FROM presence_windows WHERE key = ?"
+
+
+def expires(item):
+    return int(item['expires']['N']) if 'expires' in item else None
+
+
+def connection_item(row):
+    connection_id, username, room, encoding, connected_at, expires = row
+    item = {'connectionId': {'S': connection_id}, 'username': {'S': username}, 'room': {'S': room}}
+    if encoding:
+        item['encoding'] = {'S': encoding}
+    if connected_at is not None:
+        item['connectedAt'] = {'N': str(connected_at)}
+    if expires is not None:
+        item['expires'] = {'N': str(expires)}
+    return item
+
+
+def message_item(row):
+    slot, room, seq, timestamp, sender, body, expires = row
+    item = {'myid': {'S': slot}, 'room': {'S': room}, 'seq': {'N': str(seq)}, 'timestamp': {'N': timestamp},
+            'body': {'S': body}}
+    if sender:
+        item['sender'] = {'S': sender}
+    if expires is not None:
+        item['expires'] = {'N': str(expires)}
+    return item
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in an embedded SQLite database for single-node deployments such as server.py. The database runs in WAL
+    mode, so readers never wait for the writer, and every table is read through its primary key or an index.
+    Operations that read before they write run in one transaction where the DynamoDB backend uses conditional writes.
+    """
+
+    def __init__(self, path=':memory:', timeout=5.0):
+        """
+        :param path: Database file, shared by every process that opens it
+        :param timeout: Seconds to wait for a write lock held by another process
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """
+        Add the ADDED_COLUMNS a database file created by an older version does not have yet
+        """
+        for table, column, column_type in ADDED_COLUMNS:
+            columns = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def read(self, sql, *parameters):
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Write transaction, other processes on the same database wait for it instead of failing halfway
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def write(self, *statements):
+        """
+        Run statements in one write transaction
+
+        :param statements: (sql, parameters) tuples
+        :return: List of the number of rows each statement changed
+        """
+        with self.transaction() as db:
+            return [db.execute(sql, parameters).rowcount for sql, parameters in statements]
+
+    def close(self):
+        self.db.close()
+
+    def put_connection(self, item):
+        connected_at = int(item['connectedAt']['N']) if 'connectedAt' in item else None
+        self.write((INSERT_CONNECTION, (item['connectionId']['S'], item['username']['S'], item['room']['S'],
+                                        item['encoding']['S'] if 'encoding' in item else None, connected_at,
+                                        expires(item))))
+
+    def delete_connection(self, connection_id):
+        with self.transaction() as db:
+            rows = db.execute(SELECT_CONNECTION, (connection_id,)).fetchall()
+            db.execute(DELETE_CONNECTION, (connection_id,))
+        return connection_item(rows[0]) if rows else None
+
+    def delete_connections(self, connection_ids):
+        self.write((DELETE_CONNECTIONS, (json.dumps(list(connection_ids)),)))
+        return []
+
+    def get_connections(self, connection_ids):
+        rows = self.read(SELECT_CONNECTIONS_BY_ID, json.dumps(list(connection_ids)))
+        return [connection_item(row) for row in rows]
+
+    def room_connections(self, room):
+        return [connection_item(row) for row in self.read(SELECT_CONNECTIONS_BY_ROOM, room)]
+
+    def all_connections(self):
+        return [connection_item(row) for row in self.read(SELECT_CONNECTIONS)]
+
+    def scan_connections(self, segment, segments):
+        return [connection_item(row) for row in self.read(SELECT_CONNECTIONS_BY_SEGMENT, segments, segment)]
+
+    def add_counter(self, key, delta):
+        self.write((ADD_COUNTER, (key, delta)))
+
+    def get_counters(self, keys):
+        return dict(self.read(SELECT_COUNTERS, json.dumps(list(keys))))
+
+    def next_sequence(self, key, count=1):
+        with self.transaction() as db:
+            db.execute(ADD_COUNTER, (key, count))
+            [(value,)] = db.execute(SELECT_COUNTER, (key,)).fetchall()
+        return value
+
+    def put_message(self, item):
+        [changed] = self.write((PUT_MESSAGE, (
+            item['myid']['S'], item['room']['S'], int(item['seq']['N']), item['timestamp']['N'],
+            item['sender']['S'] if 'sender' in item else None, item['body']['S'], expires(item)
+        )))
+        return changed == 1
+
+    def latest_messages(self, room, limit, since=None):
+        # Sequence numbers start at 1, so no cursor reads the whole ring buffer
+        rows = self.read(SELECT_MESSAGES, room, since or 0, limit)
+        return [message_item(row) for row in reversed(rows)]
+
+    def get_bucket(self, key):
+        rows = self.read(SELECT_BUCKET, key)
+        return tuple(rows[0]) if rows else None
+
+    def put_bucket(self, key, tokens, updated, previous=None, expires=None):
+        """
+        SQLite has no TTL, buckets that have expired are deleted by the writes of other buckets
+        """
+        if previous is None:
+            statement = (INSERT_BUCKET, (key, tokens, updated, expires))
+        else:
+            statement = (UPDATE_BUCKET, (tokens, updated, expires, key, previous[0], previous[1]))
+        [changed, _] = self.write(statement, (DELETE_EXPIRED_BUCKETS, (int(float(updated)),)))
+        return changed == 1
+
+    def add_presence(self, key, username, change, now):
+        with self.transaction() as db:
+            created = db.execute(OPEN_PRESENCE, (key, int(now))).rowcount == 1
+            db.execute(ADD_PRESENCE, (key, username, change))
+            [(opened,)] = db.execute(SELECT_PRESENCE_WINDOW, (key,)).fetchall()
+        return opened, created
+
+    def reopen_presence(self, key, opened, now):
+        [changed] = self.write((REOPEN_PRESENCE, (int(now), key, int(opened))))
+        return changed == 1
+
+    def take_presence(self, key):
+        with self.transaction() as db:
+            rows = db.execute(SELECT_PRESENCE, (key,)).fetchall()
+            db.execute(DELETE_PRESENCE_CHANGES, (key,))
+            db.execute(DELETE_PRESENCE_WINDOW, (key,))
+        return dict(rows)
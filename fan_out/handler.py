@@ -0,0 +1,89 @@
+import json
+import time
+
+from chat_common import connections, fanout, metrics, presence, rooms, runtime
+
+
+def report(batch, result, elapsed):
+    """
+    Print the metrics of one fan-out batch as a JSON log line
+
+    :param batch: Batch index
+    :param result: BroadcastResult of the batch
+    :param elapsed: Seconds spent on the batch, including the purge of stale connections
+    :return: Dict of metrics
+    """
+    line = {'metric': 'fanout_batch', 'batch': batch, 'size': len(result.statuses),
+            'elapsedMs': round(elapsed * 1000, 3)}
+    line.update(result.summary())
+    print(json.dumps(line))
+    return line
+
+
+def broadcast_record(record, dynamodb, apigatewaymanagementapi=None):
+    """
+    Broadcast one queued message, or the update of one presence window, to its room
+
+    :param record: SQS record
+    :param dynamodb: DDB client or storage backend
+    :param apigatewaymanagementapi: Optional apigatewaymanagemntapi client, defaults to the container's cached client
+    :return: List of per-batch metrics
+    """
+    message = json.loads(record['body'])
+    room = message.get('room', rooms.DEFAULT_ROOM)
+    if message.get('presence'):
+        with metrics.phase('presence'):
+            data = presence.flush(dynamodb, room)
+        if data is None:
+            # Every join of the window was cancelled by a leave of the same user or the other way round
+            return []
+    else:
+        data = fanout.payload(message)
+    client = apigatewaymanagementapi or \
+        runtime.client('apigatewaymanagementapi', endpoint_url=message['endpointUrl'])
+
+    # Retrieve the connection_ids of the room from the connection registry
+    with metrics.phase('connections'):
+        connection_ids = connections.get_connections(dynamodb, room)
+    batch_metrics = []
+    for batch, batch_connection_ids in enumerate(fanout.batches(connection_ids)):
+        started = time.monotonic()
+        with metrics.phase('broadcast'):
+            result = connections.send_to_all(dynamodb, client, batch_connection_ids, data)
+        batch_metrics.append(report(batch, result, time.monotonic() - started))
+    return batch_metrics
+
+
+@metrics.instrumented('fan_out')
+def handle(event, context, dynamodb=None, apigatewaymanagementapi=None):
+    """
+    Method that handle queued broadcasts from the sendmessage action. Each message is sent to all alive clients of
+    its room in batches of FANOUT_BATCH_SIZE connections. Presence flushes close the presence window of their room and
+    broadcast one update for all the joins and leaves of the window.
+    A record that fails is reported back to SQS together with every record after it, so only those are delivered
+    again and the messages of a room are never broadcast out of order.
+
+    :param event: SQS event with one record per queued message.
+    :param context: A context object is passed to your function by Lambda at runtime.
+    This object provides methods and properties that provide information about the invocation,
+    function, and runtime environment.
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param apigatewaymanagementapi: Optional apigatewaymanagemntapi client, defaults to the container's cached client
+    :return: {'batches': list of per-batch metrics, 'batchItemFailures': records SQS delivers again}
+    """
+    dynamodb = dynamodb or runtime.dynamodb()
+    batch_metrics = []
+    failures = []
+    for record in event['Records']:
+        if failures:
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+        try:
+            batch_metrics.extend(broadcast_record(record, dynamodb, apigatewaymanagementapi))
+        except Exception as e:
+            print(e)
+            failures.append({'itemIdentifier': record['messageId']})
+    if failures:
+        metrics.count('failedRecords', len(failures))
+
+    return {'batches': batch_metrics, 'batchItemFailures': failures}
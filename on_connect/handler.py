@@ -1,25 +1,31 @@
-import boto3
-import os
+from chat_common import connections, envelope, metrics, rooms, runtime
 
 
-def handle(event, context):
+@metrics.instrumented('on_connect')
+def handle(event, context, dynamodb=None):
     """
-    Method that handle on_connect event, it will store connection_id and username into DDB
+    Method that handle on_connect event, it will store connection_id, username, room and frame encoding into DDB
 
     :param event: JSON-formatted document that contains data for a Lambda function to process.
     :param context: A context object is passed to your function by Lambda at runtime.
     This object provides methods and properties that provide information about the invocation,
     function, and runtime environment.
-    :return: {}
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :return: {} or a 400 response when the room name or encoding is invalid
     """
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = dynamodb or runtime.dynamodb()
     username = event['queryStringParameters']['username']
     connection_id = event['requestContext']['connectionId']
 
+    try:
+        room = rooms.validate(event['queryStringParameters'].get('room'))
+        encoding = envelope.validate(event['queryStringParameters'].get('encoding'))
+    except ValueError as e:
+        print(e)
+        return {'statusCode': 400, 'body': str(e)}
+
     # Insert the connectionId of the connected device to the database
-    dynamodb.put_item(
-        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-        Item={'connectionId': {'S': connection_id}, 'username': {'S': username}}
-    )
+    with metrics.phase('register'):
+        connections.register(dynamodb, connection_id, username, room, encoding)
 
     return {}
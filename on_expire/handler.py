@@ -0,0 +1,40 @@
+from chat_common import connections, metrics, runtime
+
+# Principal of the deletes made by DynamoDB TTL in the records of a table stream
+TTL_PRINCIPAL = 'dynamodb.amazonaws.com'
+
+
+def removed(event):
+    """
+    Connection items deleted by the functions or by the table's TTL
+
+    :param event: DynamoDB stream event
+    :return: List of (connection item, True when the TTL reaped it)
+    """
+    return [(record['dynamodb']['OldImage'], record.get('userIdentity', {}).get('principalId') == TTL_PRINCIPAL)
+            for record in event['Records'] if record['eventName'] == 'REMOVE']
+
+
+@metrics.instrumented('on_expire')
+def handle(event, context, dynamodb=None):
+    """
+    Method that handle the stream of the connections table. Every removed connection is taken off the live count of
+    its room here, once per delete that found the item, so the functions can remove connections in batches and a
+    connection removed twice is still counted once. Connections reaped by the table's TTL never got a $disconnect and
+    are counted here as well.
+
+    :param event: DynamoDB stream event.
+    :param context: A context object is passed to your function by Lambda at runtime.
+    This object provides methods and properties that provide information about the invocation,
+    function, and runtime environment.
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :return: Dict with the number of removed connections and how many of them the TTL reaped
+    """
+    records = removed(event)
+    if records:
+        with metrics.phase('counter'):
+            connections.uncount(dynamodb or runtime.dynamodb(), [item for item, _ in records])
+    reaped = sum(1 for _, ttl in records if ttl)
+    metrics.count('removed', len(records))
+    metrics.count('reaped', reaped)
+    return {'removed': len(records), 'reaped': reaped}
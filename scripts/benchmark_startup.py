@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS = ('on_connect', 'on_disconnect', 'send_message', 'send_notify', 'fan_out', 'sweeper', 'on_expire')
+
+# Startup budget in milliseconds per function, covering handler import plus first client creation
+BUDGETS = {
+    'on_connect': 800,
+    'on_disconnect': 800,
+    'send_message': 800,
+    'send_notify': 800,
+    'fan_out': 800,
+    'sweeper': 800,
+    'on_expire': 800,
+}
+
+INIT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import handler
+imported = time.perf_counter()
+from chat_common import runtime
+runtime.dynamodb()
+initialised = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'init_ms': (initialised - started) * 1000}))
+"""
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr of `python -X importtime` into a list of imported modules
+
+    :param output: String output of -X importtime
+    :return: List of (module, self_us, cumulative_us, depth) tuples in import order
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def run(function, env):
+    """
+    Import a handler module in a fresh interpreter and measure import and init time
+
+    :param function: Function directory name
+    :param env: Environment for the child interpreter
+    :return: Dict report for the function
+    """
+    cwd = os.path.join(ROOT, function)
+    importtime = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import handler'],
+        cwd=cwd, env=env, capture_output=True, text=True, check=True
+    )
+    modules = parse_importtime(importtime.stderr)
+    end = max(i for i, m in enumerate(modules) if m[0] == 'handler' and m[3] == 0)
+    start = max([i + 1 for i, m in enumerate(modules[:end]) if m[3] == 0] or [0])
+    children = [m for m in modules[start:end] if m[3] == 1]
+
+    init = subprocess.run([sys.executable, '-c', INIT_SCRIPT], cwd=cwd, env=env, capture_output=True, text=True,
+                          check=True)
+    report = json.loads(init.stdout)
+    report['function'] = function
+    report['handler_importtime_ms'] = modules[end][2] / 1000
+    report['heaviest'] = [(name, cumulative / 1000) for name, _, cumulative, _ in
+                          sorted(children, key=lambda m: m[2], reverse=True)[:5]]
+    report['budget_ms'] = BUDGETS[function]
+    return report
+
+
+@click.command()
+@click.option("--json-output", is_flag=True, help="Print the report as JSON")
+@click.option("--check", is_flag=True, help="Exit with an error when a function exceeds its startup budget")
+def main(json_output, check):
+    """
+    Measure import and init time of every handler module.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(ROOT, 'common'), env.get('PYTHONPATH', '')])
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    reports = [run(function, env) for function in FUNCTIONS]
+
+    if json_output:
+        click.echo(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            click.echo(f"{report['function']}: import {report['import_ms']:.1f} ms "
+                       f"(-X importtime {report['handler_importtime_ms']:.1f} ms), "
+                       f"init {report['init_ms']:.1f} ms (budget {report['budget_ms']} ms)")
+            for name, cumulative in report['heaviest']:
+                click.echo(f"    {name}: {cumulative:.1f} ms")
+
+    over_budget = [r['function'] for r in reports if r['init_ms'] > r['budget_ms']]
+    if check and over_budget:
+        raise click.ClickException(f"Startup budget exceeded by {', '.join(over_budget)}")
+
+
+if __name__ == '__main__':
+    main()
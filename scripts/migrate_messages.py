@@ -0,0 +1,138 @@
+import boto3
+import click
+
+from chat_common import counters, history, rooms
+
+
+def read_messages(dynamodb, table_name):
+    """
+    Read every message from a messages table, oldest first. Legacy tables keyed by (myid, timestamp) have no sequence
+    number, so they are ordered by their numeric timestamp.
+
+    :param dynamodb: DDB client
+    :param table_name: Source table name
+    :return: List of message items
+    """
+    messages = []
+    paginator = dynamodb.get_paginator('scan')
+    for page in paginator.paginate(TableName=table_name):
+        messages.extend(page['Items'])
+
+    messages.sort(key=lambda m: (float(m['seq']['N']) if 'seq' in m else 0, float(m['timestamp']['N'])))
+    return messages
+
+
+def upgrade_ring(dynamodb, table_name, counter_table):
+    """
+    Move ring buffer items written before rooms existed ('slot#<n>' keys and a single 'sequence' counter) into the
+    ring buffer of the default room
+
+    :param dynamodb: DDB client
+    :param table_name: Messages table name
+    :param counter_table: Message counter table name holding the sequence item
+    :return: Number of moved items
+    """
+    moved = 0
+    for message in read_messages(dynamodb, table_name):
+        if not message['myid']['S'].startswith('slot#'):
+            continue
+        item = dict(message)
+        item['myid'] = {'S': f"{rooms.DEFAULT_ROOM}#{message['myid']['S']}"}
+        item['room'] = {'S': rooms.DEFAULT_ROOM}
+        dynamodb.put_item(TableName=table_name, Item=item)
+        dynamodb.delete_item(TableName=table_name, Key={'myid': message['myid']})
+        moved += 1
+
+    response = dynamodb.delete_item(
+        TableName=counter_table,
+        Key={'myid': {'S': 'sequence'}},
+        ReturnValues='ALL_OLD'
+    )
+    if response.get('Attributes'):
+        dynamodb.put_item(
+            TableName=counter_table,
+            Item={'myid': {'S': history.sequence_key(rooms.DEFAULT_ROOM)}, 'seq': response['Attributes']['seq']}
+        )
+    return moved
+
+
+def migrate(dynamodb, source_table, target_table, counter_table, size):
+    """
+    Copy the most recent messages of a legacy table into the ring buffer of the default room of a new table
+
+    :param dynamodb: DDB client
+    :param source_table: Legacy messages table name
+    :param target_table: New messages table name
+    :param counter_table: Message counter table name holding the sequence item
+    :param size: Ring buffer size
+    :return: Number of migrated messages
+    """
+    messages = read_messages(dynamodb, source_table)[-size:]
+    for seq, message in enumerate(messages, start=1):
+        dynamodb.put_item(
+            TableName=target_table,
+            Item={
+                'myid': {'S': history.slot_key(seq, size, rooms.DEFAULT_ROOM)},
+                'room': {'S': rooms.DEFAULT_ROOM},
+                'seq': {'N': str(seq)},
+                'timestamp': message['timestamp'],
+                'data': message['data']
+            }
+        )
+
+    dynamodb.put_item(
+        TableName=counter_table,
+        Item={'myid': {'S': history.sequence_key(rooms.DEFAULT_ROOM)}, 'seq': {'N': str(len(messages))}},
+    )
+    return len(messages)
+
+
+def migrate_message_count(dynamodb, counter_table):
+    """
+    Move the legacy single-item message counter into the first shard of the sharded message counter
+
+    :param dynamodb: DDB client
+    :param counter_table: Message counter table name
+    :return: Number of messages moved
+    """
+    response = dynamodb.delete_item(
+        TableName=counter_table,
+        Key={'myid': {'S': 'counter'}},
+        ReturnValues='ALL_OLD'
+    )
+    legacy = int(response.get('Attributes', {}).get('msgCount', {}).get('N', '0'))
+    if legacy:
+        dynamodb.update_item(
+            TableName=counter_table,
+            Key={'myid': {'S': counters.shard_keys(counters.MESSAGE_COUNT)[0]}},
+            UpdateExpression="ADD #count :delta",
+            ExpressionAttributeNames={'#count': 'count'},
+            ExpressionAttributeValues={':delta': {'N': str(legacy)}}
+        )
+    return legacy
+
+
+@click.command()
+@click.option("--source-table", required=True, help="Existing messages table")
+@click.option("--target-table", required=True, help="Messages table created by the current template")
+@click.option("--counter-table", required=True, help="Message counter table")
+@click.option("--history-size", default=20, help="MessageHistorySize the stack is deployed with")
+def main(source_table, target_table, counter_table, history_size):
+    """
+    Migrate chat history into the ring buffer and history index layout. When source and target are the same table the
+    items are already ring buffer slots and are moved into the ring buffer of the default room. The legacy message
+    counter is moved into the sharded message counter.
+    """
+    dynamodb = boto3.client('dynamodb')
+    moved = migrate_message_count(dynamodb, counter_table)
+    click.echo(f"Moved {moved} messages into the sharded message counter")
+    if source_table == target_table:
+        count = upgrade_ring(dynamodb, target_table, counter_table)
+        click.echo(f"Moved {count} messages into the default room")
+    else:
+        count = migrate(dynamodb, source_table, target_table, counter_table, history_size)
+        click.echo(f"Migrated {count} messages from {source_table} to {target_table}")
+
+
+if __name__ == '__main__':
+    main()
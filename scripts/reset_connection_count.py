@@ -0,0 +1,56 @@
+import os
+
+import boto3
+import click
+
+from chat_common import connections, counters, rooms
+
+
+def reset_connection_count(dynamodb):
+    """
+    Set the live connection counter of every room to the number of its items in the connections table. Connections
+    stored before rooms existed are moved into the default room so the room index picks them up.
+
+    :param dynamodb: DDB client
+    :return: Dict of room to number of connections
+    """
+    counts = {}
+    for item in connections.scan(dynamodb):
+        room = rooms.of(item)
+        if 'room' not in item:
+            dynamodb.update_item(
+                TableName=connections.table_name(),
+                Key={'connectionId': item['connectionId']},
+                UpdateExpression="SET #room = :room",
+                ExpressionAttributeNames={'#room': 'room'},
+                ExpressionAttributeValues={':room': {'S': room}}
+            )
+        counts[room] = counts.get(room, 0) + 1
+
+    for room, count in counts.items():
+        for shard, key in enumerate(counters.shard_keys(connections.live_count(room))):
+            dynamodb.put_item(
+                TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+                Item={'myid': {'S': key}, 'count': {'N': str(count if shard == 0 else 0)}}
+            )
+    return counts
+
+
+@click.command()
+@click.option("--connection-table", required=True, help="Connections table")
+@click.option("--counter-table", required=True, help="Message counter table")
+@click.option("--shards", default=4, help="COUNTER_SHARDS the stack is deployed with")
+def main(connection_table, counter_table, shards):
+    """
+    Seed the sharded live connection counters from the connections table.
+    """
+    os.environ['CONNECTION_TABLE_NAME'] = connection_table
+    os.environ['MSG_COUNTER_TABLE_NAME'] = counter_table
+    os.environ['COUNTER_SHARDS'] = str(shards)
+    counts = reset_connection_count(boto3.client('dynamodb'))
+    for room, count in counts.items():
+        click.echo(f"Connection count of {room} set to {count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,127 +1,150 @@
-import boto3
 import json
-import os
+import time
 
-from datetime import datetime
-from uuid import uuid1
+from chat_common import connections, counters, envelope, fanout, history, metrics, ratelimit, rooms, runtime
 
+# Messages accepted in one sendmessage batch
+MAX_BATCH = 25
 
-def send_to_all(apigatewaymanagementapi, connection_ids, data):
+
+def send_throttled(apigatewaymanagementapi, connection_id, reply, encoding=envelope.JSON):
     """
-    Send message to all alive connections
+    Tell a sender that its messages were rejected by the rate limiter
 
     :param apigatewaymanagementapi: apigatewaymanagemntapi client
-    :param connection_ids: List of connection ids from DDB
-    :param data: String message
+    :param connection_id: Sender connection id
+    :param reply: Throttle reply dict with scope and retryAfter seconds
+    :param encoding: Frame encoding of the sender
     :return:
     """
-    dynamodb = boto3.client('dynamodb')
-    for connection_id in connection_ids:
-        try:
-            apigatewaymanagementapi.post_to_connection(Data=data, ConnectionId=connection_id['connectionId']['S'])
-        except Exception as e:
-            print(e)
-            # Remove connection id from DDB
-            dynamodb.delete_item(
-                TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-                Key={'connectionId': {'S': connection_id['connectionId']['S']}}
-            )
-
-
-def increment_message():
+    try:
+        apigatewaymanagementapi.post_to_connection(Data=envelope.encode(reply, encoding), ConnectionId=connection_id)
+    except Exception as e:
+        # The sender is gone or throttled itself, either way the messages stay rejected
+        print(e)
+
+
+def increment_message(count=1):
     """
-    Insert message count (1) for first time, otherwise it will increase by 1 everytime user sending a message
+    Increase the sharded message counter. The increment is buffered in the container and written by the flush at the
+    end of the invocation.
 
+    :param count: Number of messages
     :return: None
     """
-    dynamodb = boto3.client('dynamodb')
-    dynamodb.update_item(
-        TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
-        Key={'myid': {'S': 'counter'}},
-        UpdateExpression="ADD #msgCount :increment",
-        ExpressionAttributeNames={'#msgCount': 'msgCount'},
-        ExpressionAttributeValues={':increment': {'N': '1'}}
-    )
+    counters.increment(counters.MESSAGE_COUNT, count)
 
 
-def store_message(data):
+def store_message(data, dynamodb=None, room=rooms.DEFAULT_ROOM, sender=None, timestamp=None):
     """
-    Store users message in DDB for a maximum of 20 messages.
+    Store users message in the DDB ring buffer of the room which keeps the last MESSAGE_HISTORY_SIZE messages.
 
     :param data: User input message
-    :return:
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param room: Room name
+    :param sender: Optional username of the sender
+    :param timestamp: Server time in epoch seconds, defaults to now
+    :return: List with the cursor of the message
+    """
+    return store_messages([data], dynamodb, room, sender, timestamp)
+
+
+def store_messages(messages, dynamodb=None, room=rooms.DEFAULT_ROOM, sender=None, timestamp=None):
+    """
+    Store a batch of users messages in the DDB ring buffer of the room.
+
+    :param messages: List of user input messages, oldest first
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param room: Room name
+    :param sender: Optional username of the sender
+    :param timestamp: Server time in epoch seconds, defaults to now
+    :return: List of cursors, one per message
     """
-    dynamodb = boto3.client('dynamodb')
-    messages = []
-    _messages = []
-    paginator = dynamodb.get_paginator('scan')
-    for page in paginator.paginate(TableName=os.environ.get('MESSAGE_TABLE_NAME')):
-        _messages.extend(page['Items'])
-
-    for message in _messages:
-        m = {
-            message['timestamp']['N']: message['myid']['S']
-        }
-        messages.append(m)
-
-    # sort list of dict by timestamp
-    messages = list(map(dict, sorted(list(i.items()) for i in messages)))
-
-    if len(messages) > 19:
-        k, v = list(messages[0].items())[0]
-        dynamodb.delete_item(
-            TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-            Key={
-                "myid": {"S": v},
-                "timestamp": {"N": k}
-            }
-        )
-
-    dynamodb.put_item(
-        TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-        Item={
-            'myid': {'S': str(uuid1())},
-            'timestamp': {'N': str(datetime.now().timestamp())},
-            'data': {'S': data}
-        }
-    )
-
-    increment_message()
-
-
-def handle(event, context):
+    dynamodb = dynamodb or runtime.dynamodb()
+    sequences = history.store_many(dynamodb, messages, room, sender, timestamp)
+
+    increment_message(len(messages))
+    return sequences
+
+
+def parse_messages(body):
+    """
+    Read the messages of a sendmessage body, either a single "message" or a batch in "messages"
+
+    :param body: JSON string
+    :return: List of message strings
+    """
+    body = json.loads(body)
+    messages = body['messages'] if 'messages' in body else [body['message']]
+    if not isinstance(messages, list) or not messages or not all(isinstance(m, str) for m in messages):
+        raise ValueError('messages must be a non-empty list of strings')
+    if len(messages) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} messages can be sent at once")
+    return messages
+
+
+@metrics.instrumented('send_message')
+def handle(event, context, dynamodb=None, apigatewaymanagementapi=None, sqs=None):
     """
-    Method that handle sendmessage action. It will send message to all alive clients, store the messages in DDB and
-    increment the message counter.
+    Method that handle sendmessage action. It will store the messages in DDB, increment the message counter and send
+    the message to all alive clients of the sender's room. A batch of messages is stored and sent as one broadcast,
+    every message in an envelope with its sender, server timestamp, sequence number and room. When FANOUT_QUEUE_URL
+    is set the message is queued for the fan-out worker instead of being broadcast here, so the sender does not wait
+    for the whole room. Senders over the per-connection or per-room rate limit get a throttle reply and their messages
+    are neither stored nor broadcast.
 
     :param event: JSON-formatted document that contains data for a Lambda function to process.
     :param context: A context object is passed to your function by Lambda at runtime.
     This object provides methods and properties that provide information about the invocation,
     function, and runtime environment.
-    :return: {}
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param apigatewaymanagementapi: Optional apigatewaymanagemntapi client, defaults to the container's cached client
+    :param sqs: Optional SQS client, defaults to the container's cached client
+    :return: {}, a 400 response when the messages are invalid or a 429 response when the sender is throttled
     """
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = dynamodb or runtime.dynamodb()
     connection_id = event['requestContext']['connectionId']
-    response = dynamodb.get_item(
-        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-        Key={'connectionId': {'S': connection_id}}
-    )
-
-    username = response['Item']['username']['S']
-    message = json.loads(event['body'])['message']
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    data = f"[{now} {username}] {message}"
-    store_message(data)
-
-    connection_ids = []
-    paginator = dynamodb.get_paginator('scan')
-
-    # Retrieve all connection_ids from the database
-    for page in paginator.paginate(TableName=os.environ.get('CONNECTION_TABLE_NAME')):
-        connection_ids.extend(page['Items'])
-
-    endpoint_url = f"https://{event['requestContext']['domainName']}/{event['requestContext']['stage']}"
-    apigatewaymanagementapi = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
-    send_to_all(apigatewaymanagementapi, connection_ids, data)
+    with metrics.phase('sender'):
+        sender = connections.get(dynamodb, connection_id)
+
+    username = sender['username']['S']
+    room = rooms.of(sender)
+    try:
+        messages = parse_messages(event['body'])
+    except ValueError as e:
+        print(e)
+        return {'statusCode': 400, 'body': str(e)}
+
+    # Every message costs a token, each one of a batch is a write to the messages table
+    with metrics.phase('ratelimit'):
+        throttled = ratelimit.check(dynamodb, connection_id, room, cost=len(messages))
+    if throttled:
+        metrics.count('rateLimited')
+        apigatewaymanagementapi = apigatewaymanagementapi or runtime.apigatewaymanagementapi(event)
+        send_throttled(apigatewaymanagementapi, connection_id, throttled, envelope.of(sender))
+        return {'statusCode': 429, 'body': json.dumps(throttled)}
+
+    now = time.time()
+    with metrics.phase('store'):
+        cursors = store_messages(messages, dynamodb, room, username, now)
+
+    # A batch goes out as one frame, serialised once per encoding for the whole room
+    data = envelope.messages(envelope.create(seq, room, username, message, now)
+                             for seq, message in zip(cursors, messages))
+    with metrics.phase('counter'):
+        counters.flush(dynamodb)
+
+    if fanout.queue_url():
+        with metrics.phase('enqueue'):
+            fanout.enqueue(sqs or runtime.sqs(), runtime.endpoint_url(event), data, room)
+        return {}
+
+    # Retrieve the connection_ids of the room from the connection registry
+    with metrics.phase('connections'):
+        connection_ids = connections.get_connections(dynamodb, room)
+
+    apigatewaymanagementapi = apigatewaymanagementapi or runtime.apigatewaymanagementapi(event)
+    with metrics.phase('broadcast'):
+        connections.send_to_all(dynamodb, apigatewaymanagementapi, connection_ids, data)
 
     return {}
@@ -1,27 +1,6 @@
-import boto3
-import os
+import json
 
-
-def send_to_all(apigatewaymanagementapi, connection_ids, data):
-    """
-    Send message to all alive connections
-
-    :param apigatewaymanagementapi: apigatewaymanagemntapi client
-    :param connection_ids: List of connection ids from DDB
-    :param data: String message
-    :return:
-    """
-    dynamodb = boto3.client('dynamodb')
-    for connection_id in connection_ids:
-        try:
-            apigatewaymanagementapi.post_to_connection(Data=data, ConnectionId=connection_id['connectionId']['S'])
-        except Exception as e:
-            print(e)
-            # Remove connection id from DDB
-            dynamodb.delete_item(
-                TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-                Key={'connectionId': {'S': connection_id['connectionId']['S']}}
-            )
+from chat_common import connections, counters, envelope, history, metrics, presence, rooms, runtime
 
 
 def send_to_self(apigatewaymanagementapi, connection_id, data):
@@ -39,82 +18,109 @@ def send_to_self(apigatewaymanagementapi, connection_id, data):
     )
 
 
-def get_messages():
+def get_messages(dynamodb=None, room=rooms.DEFAULT_ROOM):
     """
-    Method to get last 20 messages from users.
+    Method to get the last MESSAGE_HISTORY_SIZE messages from users of a room.
 
-    :return: List of messages
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param room: Room name
+    :return: List of messages formatted as text
     """
-    dynamodb = boto3.client('dynamodb')
-    messages = []
-    _messages = []
-    paginator = dynamodb.get_paginator('scan')
-    for page in paginator.paginate(TableName=os.environ.get('MESSAGE_TABLE_NAME')):
-        _messages.extend(page['Items'])
+    dynamodb = dynamodb or runtime.dynamodb()
+    return [envelope.format(envelope.from_item(message)) for message in history.latest(dynamodb, room)]
 
-    if not _messages:
-        return _messages
 
-    for message in _messages:
-        m = {
-            message['timestamp']['N']: message['data']['S']
-        }
-        messages.append(m)
+def get_messages_since(since, dynamodb=None, room=rooms.DEFAULT_ROOM):
+    """
+    Method to get the messages of a room newer than the client's cursor, at most MESSAGE_HISTORY_SIZE.
+
+    :param since: Cursor of the last message the client has seen
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param room: Room name
+    :return: List of message envelopes
+    """
+    dynamodb = dynamodb or runtime.dynamodb()
+    return [envelope.from_item(message) for message in history.latest(dynamodb, room, since=since)]
 
-    # sort list of dict by timestamp
-    messages = list(map(dict, sorted(list(i.items()) for i in messages)))
 
-    _messages = []
-    for message in messages:
-        _, v = list(message.items())[0]
-        _messages.append(v)
+def parse_since(body):
+    """
+    Read the optional since cursor of a sendnotify body
 
-    return _messages
+    :param body: JSON string or None
+    :return: Integer cursor, or None when the client did not send one
+    """
+    since = json.loads(body or '{}').get('since')
+    if since is not None and (isinstance(since, bool) or not isinstance(since, int) or since < 0):
+        raise ValueError('since must be a non-negative integer cursor')
+    return since
 
 
-def handle(event, context):
+@metrics.instrumented('send_notify')
+def handle(event, context, dynamodb=None, apigatewaymanagementapi=None, sqs=None):
     """
-    Method that handle sendnotify action. It will send chat history to client, and send messaage to all alive client
-    to notify that someone has joined the chat room.
+    Method that handle sendnotify action. It will send the chat history of the client's room to the client, and send
+    messaage to all alive clients of the room to notify that someone has joined the chat room. A client that sends a
+    since cursor gets frames with only the messages newer than the cursor. The history is sent in chunks of at most
+    HISTORY_CHUNK_BYTES so a long history never exceeds the post limit of API Gateway. When presence coalescing is enabled
+    the join is added to the room's presence window instead, and the fan-out worker announces the whole window at once.
 
     :param event: JSON-formatted document that contains data for a Lambda function to process.
     :param context: A context object is passed to your function by Lambda at runtime.
     This object provides methods and properties that provide information about the invocation,
     function, and runtime environment.
-    :return: {}
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param apigatewaymanagementapi: Optional apigatewaymanagemntapi client, defaults to the container's cached client
+    :param sqs: Optional SQS client, defaults to the container's cached client
+    :return: {} or a 400 response when the cursor is invalid
     """
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = dynamodb or runtime.dynamodb()
     connection_id = event['requestContext']['connectionId']
-    connection_ids = []
-    paginator = dynamodb.get_paginator('scan')
-
-    # Retrieve all connection_ids from the database
-    for page in paginator.paginate(TableName=os.environ.get('CONNECTION_TABLE_NAME')):
-        connection_ids.extend(page['Items'])
-
-    endpoint_url = f"https://{event['requestContext']['domainName']}/{event['requestContext']['stage']}"
-    apigatewaymanagementapi = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
-
-    msg_counter = dynamodb.get_item(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'), Key={'myid': {'S': 'counter'}})
-    if not msg_counter:
-        msg_counter = 0
-    else:
-        msg_counter = msg_counter['Item']['msgCount']['N']
+    try:
+        since = parse_since(event.get('body'))
+    except ValueError as e:
+        print(e)
+        return {'statusCode': 400, 'body': str(e)}
+    with metrics.phase('sender'):
+        sender = connections.get(dynamodb, connection_id)
+    room = rooms.of(sender)
+
+    # Both counters are read at once, the live count also tells whether the cached room members are current
+    with metrics.phase('counter'):
+        totals = counters.totals(dynamodb, [counters.MESSAGE_COUNT, connections.live_count(room)])
+        msg_counter = totals[counters.MESSAGE_COUNT]
+        user_count = totals[connections.live_count(room)]
+
+    apigatewaymanagementapi = apigatewaymanagementapi or runtime.apigatewaymanagementapi(event)
 
     data = f"Welcome to Simple Chat\n" \
-           f"There are {len(connection_ids)} users connected.\n" \
+           f"There are {user_count} users connected.\n" \
            f"Total of {msg_counter} messages recorded as of today.\n\n"
 
-    messages = get_messages()
-    data = data + '\n'.join(messages)
-    send_to_self(apigatewaymanagementapi, connection_id, data)
-
-    response = dynamodb.get_item(
-        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-        Key={'connectionId': {'S': connection_id}}
-    )
-    data = f"{response['Item']['username']['S']} has joined the chat room"
-    send_to_all(apigatewaymanagementapi, connection_ids, data)
+    # History goes out in chunks that each fit in one post, the client renders the first while the rest is sent
+    with metrics.phase('history'):
+        if since is None:
+            chunks = list(envelope.text_chunks(data, get_messages(dynamodb, room)))
+        else:
+            # Clients that keep a cursor get the welcome text and only the messages they have not seen
+            chunks = list(envelope.chunks(get_messages_since(since, dynamodb, room), envelope.of(sender),
+                                          welcome=data))
+    with metrics.phase('broadcast'):
+        for chunk in chunks:
+            send_to_self(apigatewaymanagementapi, connection_id, chunk)
+
+    if presence.enabled():
+        with metrics.phase('presence'):
+            presence.record(dynamodb, sqs or runtime.sqs(), runtime.endpoint_url(event), room,
+                            sender['username']['S'], presence.JOINED)
+        return {}
+
+    # Retrieve the connection_ids of the room from the connection registry
+    with metrics.phase('connections'):
+        connection_ids = connections.get_connections(dynamodb, room, user_count)
+
+    with metrics.phase('broadcast'):
+        data = f"{sender['username']['S']} has joined the chat room"
+        connections.send_to_all(dynamodb, apigatewaymanagementapi, connection_ids, data)
 
     return {}
-
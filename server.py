@@ -0,0 +1,309 @@
+"""
+Standalone WebSocket gateway that runs the chat functions in-process, for on-prem and edge deployments and for local
+end-to-end load tests. It accepts WebSocket connections itself, routes on $request.body.action like the API of
+template.yaml and posts to its own sockets instead of the API Gateway management API.
+
+    PYTHONPATH=common python server.py --port 8080
+"""
+import asyncio
+import base64
+import functools
+import json
+import os
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import click
+
+from chat_common import storage
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from fan_out import handler as fan_out
+from on_connect import handler as on_connect
+from on_disconnect import handler as on_disconnect
+from send_message import handler as send_message
+from send_notify import handler as send_notify
+
+# Routes of the WebSocket API in template.yaml, selected by $request.body.action
+ROUTES = {
+    'sendmessage': send_message.handle,
+    'sendnotify': send_notify.handle,
+}
+
+# Frames larger than this are rejected by API Gateway as well
+MAX_FRAME_SIZE = 128 * 1024
+
+# FANOUT_QUEUE_URL and PRESENCE_QUEUE_URL of the in-process fan-out queue
+LOCAL_QUEUE_URL = 'local://fanout'
+
+
+class GoneException(Exception):
+    """
+    Raised for connections that are not open on this server, broadcast treats it like a 410 from API Gateway
+    """
+    response = {'Error': {'Code': 'GoneException'}, 'ResponseMetadata': {'HTTPStatusCode': 410}}
+
+
+class PendingConnection(object):
+    """
+    Connection whose $connect has run but whose handshake has not finished yet. The functions already see it in storage,
+    so posts to it are queued until the socket is open instead of reporting it gone.
+    """
+
+    def __init__(self, remote_address):
+        self.remote_address = remote_address
+        self.queued = []
+        self.closed = False
+
+    async def send(self, data):
+        self.queued.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+class LocalManagementApi(object):
+    """
+    Stand-in for the apigatewaymanagementapi client that writes to the sockets of this server. The functions call it
+    from worker threads, every post is handed to the event loop and waited for.
+    """
+
+    class exceptions(object):
+        GoneException = GoneException
+
+    def __init__(self, loop, timeout=5.0):
+        self.loop = loop
+        self.timeout = timeout
+        self.connections = {}
+
+    def connection(self, connection_id):
+        connection = self.connections.get(connection_id)
+        if connection is None:
+            raise GoneException(f"{connection_id} is not connected")
+        return connection
+
+    def post_to_connection(self, Data, ConnectionId):
+        connection = self.connection(ConnectionId)
+        try:
+            asyncio.run_coroutine_threadsafe(connection.send(Data), self.loop).result(self.timeout)
+        except ConnectionClosed as e:
+            raise GoneException(f"{ConnectionId} is not connected") from e
+        return {}
+
+    def get_connection(self, ConnectionId):
+        connection = self.connection(ConnectionId)
+        return {'identity': {'sourceIp': connection.remote_address[0]}}
+
+    def delete_connection(self, ConnectionId):
+        connection = self.connection(ConnectionId)
+        asyncio.run_coroutine_threadsafe(connection.close(), self.loop).result(self.timeout)
+        return {}
+
+
+class LocalQueue(object):
+    """
+    Stand-in for the SQS client of the fan-out and presence queues, queued messages are handled by the fan_out function
+    in-process once their delay has passed. Events run one at a time in the order they were queued, which keeps the
+    order of every message group.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, MessageGroupId=None, MessageDeduplicationId=None):
+        message_id = str(uuid.uuid4())
+        record = {'messageId': message_id, 'body': MessageBody}
+        loop = self.gateway.loop
+        loop.call_soon_threadsafe(loop.call_later, DelaySeconds, self.gateway.dispatch, record)
+        return {'MessageId': message_id}
+
+
+class Gateway(object):
+    """
+    WebSocket server that turns connections and frames into the events API Gateway would send to the functions.
+    Events are handled one at a time on a single worker thread, like a warm Lambda container, while broadcasts still
+    post to many sockets in parallel.
+    """
+
+    def __init__(self, dynamodb=None, stage='local'):
+        """
+        :param dynamodb: Optional DDB client, defaults to the functions' cached client
+        :param stage: Stage name of the events
+        """
+        self.dynamodb = dynamodb
+        self.stage = stage
+        self.domain_name = 'localhost'
+        self.loop = None
+        self.api = None
+        self.queue = LocalQueue(self)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection_ids = {}
+        self.pending = set()
+
+    def event(self, connection_id, route_key, event_type, **kwargs):
+        """
+        Build the API Gateway WebSocket event of a route
+
+        :param connection_id: Connection id
+        :param route_key: $connect, $disconnect or the action
+        :param event_type: CONNECT, MESSAGE or DISCONNECT
+        :param kwargs: Extra top level event keys such as body or queryStringParameters
+        :return: Event dict
+        """
+        return dict({
+            'requestContext': {
+                'routeKey': route_key,
+                'eventType': event_type,
+                'connectionId': connection_id,
+                'domainName': self.domain_name,
+                'stage': self.stage,
+            },
+        }, **kwargs)
+
+    def clients(self, handle):
+        if handle is on_connect.handle:
+            return {'dynamodb': self.dynamodb}
+        if handle is fan_out.handle:
+            return {'dynamodb': self.dynamodb, 'apigatewaymanagementapi': self.api}
+        return {'dynamodb': self.dynamodb, 'apigatewaymanagementapi': self.api, 'sqs': self.queue}
+
+    async def invoke(self, handle, event):
+        """
+        Call a function on the worker thread
+
+        :param handle: Handler function
+        :param event: Event dict
+        :return: Response of the function, a 500 response when it raised
+        """
+        call = functools.partial(handle, event, None, **self.clients(handle))
+        try:
+            return await self.loop.run_in_executor(self.executor, call) or {}
+        except Exception as e:
+            print(e)
+            return {'statusCode': 500, 'body': 'Internal server error'}
+
+    def dispatch(self, record):
+        task = self.loop.create_task(self.invoke(fan_out.handle, {'Records': [record]}))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def process_request(self, connection, request):
+        """
+        Run $connect before the handshake, a function that rejects the connection fails the handshake with its status
+        """
+        connection_id = base64.b64encode(os.urandom(8)).decode()
+        query = dict(parse_qsl(urlsplit(request.path).query))
+        # Known to the management API before $connect stores it, broadcasts during the handshake are queued for it
+        self.api.connections[connection_id] = PendingConnection(connection.remote_address)
+        response = await self.invoke(on_connect.handle,
+                                     self.event(connection_id, '$connect', 'CONNECT', queryStringParameters=query))
+        status = response.get('statusCode', 200)
+        if status >= 400:
+            self.api.connections.pop(connection_id, None)
+            return connection.respond(status, f"{response.get('body', '')}\n")
+        self.connection_ids[connection] = connection_id
+        return None
+
+    async def open(self, connection, connection_id):
+        """
+        Hand the posts queued during the handshake to the socket, in order, and post to the socket from then on
+        """
+        pending = self.api.connections.get(connection_id)
+        while isinstance(pending, PendingConnection) and pending.queued:
+            await connection.send(pending.queued.pop(0))
+        self.api.connections[connection_id] = connection
+        if isinstance(pending, PendingConnection) and pending.closed:
+            await connection.close()
+
+    async def handler(self, connection):
+        connection_id = self.connection_ids.pop(connection)
+        try:
+            await self.open(connection, connection_id)
+            async for message in connection:
+                await self.route(connection, connection_id, message)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.api.connections.pop(connection_id, None)
+            await self.invoke(on_disconnect.handle, self.event(connection_id, '$disconnect', 'DISCONNECT'))
+
+    async def route(self, connection, connection_id, message):
+        """
+        Select the route of a frame by its action and call the function of the route
+        """
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace')
+        try:
+            action = json.loads(message).get('action')
+        except (ValueError, AttributeError):
+            action = None
+
+        handle = ROUTES.get(action)
+        if handle is None:
+            # What API Gateway answers when no route matches and there is no $default route
+            await connection.send(json.dumps({'message': 'Forbidden', 'connectionId': connection_id}))
+            return
+        await self.invoke(handle, self.event(connection_id, action, 'MESSAGE', body=message))
+
+    async def start(self, host='localhost', port=8080):
+        """
+        Start listening
+
+        :param host: Interface to listen on
+        :param port: Port to listen on, 0 picks a free port
+        :return: websockets Server
+        """
+        self.loop = asyncio.get_running_loop()
+        self.api = LocalManagementApi(self.loop)
+        server = await serve(self.handler, host, port, process_request=self.process_request,
+                             max_size=MAX_FRAME_SIZE)
+        self.domain_name = f"{host}:{server.sockets[0].getsockname()[1]}"
+        return server
+
+
+async def run(host, port, dynamodb=None):
+    gateway = Gateway(dynamodb)
+    server = await gateway.start(host, port)
+    print(f"Listening on ws://{gateway.domain_name}")
+    await server.serve_forever()
+
+
+@click.command()
+@click.option("--host", default="localhost", help="Interface to listen on")
+@click.option("--port", default=8080, help="Port to listen on")
+@click.option("--fan-out", "use_fan_out", is_flag=True,
+              help="Hand broadcasts and presence windows to the in-process fan-out queue")
+@click.option("--metrics", is_flag=True, help="Print the per-invocation metrics lines")
+@click.option("--storage", "storage_backend", type=click.Choice(storage.BACKENDS), default=storage.backend(),
+              help="Keep connections, messages and counters in DynamoDB or in an SQLite database file")
+@click.option("--sqlite-path", default=storage.sqlite_path(), help="SQLite database file")
+def main(host, port, use_fan_out, metrics, storage_backend, sqlite_path):
+    """
+    Main method to start the WebSocket gateway. The tables are read from the same environment variables as the
+    functions, point AWS_ENDPOINT_URL_DYNAMODB at DynamoDB Local to run without AWS, or use the sqlite storage to run
+    on a single node without any tables.
+
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :param use_fan_out: Use the in-process fan-out queue instead of broadcasting inline
+    :param metrics: Keep the per-invocation metrics lines on
+    :param storage_backend: dynamodb or sqlite
+    :param sqlite_path: Database file of the sqlite storage
+    :return:
+    """
+    if use_fan_out:
+        os.environ['FANOUT_QUEUE_URL'] = os.environ['PRESENCE_QUEUE_URL'] = LOCAL_QUEUE_URL
+    else:
+        os.environ.pop('FANOUT_QUEUE_URL', None)
+        os.environ.pop('PRESENCE_QUEUE_URL', None)
+    os.environ['METRICS_ENABLED'] = 'true' if metrics else 'false'
+    os.environ['STORAGE_BACKEND'] = storage_backend
+    os.environ['SQLITE_PATH'] = sqlite_path
+    asyncio.run(run(host, port))
+
+
+if __name__ == '__main__':
+    main()
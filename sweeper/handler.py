@@ -0,0 +1,64 @@
+import json
+import time
+
+from chat_common import connections, liveness, metrics, runtime
+
+
+def report(statuses, unremoved, elapsed):
+    """
+    Print the result of one sweep as a JSON log line
+
+    :param statuses: Dict of liveness status keyed by connection id
+    :param unremoved: List of gone connection ids that could not be removed
+    :param elapsed: Seconds spent on the sweep
+    :return: Dict of metrics
+    """
+    counts = {status: 0 for status in (liveness.ALIVE, liveness.GONE, liveness.FAILED)}
+    for status in statuses.values():
+        counts[status] += 1
+    line = {
+        'metric': 'sweep',
+        'swept': len(statuses),
+        'alive': counts[liveness.ALIVE],
+        'removed': counts[liveness.GONE] - len(unremoved),
+        'failed': counts[liveness.FAILED] + len(unremoved),
+        'elapsedMs': round(elapsed * 1000, 3)
+    }
+    for name in ('swept', 'alive', 'removed', 'failed'):
+        metrics.count(name, line[name])
+    print(json.dumps(line))
+    return line
+
+
+@metrics.instrumented('sweeper')
+def handle(event, context, dynamodb=None, apigatewaymanagementapi=None):
+    """
+    Method that handle the scheduled liveness sweep. Every connection is read with a parallel scan and checked with
+    the management API, connections that are gone are removed in batches so broadcasts stop posting to them.
+    Connections younger than SWEEP_GRACE and connections the API could not tell about are left for the next sweep.
+
+    :param event: EventBridge scheduled event.
+    :param context: A context object is passed to your function by Lambda at runtime.
+    This object provides methods and properties that provide information about the invocation,
+    function, and runtime environment.
+    :param dynamodb: Optional DDB client, defaults to the container's cached client
+    :param apigatewaymanagementapi: Optional apigatewaymanagemntapi client, defaults to the container's cached client
+    :return: Dict with the swept, alive, removed and failed counts
+    """
+    dynamodb = dynamodb or runtime.dynamodb()
+    apigatewaymanagementapi = apigatewaymanagementapi or \
+        runtime.client('apigatewaymanagementapi', endpoint_url=liveness.endpoint_url())
+    started = time.monotonic()
+
+    with metrics.phase('scan'):
+        now = time.time()
+        items = [item for item in liveness.scan(dynamodb) if liveness.settled(item, now)]
+    with metrics.phase('check'):
+        statuses = liveness.check_all(apigatewaymanagementapi, items)
+    gone = [item for item in items if statuses[item['connectionId']['S']] == liveness.GONE]
+    unremoved = []
+    if gone:
+        with metrics.phase('purge'):
+            unremoved = connections.purge(dynamodb, gone)
+
+    return report(statuses, unremoved, time.monotonic() - started)
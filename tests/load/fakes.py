@@ -0,0 +1,440 @@
+"""
+Lightweight in-process stand-ins for the DynamoDB and API Gateway management API clients, used by the load test
+harness. They implement the subset of the client APIs the handlers use, count every call per operation and can
+inject latency.
+"""
+import re
+import threading
+import time
+
+from collections import Counter
+from decimal import Decimal
+
+
+class FakeClientError(Exception):
+    def __init__(self, code, message='', status_code=400):
+        super(FakeClientError, self).__init__(message or code)
+        self.response = {'Error': {'Code': code, 'Message': message or code},
+                         'ResponseMetadata': {'HTTPStatusCode': status_code}}
+
+
+class ConditionalCheckFailedException(FakeClientError):
+    def __init__(self):
+        super(ConditionalCheckFailedException, self).__init__('ConditionalCheckFailedException')
+
+
+class GoneException(FakeClientError):
+    def __init__(self):
+        super(GoneException, self).__init__('GoneException', status_code=410)
+
+
+class Exceptions(object):
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    GoneException = GoneException
+
+
+TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),+-]|[#:]?[A-Za-z_][A-Za-z0-9_.]*)')
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"Unsupported expression: {expression}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def to_python(value):
+    if value is None:
+        return None
+    if 'N' in value:
+        return Decimal(value['N'])
+    if 'S' in value:
+        return value['S']
+    if 'BOOL' in value:
+        return value['BOOL']
+    if 'B' in value:
+        return value['B']
+    if 'L' in value:
+        return [to_python(v) for v in value['L']]
+    raise ValueError(f"Unsupported value: {value}")
+
+
+def number(value):
+    return {'N': str(int(value)) if value == value.to_integral_value() else str(value)}
+
+
+class Expression(object):
+    """
+    Recursive descent evaluator for condition, filter and key condition expressions
+    """
+
+    def __init__(self, expression, names, values):
+        self.tokens = tokenize(expression)
+        self.names = names or {}
+        self.values = values or {}
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token or '').upper() != expected:
+            raise ValueError(f"Expected {expected} but found {token}")
+        self.position += 1
+        return token
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, item):
+        token = self.take()
+        if token.startswith(':'):
+            return to_python(self.values[token])
+        if token == 'size':
+            self.take('(')
+            value = to_python(item.get(self.name(self.take())))
+            self.take(')')
+            return len(value) if value is not None else None
+        return to_python(item.get(self.name(token)))
+
+    def evaluate(self, item):
+        self.position = 0
+        result = self.disjunction(item)
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected token {self.peek()}")
+        return result
+
+    def disjunction(self, item):
+        result = self.conjunction(item)
+        while (self.peek() or '').upper() == 'OR':
+            self.take()
+            right = self.conjunction(item)
+            result = result or right
+        return result
+
+    def conjunction(self, item):
+        result = self.negation(item)
+        while (self.peek() or '').upper() == 'AND':
+            self.take()
+            right = self.negation(item)
+            result = result and right
+        return result
+
+    def negation(self, item):
+        if (self.peek() or '').upper() == 'NOT':
+            self.take()
+            return not self.negation(item)
+        return self.comparison(item)
+
+    def comparison(self, item):
+        token = self.peek()
+        if token == '(':
+            self.take()
+            result = self.disjunction(item)
+            self.take(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()
+            self.take('(')
+            exists = self.name(self.take()) in item
+            self.take(')')
+            return exists if token == 'attribute_exists' else not exists
+        if token == 'begins_with':
+            self.take()
+            self.take('(')
+            value = self.operand(item)
+            self.take(',')
+            prefix = self.operand(item)
+            self.take(')')
+            return value is not None and value.startswith(prefix)
+
+        left = self.operand(item)
+        operator = self.take()
+        if operator.upper() == 'BETWEEN':
+            low = self.operand(item)
+            self.take('AND')
+            high = self.operand(item)
+            return left is not None and low <= left <= high
+        right = self.operand(item)
+        if left is None or right is None:
+            return operator == '<>' and left != right
+        return {
+            '=': lambda: left == right,
+            '<>': lambda: left != right,
+            '<': lambda: left < right,
+            '<=': lambda: left <= right,
+            '>': lambda: left > right,
+            '>=': lambda: left >= right,
+        }[operator]()
+
+
+def apply_update(item, expression, names, values):
+    """
+    Apply a SET/ADD/REMOVE update expression to an item in place
+
+    :return: Set of updated attribute names
+    """
+    updated = set()
+    names = names or {}
+    values = values or {}
+    clauses = re.split(r'\b(SET|ADD|REMOVE)\b', expression.strip(), flags=re.IGNORECASE)
+    action = None
+    for clause in clauses:
+        clause = clause.strip()
+        if not clause:
+            continue
+        if clause.upper() in ('SET', 'ADD', 'REMOVE'):
+            action = clause.upper()
+            continue
+        for part in split_top_level(clause):
+            if action == 'SET':
+                path, value = part.split('=', 1)
+                path = names.get(path.strip(), path.strip())
+                item[path] = set_value(item, value.strip(), names, values)
+                updated.add(path)
+            elif action == 'ADD':
+                path, value = part.split()
+                path = names.get(path, path)
+                current = to_python(item.get(path)) or Decimal(0)
+                item[path] = number(current + to_python(values[value]))
+                updated.add(path)
+            elif action == 'REMOVE':
+                item.pop(names.get(part, part), None)
+    return updated
+
+
+def split_top_level(clause):
+    parts, depth, current = [], 0, ''
+    for char in clause:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def set_value(item, expression, names, values):
+    for operator in ('+', '-'):
+        depth = 0
+        for i, char in enumerate(expression):
+            depth += char == '('
+            depth -= char == ')'
+            if char == operator and depth == 0:
+                left = to_python(set_value(item, expression[:i].strip(), names, values))
+                right = to_python(set_value(item, expression[i + 1:].strip(), names, values))
+                return number(left + right if operator == '+' else left - right)
+    if expression.startswith('if_not_exists'):
+        path, default = [p.strip() for p in expression[expression.index('(') + 1:expression.rindex(')')].split(',')]
+        path = names.get(path, path)
+        return item[path] if path in item else values[default]
+    if expression.startswith(':'):
+        return values[expression]
+    return item[names.get(expression, expression)]
+
+
+def project(item, projection, names):
+    if not projection:
+        return dict(item)
+    names = names or {}
+    attributes = [names.get(p.strip(), p.strip()) for p in projection.split(',')]
+    return {k: v for k, v in item.items() if k in attributes}
+
+
+class Paginator(object):
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class FakeDynamoDB(object):
+    """
+    In-memory DynamoDB client
+    """
+
+    exceptions = Exceptions
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.calls = Counter()
+        self.lock = threading.RLock()
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_table(self, TableName, KeySchema, AttributeDefinitions, GlobalSecondaryIndexes=(), **kwargs):
+        self.tables[TableName] = {
+            'key': [k['AttributeName'] for k in KeySchema],
+            'indexes': {index['IndexName']: [k['AttributeName'] for k in index['KeySchema']]
+                        for index in GlobalSecondaryIndexes},
+            'items': {},
+        }
+
+    def update_time_to_live(self, **kwargs):
+        return {}
+
+    def key_of(self, table_name, item):
+        return tuple(item[k]['S'] if 'S' in item[k] else item[k]['N'] for k in self.tables[table_name]['key'])
+
+    def check(self, item, kwargs):
+        if 'ConditionExpression' in kwargs:
+            expression = Expression(kwargs['ConditionExpression'], kwargs.get('ExpressionAttributeNames'),
+                                    kwargs.get('ExpressionAttributeValues'))
+            if not expression.evaluate(item or {}):
+                raise ConditionalCheckFailedException()
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation))
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.call('PutItem')
+        with self.lock:
+            key = self.key_of(TableName, Item)
+            old = self.tables[TableName]['items'].get(key)
+            self.check(old, kwargs)
+            self.tables[TableName]['items'][key] = dict(Item)
+        return {'Attributes': old} if kwargs.get('ReturnValues') == 'ALL_OLD' and old else {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call('GetItem')
+        item = self.tables[TableName]['items'].get(self.key_of(TableName, Key))
+        if item is None:
+            return {}
+        return {'Item': project(item, kwargs.get('ProjectionExpression'), kwargs.get('ExpressionAttributeNames'))}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.call('DeleteItem')
+        with self.lock:
+            key = self.key_of(TableName, Key)
+            old = self.tables[TableName]['items'].get(key)
+            self.check(old, kwargs)
+            self.tables[TableName]['items'].pop(key, None)
+        return {'Attributes': old} if kwargs.get('ReturnValues') == 'ALL_OLD' and old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, **kwargs):
+        self.call('UpdateItem')
+        with self.lock:
+            key = self.key_of(TableName, Key)
+            old = self.tables[TableName]['items'].get(key)
+            self.check(old, kwargs)
+            item = dict(old or Key)
+            updated = apply_update(item, UpdateExpression, kwargs.get('ExpressionAttributeNames'),
+                         kwargs.get('ExpressionAttributeValues'))
+            self.tables[TableName]['items'][key] = item
+
+        return_values = kwargs.get('ReturnValues')
+        if return_values == 'ALL_NEW':
+            return {'Attributes': dict(item)}
+        if return_values == 'UPDATED_NEW':
+            return {'Attributes': {k: v for k, v in item.items() if k in updated}}
+        if return_values == 'ALL_OLD':
+            return {'Attributes': old or {}}
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.call('BatchWriteItem')
+        for table_name, requests in RequestItems.items():
+            with self.lock:
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self.tables[table_name]['items'][self.key_of(table_name, item)] = dict(item)
+                    else:
+                        self.tables[table_name]['items'].pop(
+                            self.key_of(table_name, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems):
+        self.call('BatchGetItem')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            items = self.tables[table_name]['items']
+            responses[table_name] = [
+                project(items[self.key_of(table_name, key)], request.get('ProjectionExpression'),
+                        request.get('ExpressionAttributeNames'))
+                for key in request['Keys'] if self.key_of(table_name, key) in items
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def scan(self, TableName, **kwargs):
+        self.call('Scan')
+        items = list(self.tables[TableName]['items'].values())
+        return {'Items': self.finish(items, kwargs), 'Count': len(items)}
+
+    def query(self, TableName, KeyConditionExpression, **kwargs):
+        self.call('Query')
+        table = self.tables[TableName]
+        key = table['indexes'][kwargs['IndexName']] if 'IndexName' in kwargs else table['key']
+        names = kwargs.get('ExpressionAttributeNames')
+        values = kwargs.get('ExpressionAttributeValues')
+        condition = Expression(KeyConditionExpression, names, values)
+        items = [item for item in list(table['items'].values())
+                 if all(k in item for k in key) and condition.evaluate(item)]
+        if len(key) > 1:
+            items.sort(key=lambda item: to_python(item[key[1]]), reverse=not kwargs.get('ScanIndexForward', True))
+        if 'Limit' in kwargs:
+            items = items[:kwargs['Limit']]
+        return {'Items': self.finish(items, kwargs), 'Count': len(items)}
+
+    def finish(self, items, kwargs):
+        names = kwargs.get('ExpressionAttributeNames')
+        if 'FilterExpression' in kwargs:
+            expression = Expression(kwargs['FilterExpression'], names, kwargs.get('ExpressionAttributeValues'))
+            items = [item for item in items if expression.evaluate(item)]
+        return [project(item, kwargs.get('ProjectionExpression'), names) for item in items]
+
+
+class FakeManagementApi(object):
+    """
+    In-memory API Gateway management API client that records posted frames
+    """
+
+    exceptions = Exceptions
+
+    def __init__(self, latency=0.0, gone=()):
+        self.latency = latency
+        self.gone = set(gone)
+        self.posts = Counter()
+        self.frames = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, Data, ConnectionId):
+        with self.lock:
+            self.calls['PostToConnection'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if ConnectionId in self.gone:
+            raise GoneException()
+        with self.lock:
+            self.posts[ConnectionId] += 1
+            self.frames.setdefault(ConnectionId, []).append(Data)
+        return {}
+
+    def get_connection(self, ConnectionId):
+        with self.lock:
+            self.calls['GetConnection'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if ConnectionId in self.gone:
+            raise GoneException()
+        return {'ConnectionId': ConnectionId}
@@ -0,0 +1,239 @@
+"""
+Local load test harness that drives the four WebSocket handlers against the in-process DynamoDB and API Gateway
+stand-ins in tests/load/fakes.py.
+
+For every room size the harness connects the whole room, then runs a sample of sendnotify, sendmessage and disconnect
+invocations and reports throughput, p50/p95/p99 handler latency and the number of DynamoDB calls per invocation.
+
+    python -m tests.load.harness --sizes 10,100,1000,10000 --post-latency-ms 5
+"""
+import contextlib
+import io
+import json
+import os
+import time
+
+from collections import Counter
+
+import click
+
+from tests.load.fakes import FakeDynamoDB, FakeManagementApi
+
+CONNECTION_TABLE_NAME = 'LoadConnectionTable'
+MSG_COUNTER_TABLE_NAME = 'LoadMsgCounterTable'
+MESSAGE_TABLE_NAME = 'LoadMessageTable'
+SIZES = (10, 100, 1000, 10000)
+OPERATIONS = ('connect', 'sendnotify', 'sendmessage', 'disconnect')
+
+
+def setup_env(metrics=False):
+    """
+    Point the handlers at the load test tables and keep the fan-out inline
+
+    :param metrics: Keep the per-invocation metrics lines on, their output is discarded
+    :return: None
+    """
+    os.environ['CONNECTION_TABLE_NAME'] = CONNECTION_TABLE_NAME
+    os.environ['MSG_COUNTER_TABLE_NAME'] = MSG_COUNTER_TABLE_NAME
+    os.environ['MESSAGE_TABLE_NAME'] = MESSAGE_TABLE_NAME
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.pop('FANOUT_QUEUE_URL', None)
+    os.environ.pop('PRESENCE_QUEUE_URL', None)
+    os.environ['METRICS_ENABLED'] = 'true' if metrics else 'false'
+
+
+def create_tables(dynamodb):
+    """
+    Create the tables of template.yaml on the fake DDB client
+
+    :param dynamodb: FakeDynamoDB
+    :return: None
+    """
+    dynamodb.create_table(
+        TableName=CONNECTION_TABLE_NAME,
+        KeySchema=[{'AttributeName': 'connectionId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'connectionId', 'AttributeType': 'S'},
+                              {'AttributeName': 'room', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{'IndexName': 'room-index',
+                                 'KeySchema': [{'AttributeName': 'room', 'KeyType': 'HASH'}],
+                                 'Projection': {'ProjectionType': 'ALL'}}],
+    )
+    dynamodb.create_table(
+        TableName=MSG_COUNTER_TABLE_NAME,
+        KeySchema=[{'AttributeName': 'myid', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'myid', 'AttributeType': 'S'}],
+    )
+    dynamodb.create_table(
+        TableName=MESSAGE_TABLE_NAME,
+        KeySchema=[{'AttributeName': 'myid', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'myid', 'AttributeType': 'S'},
+                              {'AttributeName': 'room', 'AttributeType': 'S'},
+                              {'AttributeName': 'seq', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{'IndexName': 'history-index',
+                                 'KeySchema': [{'AttributeName': 'room', 'KeyType': 'HASH'},
+                                               {'AttributeName': 'seq', 'KeyType': 'RANGE'}],
+                                 'Projection': {'ProjectionType': 'ALL'}}],
+    )
+
+
+def event(connection_id, **kwargs):
+    """
+    Build an API Gateway WebSocket event for a connection
+
+    :param connection_id: Connection id
+    :param kwargs: Extra top level event keys such as body or queryStringParameters
+    :return: Event dict
+    """
+    return dict({
+        'requestContext': {
+            'connectionId': connection_id,
+            'domainName': 'loadtest',
+            'stage': 'test'
+        },
+    }, **kwargs)
+
+
+def percentile(samples, p):
+    """
+    Nearest rank percentile
+
+    :param samples: List of numbers
+    :param p: Percentile between 0 and 100
+    :return: Number, or 0 for no samples
+    """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+class Recorder(object):
+    """
+    Collects latency, DDB calls and posts for each invocation of an operation
+    """
+
+    def __init__(self, dynamodb, apigatewaymanagementapi):
+        self.dynamodb = dynamodb
+        self.apigatewaymanagementapi = apigatewaymanagementapi
+        self.latencies = {}
+        self.calls = {}
+        self.posts = {}
+        self.elapsed = Counter()
+
+    def invoke(self, operation, function, *args, **kwargs):
+        ddb_before = sum(self.dynamodb.calls.values())
+        posts_before = self.apigatewaymanagementapi.calls['PostToConnection']
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.elapsed[operation] += elapsed
+        self.latencies.setdefault(operation, []).append(elapsed * 1000)
+        self.calls.setdefault(operation, []).append(sum(self.dynamodb.calls.values()) - ddb_before)
+        self.posts.setdefault(operation, []).append(self.apigatewaymanagementapi.calls['PostToConnection'] - posts_before)
+        return result
+
+    def report(self):
+        report = {}
+        for operation in OPERATIONS:
+            latencies = self.latencies.get(operation, [])
+            if not latencies:
+                continue
+            calls = self.calls[operation]
+            report[operation] = {
+                'invocations': len(latencies),
+                'throughput': round(len(latencies) / self.elapsed[operation], 1) if self.elapsed[operation] else 0,
+                'p50Ms': round(percentile(latencies, 50), 3),
+                'p95Ms': round(percentile(latencies, 95), 3),
+                'p99Ms': round(percentile(latencies, 99), 3),
+                'ddbCallsPerOp': round(sum(calls) / float(len(calls)), 2),
+                'ddbCallsMax': max(calls),
+                'postsPerOp': round(sum(self.posts[operation]) / float(len(latencies)), 1),
+            }
+        return report
+
+
+def run(size, samples=20, ddb_latency=0.0, post_latency=0.0, metrics=False):
+    """
+    Run the load scenario for one room size
+
+    :param size: Number of connections in the room
+    :param samples: Number of sendnotify, sendmessage and disconnect invocations to measure
+    :param ddb_latency: Seconds added to every DDB call
+    :param post_latency: Seconds added to every post_to_connection call
+    :param metrics: Measure with the per-invocation metrics lines on
+    :return: Report dict keyed by operation
+    """
+    setup_env(metrics)
+
+    from chat_common import concurrency, connections, counters, ratelimit, runtime
+    from on_connect import handler as on_connect
+    from on_disconnect import handler as on_disconnect
+    from send_message import handler as send_message
+    from send_notify import handler as send_notify
+
+    runtime.reset()
+    connections.reset()
+    counters.reset()
+    ratelimit.reset()
+    concurrency.reset()
+
+    dynamodb = FakeDynamoDB(latency=ddb_latency)
+    create_tables(dynamodb)
+    apigatewaymanagementapi = FakeManagementApi(latency=post_latency)
+    recorder = Recorder(dynamodb, apigatewaymanagementapi)
+    clients = {'dynamodb': dynamodb, 'apigatewaymanagementapi': apigatewaymanagementapi}
+
+    connection_ids = [f"conn-{i}" for i in range(size)]
+    for i, connection_id in enumerate(connection_ids):
+        recorder.invoke('connect', on_connect.handle,
+                        event(connection_id, queryStringParameters={'username': f"user{i}"}), None,
+                        dynamodb=dynamodb)
+
+    samples = min(samples, size)
+    for connection_id in connection_ids[:samples]:
+        recorder.invoke('sendnotify', send_notify.handle, event(connection_id), None, **clients)
+
+    for i, connection_id in enumerate(connection_ids[:samples]):
+        body = json.dumps({'action': 'sendmessage', 'message': f"message {i}"})
+        recorder.invoke('sendmessage', send_message.handle, event(connection_id, body=body), None, **clients)
+
+    for connection_id in connection_ids[-samples:]:
+        recorder.invoke('disconnect', on_disconnect.handle, event(connection_id), None, **clients)
+
+    return recorder.report()
+
+
+def render(size, report):
+    lines = [f"room size {size}",
+             f"  {'operation':<12}{'n':>6}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+             f"{'ddb/op':>8}{'ddb max':>8}{'posts/op':>10}"]
+    for operation, stats in report.items():
+        lines.append(f"  {operation:<12}{stats['invocations']:>6}{stats['throughput']:>10}{stats['p50Ms']:>10}"
+                     f"{stats['p95Ms']:>10}{stats['p99Ms']:>10}{stats['ddbCallsPerOp']:>8}{stats['ddbCallsMax']:>8}"
+                     f"{stats['postsPerOp']:>10}")
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--sizes', default=','.join(str(size) for size in SIZES), show_default=True,
+              help='Comma separated room sizes')
+@click.option('--samples', default=20, show_default=True,
+              help='Measured sendnotify, sendmessage and disconnect invocations per room size')
+@click.option('--ddb-latency-ms', default=0.0, show_default=True, help='Latency added to every DDB call')
+@click.option('--post-latency-ms', default=0.0, show_default=True,
+              help='Latency added to every post_to_connection call')
+@click.option('--metrics', is_flag=True, help='Keep the per-invocation metrics lines on to measure their overhead')
+@click.option('--json-output', is_flag=True, help='Print the report as JSON')
+def main(sizes, samples, ddb_latency_ms, post_latency_ms, metrics, json_output):
+    reports = {}
+    for size in [int(size) for size in sizes.split(',')]:
+        reports[size] = run(size, samples, ddb_latency_ms / 1000.0, post_latency_ms / 1000.0, metrics)
+        if not json_output:
+            click.echo(render(size, reports[size]))
+    if json_output:
+        click.echo(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
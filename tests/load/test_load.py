@@ -0,0 +1,114 @@
+import json
+import os
+import pytest
+
+from chat_common import concurrency, connections, counters, ratelimit, runtime
+from tests.load import harness
+from tests.load.fakes import FakeDynamoDB, FakeManagementApi
+
+
+@pytest.fixture(autouse=True)
+def restore_env():
+    environ = dict(os.environ)
+    yield
+    os.environ.clear()
+    os.environ.update(environ)
+    runtime.reset()
+    connections.reset()
+    counters.reset()
+    ratelimit.reset()
+    concurrency.reset()
+
+
+def test_report_has_all_operations():
+    report = harness.run(10, samples=5)
+
+    assert list(report) == list(harness.OPERATIONS)
+    assert report['connect']['invocations'] == 10
+    assert report['sendmessage']['invocations'] == 5
+    assert report['sendmessage']['postsPerOp'] == 10
+    assert report['sendnotify']['postsPerOp'] == 11
+    for stats in report.values():
+        assert stats['p50Ms'] <= stats['p95Ms'] <= stats['p99Ms']
+
+
+def test_ddb_calls_do_not_grow_with_room_size():
+    small = harness.run(10, samples=5)
+    large = harness.run(200, samples=5)
+
+    for operation in harness.OPERATIONS:
+        assert small[operation]['ddbCallsMax'] == large[operation]['ddbCallsMax']
+
+
+@pytest.mark.skipif(not os.environ.get('LOAD_TEST_SIZES'), reason='set LOAD_TEST_SIZES to run the full load test')
+def test_full_load():
+    for size in [int(size) for size in os.environ['LOAD_TEST_SIZES'].split(',')]:
+        print(harness.render(size, harness.run(size)))
+
+
+def test_ddb_calls_per_handler():
+    harness.setup_env()
+    from on_connect import handler as on_connect
+    from on_disconnect import handler as on_disconnect
+    from send_message import handler as send_message
+    from send_notify import handler as send_notify
+
+    dynamodb = FakeDynamoDB()
+    harness.create_tables(dynamodb)
+    clients = {'dynamodb': dynamodb, 'apigatewaymanagementapi': FakeManagementApi()}
+
+    def calls(handle, connection_id, **kwargs):
+        before = dict(dynamodb.calls)
+        if handle is on_connect.handle:
+            handle(harness.event(connection_id, **kwargs), None, dynamodb=dynamodb)
+        else:
+            handle(harness.event(connection_id, **kwargs), None, **clients)
+        return {operation: count - before.get(operation, 0) for operation, count in dynamodb.calls.items()
+                if count != before.get(operation, 0)}
+
+    for i in range(3):
+        assert calls(on_connect.handle, f"conn-{i}", queryStringParameters={'username': f"user{i}"}) == \
+            {'PutItem': 1, 'UpdateItem': 1}
+
+    # A cold container reads the sender and the room, after that both come from the container's cache
+    assert calls(send_notify.handle, 'conn-0') == {'BatchGetItem': 2, 'Query': 2}
+    assert calls(send_notify.handle, 'conn-1') == {'BatchGetItem': 1, 'Query': 1}
+
+    # Rate limit buckets, sequence, message, counter flush and the live count, plus one read per bucket the container
+    # has not seen yet
+    body = json.dumps({'action': 'sendmessage', 'message': 'hello'})
+    assert calls(send_message.handle, 'conn-2', body=body) == \
+        {'GetItem': 2, 'UpdateItem': 4, 'PutItem': 1, 'BatchGetItem': 1}
+    assert calls(send_message.handle, 'conn-2', body=body) == {'UpdateItem': 4, 'PutItem': 1, 'BatchGetItem': 1}
+
+    # The leaving user comes back from the delete itself, the connections table stream takes it off the live count
+    assert calls(on_disconnect.handle, 'conn-2') == {'DeleteItem': 1, 'BatchGetItem': 1}
+
+
+def test_fake_dynamodb_conditions():
+    dynamodb = FakeDynamoDB()
+    harness.create_tables(dynamodb)
+    key = {'myid': {'S': 'slot'}}
+    dynamodb.put_item(TableName=harness.MESSAGE_TABLE_NAME, Item=dict(key, seq={'N': '2'}))
+
+    with pytest.raises(dynamodb.exceptions.ConditionalCheckFailedException):
+        dynamodb.put_item(TableName=harness.MESSAGE_TABLE_NAME, Item=dict(key, seq={'N': '1'}),
+                          ConditionExpression='attribute_not_exists(#seq) OR #seq < :seq',
+                          ExpressionAttributeNames={'#seq': 'seq'},
+                          ExpressionAttributeValues={':seq': {'N': '1'}})
+
+    response = dynamodb.update_item(TableName=harness.MESSAGE_TABLE_NAME, Key=key, UpdateExpression='ADD #seq :one',
+                                    ExpressionAttributeNames={'#seq': 'seq'},
+                                    ExpressionAttributeValues={':one': {'N': '1'}}, ReturnValues='UPDATED_NEW')
+    assert response['Attributes'] == {'seq': {'N': '3'}}
+    assert dynamodb.calls == {'PutItem': 2, 'UpdateItem': 1}
+
+
+def test_fake_management_api_gone():
+    apigatewaymanagementapi = FakeManagementApi(gone=['gone'])
+
+    with pytest.raises(apigatewaymanagementapi.exceptions.GoneException):
+        apigatewaymanagementapi.post_to_connection(Data='hi', ConnectionId='gone')
+    apigatewaymanagementapi.post_to_connection(Data='hi', ConnectionId='alive')
+
+    assert apigatewaymanagementapi.frames == {'alive': ['hi']}
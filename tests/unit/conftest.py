@@ -1,5 +1,9 @@
+import os
 import pytest
 
+from chat_common import concurrency, connections, counters, ratelimit, runtime
+from on_expire import handler as on_expire
+
 
 @pytest.fixture(autouse=True)
 def setup_env(monkeypatch):
@@ -10,6 +14,22 @@ def setup_env(monkeypatch):
     monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
     monkeypatch.setenv('AWS_SECURITY_TOKEN', 'testing')
     monkeypatch.setenv('AWS_SESSION_TOKEN', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture(autouse=True)
+def reset_runtime():
+    runtime.reset()
+    connections.reset()
+    counters.reset()
+    ratelimit.reset()
+    concurrency.reset()
+    yield
+    runtime.reset()
+    connections.reset()
+    counters.reset()
+    ratelimit.reset()
+    concurrency.reset()
 
 
 @pytest.fixture
@@ -26,3 +46,77 @@ def apigw_event():
             'stage': 'test'
         },
     }
+
+
+class LocalQueue(object):
+    """
+    In-process stand-in for the SQS client used by the fan-out pipeline
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.delays = []
+        self.groups = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, MessageGroupId=None, MessageDeduplicationId=None):
+        self.messages.append(MessageBody)
+        self.delays.append(DelaySeconds)
+        self.groups.append(MessageGroupId)
+        return {'MessageId': str(len(self.messages))}
+
+    def event(self):
+        """
+        Drain the queue into an SQS event for the fan-out worker
+        """
+        records = [{'messageId': str(i), 'body': body} for i, body in enumerate(self.messages, start=1)]
+        self.messages = []
+        self.groups = []
+        return {'Records': records}
+
+
+@pytest.fixture
+def local_queue(monkeypatch):
+    monkeypatch.setenv('FANOUT_QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/123456789012/TestFanOutQueue.fifo')
+    monkeypatch.setenv('PRESENCE_QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/123456789012/TestPresenceQueue')
+    return LocalQueue()
+
+
+@pytest.fixture
+def connections_stream(monkeypatch):
+    """
+    Stand-in for the connections table stream, which moto does not deliver here. Every delete of a connection that
+    found the item is handed to the on_expire function as a REMOVE record.
+    """
+    def attach(dynamodb):
+        table_name = os.environ.get('CONNECTION_TABLE_NAME')
+        delete_item, batch_write_item = dynamodb.delete_item, dynamodb.batch_write_item
+
+        def stored(key):
+            return dynamodb.get_item(TableName=table_name, Key=key).get('Item')
+
+        def stream(items):
+            records = [{'eventName': 'REMOVE', 'dynamodb': {'OldImage': item}} for item in items if item]
+            if records:
+                on_expire.handle({'Records': records}, None, dynamodb=dynamodb)
+
+        def mock_delete_item(**kwargs):
+            item = stored(kwargs['Key']) if kwargs['TableName'] == table_name else None
+            response = delete_item(**kwargs)
+            stream([item])
+            return response
+
+        def mock_batch_write_item(RequestItems):
+            keys = [request['DeleteRequest']['Key'] for request in RequestItems.get(table_name, [])
+                    if 'DeleteRequest' in request]
+            items = [stored(key) for key in keys]
+            response = batch_write_item(RequestItems=RequestItems)
+            unprocessed = [request['DeleteRequest']['Key']
+                           for request in (response.get('UnprocessedItems') or {}).get(table_name, [])]
+            stream([item for key, item in zip(keys, items) if key not in unprocessed])
+            return response
+
+        monkeypatch.setattr(dynamodb, 'delete_item', mock_delete_item)
+        monkeypatch.setattr(dynamodb, 'batch_write_item', mock_batch_write_item)
+        return dynamodb
+
+    return attach
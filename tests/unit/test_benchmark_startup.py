@@ -0,0 +1,20 @@
+from scripts import benchmark_startup
+
+
+def test_parse_importtime():
+    output = "import time: self [us] | cumulative | imported package\n" \
+             "import time:       120 |        120 |     chat_common\n" \
+             "import time:       800 |        920 |   chat_common.runtime\n" \
+             "import time:      1500 |       2420 | handler\n"
+
+    modules = benchmark_startup.parse_importtime(output)
+
+    assert modules == [
+        ('chat_common', 120, 120, 2),
+        ('chat_common.runtime', 800, 920, 1),
+        ('handler', 1500, 2420, 0),
+    ]
+
+
+def test_budgets_cover_every_function():
+    assert set(benchmark_startup.BUDGETS) == set(benchmark_startup.FUNCTIONS)
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from chat_common import broadcast
+
+
+class StubManagementApi(object):
+    def __init__(self, latency=0.0, errors=None):
+        self.latency = latency
+        self.errors = errors or {}
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, Data, ConnectionId):
+        time.sleep(self.latency)
+        if ConnectionId in self.errors:
+            raise self.errors[ConnectionId]
+        with self.lock:
+            self.posted.append((ConnectionId, Data))
+
+
+def client_error(code, status_code):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status_code}},
+        'PostToConnection'
+    )
+
+
+def connection_ids(count):
+    return [{'connectionId': {'S': f'conn-{i}='}} for i in range(count)]
+
+
+def test_send_to_all_delivers_to_every_connection():
+    apig_management_client = StubManagementApi()
+    result = broadcast.send_to_all(apig_management_client, connection_ids(50), 'hello', workers=8)
+
+    assert sorted(c for c, _ in apig_management_client.posted) == sorted(f'conn-{i}=' for i in range(50))
+    assert all(data == 'hello' for _, data in apig_management_client.posted)
+    assert result.summary() == {'delivered': 50, 'gone': 0, 'throttled': 0, 'failed': 0}
+
+
+def test_send_to_all_classifies_errors():
+    apig_management_client = StubManagementApi(errors={
+        'conn-1=': client_error('GoneException', 410),
+        'conn-2=': client_error('LimitExceededException', 429),
+        'conn-3=': ValueError('boom'),
+    })
+    result = broadcast.send_to_all(apig_management_client, connection_ids(4), 'hello')
+
+    assert result.delivered == ['conn-0=']
+    assert result.gone == ['conn-1=']
+    assert result.throttled == ['conn-2=']
+    assert result.failed == ['conn-3=']
+    assert sorted(result.undelivered) == ['conn-1=', 'conn-2=', 'conn-3=']
+
+
+def test_send_to_all_deadline_marks_slow_posts_failed():
+    apig_management_client = StubManagementApi(latency=0.5)
+    result = broadcast.send_to_all(apig_management_client, connection_ids(4), 'hello', workers=1, deadline=0.1)
+
+    assert result.summary()['failed'] == 4 - len(result.delivered)
+    assert len(result.delivered) < 4
+
+
+def test_send_to_all_empty():
+    result = broadcast.send_to_all(StubManagementApi(), [], 'hello')
+    assert result.summary() == {'delivered': 0, 'gone': 0, 'throttled': 0, 'failed': 0}
+
+
+def test_send_to_all_faster_than_sequential():
+    ids = connection_ids(40)
+    apig_management_client = StubManagementApi(latency=0.01)
+
+    started = time.monotonic()
+    for connection_id in ids:
+        apig_management_client.post_to_connection(Data='hello', ConnectionId=connection_id['connectionId']['S'])
+    sequential = time.monotonic() - started
+
+    result = broadcast.send_to_all(apig_management_client, ids, 'hello', workers=16)
+
+    assert len(result.delivered) == 40
+    assert result.elapsed * 4 < sequential
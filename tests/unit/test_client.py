@@ -1,8 +1,16 @@
+import asyncio
 import client
+import json
+import msgpack
+import pytest
+import queue
+import random
+import re
 import termcolor
 import websocket
 
 from click.testing import CliRunner
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 
 
 def test_on_message(mocker, monkeypatch):
@@ -16,6 +24,20 @@ def test_on_message(mocker, monkeypatch):
     client.on_message(mocker, message)
 
 
+def test_render():
+    assert client.render('foo has joined the chat room') == ('foo has joined the chat room', None)
+    assert client.render('[1, 2]') == ('[1, 2]', None)
+    frame = {'messages': [{'seq': 7, 'sender': None, 'body': 'a'}, {'seq': 8, 'sender': None, 'body': 'b'}]}
+    assert client.render(json.dumps(frame)) == ('a\nb', 8)
+    assert client.render(msgpack.packb(frame, use_bin_type=True)) == ('a\nb', 8)
+
+
+def test_format_message():
+    message = {'seq': 7, 'room': 'global', 'sender': 'foo', 'timestamp': 1612770838718, 'body': 'hello'}
+
+    assert re.match(r'^\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} foo\] hello$', client.format_message(message))
+
+
 def test_on_error(mocker, monkeypatch):
     def mock_colored(msg, color):
         assert msg == 'error found'
@@ -68,3 +90,190 @@ def test_main(monkeypatch):
     result = runner.invoke(client.main, ['--server-url', mock_ws_server_url, '--username', mock_username])
 
     assert result.exit_code == 0
+
+
+def test_main_with_room(monkeypatch):
+    runner = CliRunner()
+
+    def mock_web_socket_app(ws_url, on_message, on_error, on_close):
+        assert ws_url == 'wss://testdomain/test?username=Test User&room=lobby'
+
+        class Struct(object):
+            def run_forever(self):
+                pass
+
+        mocker = Struct()
+        mocker.on_open = None
+
+        return mocker
+
+    monkeypatch.setattr(websocket, 'WebSocketApp', mock_web_socket_app)
+    result = runner.invoke(client.main, ['--server-url', 'wss://testdomain/test', '--username', 'Test User',
+                                         '--room', 'lobby'])
+
+    assert result.exit_code == 0
+
+
+def test_encode():
+    assert json.loads(client.encode(['say "hi"'])) == {'action': 'sendmessage', 'message': 'say "hi"'}
+    assert json.loads(client.encode(['a', 'b'])) == {'action': 'sendmessage', 'messages': ['a', 'b']}
+
+
+def test_collect():
+    outbox = queue.Queue()
+    for i in range(5):
+        outbox.put(f'message {i}')
+
+    assert client.collect(outbox) == ['message 0']
+    assert client.collect(outbox, window=0.01, limit=3) == ['message 1', 'message 2', 'message 3']
+    assert client.collect(outbox, window=0.01) == ['message 4']
+
+
+def test_sender():
+    outbox = queue.Queue()
+    outbox.put('a')
+    outbox.put('b')
+    sent = []
+
+    class Struct(object):
+        def send(self, data):
+            sent.append(json.loads(data))
+            if len(sent) == 1:
+                raise websocket.WebSocketConnectionClosedException()
+
+    try:
+        client.sender(Struct(), outbox, window=0.01)
+    except websocket.WebSocketConnectionClosedException:
+        pass
+
+    assert sent == [{'action': 'sendmessage', 'messages': ['a', 'b']}]
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(random, 'uniform', lambda low, high: high)
+
+    assert [client.backoff(attempt) for attempt in range(8)] == [0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 30.0, 30.0]
+
+
+class FakeSocket(object):
+    """
+    Scripted connection for the asyncio client, it delivers the incoming messages and then drops the connection
+    """
+
+    def __init__(self, incoming, sent):
+        self.incoming = list(incoming)
+        self.sent = sent
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def send(self, data):
+        self.sent.append(json.loads(data))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        if self.incoming:
+            return self.incoming.pop(0)
+        raise ConnectionClosedError(None, None)
+
+
+def test_session_reconnects(monkeypatch):
+    monkeypatch.setattr(client, 'backoff', lambda attempt: 0)
+    sent, received, urls = [], [], []
+    scripts = [
+        [json.dumps({'welcome': 'welcome\n', 'messages': [{'seq': 4, 'body': 'old'}]}),
+         'bar has joined the chat room'],
+        OSError('connection refused'),
+        [json.dumps({'welcome': 'welcome back\n', 'messages': []}),
+         json.dumps({'messages': [{'seq': 5, 'body': 'new'}]})],
+    ]
+
+    def connect(url):
+        urls.append(url)
+        script = scripts.pop(0)
+        if isinstance(script, Exception):
+            raise script
+        if not scripts:
+            session.close()
+        return FakeSocket(script, sent)
+
+    session = client.Session('wss://testdomain/test?username=foo', on_message=received.append, connect=connect)
+    asyncio.run(session.run())
+
+    assert len(urls) == 3
+    assert sent == [{'action': 'sendnotify', 'since': 0}, {'action': 'sendnotify', 'since': 4}]
+    assert received == ['welcome\nold', 'bar has joined the chat room', 'welcome back\n', 'new']
+    assert session.cursor == 5
+    assert session.reconnects == 2
+
+
+def test_session_gives_up(monkeypatch):
+    monkeypatch.setattr(client, 'backoff', lambda attempt: 0)
+
+    def connect(url):
+        raise OSError('connection refused')
+
+    session = client.Session('wss://testdomain/test?username=foo', connect=connect)
+    with pytest.raises(ConnectionError):
+        asyncio.run(session.run(max_attempts=3))
+    assert session.reconnects == 3
+
+
+def test_session_sends_outbox():
+    sent = []
+
+    class Socket(FakeSocket):
+        async def __anext__(self):
+            await asyncio.sleep(0.01)
+            raise ConnectionClosedOK(None, None)
+
+    async def run():
+        outbox = asyncio.Queue()
+        for message in ('a', 'b'):
+            outbox.put_nowait(message)
+
+        def connect(url):
+            session.close()
+            return Socket([], sent)
+
+        session = client.Session('wss://testdomain/test?username=foo', outbox=outbox, connect=connect)
+        await session.run()
+        return session
+
+    session = asyncio.run(run())
+    assert sent == [{'action': 'sendnotify', 'since': 0}, {'action': 'sendmessage', 'messages': ['a', 'b']}]
+    assert session.sent == 2
+
+
+def test_main_with_sessions(monkeypatch):
+    runner = CliRunner()
+    calls = []
+
+    async def mock_run_sessions(server_url, username, room, sessions, interval, encoding):
+        calls.append((server_url, username, room, sessions, interval, encoding))
+
+    monkeypatch.setattr(client, 'run_sessions', mock_run_sessions)
+    result = runner.invoke(client.main, ['--server-url', 'wss://testdomain/test', '--username', 'bot',
+                                         '--sessions', '200', '--interval', '1', '--encoding', 'msgpack'])
+
+    assert result.exit_code == 0
+    assert calls == [('wss://testdomain/test', 'bot', None, 200, 1.0, 'msgpack')]
+
+
+def test_history_chunks():
+    chunks = [json.dumps({'chunk': i, 'last': i == 2, 'messages': [{'seq': i + 1, 'body': str(i)}]}) for i in range(3)]
+    history = client.HistoryChunks()
+
+    assert history.add(chunks[1]) == []
+    assert history.add('foo has joined the chat room') == ['foo has joined the chat room']
+    assert history.add(chunks[0]) == chunks[:2]
+    assert history.add(chunks[2]) == chunks[2:]
+
+    # A new delivery after a reconnect starts at chunk 0 again
+    assert history.add(chunks[0]) == chunks[:1]
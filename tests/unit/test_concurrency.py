@@ -0,0 +1,165 @@
+import json
+import pytest
+import threading
+
+from botocore.exceptions import ClientError
+from chat_common import broadcast, concurrency, metrics
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubManagementApi(object):
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, Data, ConnectionId):
+        if ConnectionId in self.errors:
+            raise self.errors[ConnectionId]
+        with self.lock:
+            self.posted.append(ConnectionId)
+
+
+def client_error(code, status_code):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status_code}},
+        'PostToConnection'
+    )
+
+
+def connection_ids(count):
+    return [{'connectionId': {'S': f'conn-{i}='}} for i in range(count)]
+
+
+def test_throttle_halves_limit_once_per_round():
+    controller = concurrency.Controller(16, minimum=2)
+    tokens = [controller.acquire() for _ in range(3)]
+
+    for token in tokens:
+        controller.release(token, throttled=True)
+    assert controller.limit == 8
+
+    for _ in range(3):
+        controller.release(controller.acquire(), throttled=True)
+    assert controller.limit == 2
+
+
+def test_success_raises_limit_additively():
+    controller = concurrency.Controller(4)
+    controller.release(controller.acquire(), throttled=True)
+    assert controller.limit == 2
+
+    for _ in range(2):
+        controller.release(controller.acquire())
+    assert controller.limit == pytest.approx(2.9)
+
+    for _ in range(20):
+        controller.release(controller.acquire())
+    assert controller.limit == 4
+
+
+def test_acquire_waits_for_limit():
+    controller = concurrency.Controller(1)
+    token = controller.acquire()
+    acquired = threading.Event()
+
+    thread = threading.Thread(target=lambda: acquired.set() if controller.acquire() is not None else None)
+    thread.start()
+    assert not acquired.wait(0.05)
+
+    controller.release(token)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_circuit_opens_and_recovers():
+    clock = Clock()
+    controller = concurrency.Controller(4, failure_threshold=3, cooldown=10, clock=clock)
+
+    for _ in range(3):
+        controller.release(controller.acquire(), failed=True)
+    with pytest.raises(concurrency.CircuitOpen):
+        controller.acquire()
+    assert controller.snapshot() == {'concurrencyLimit': 4, 'circuitOpen': 1}
+
+    # After the cooldown a single probe call is let through, a failed probe opens the circuit again
+    clock.now = 10
+    token = controller.acquire()
+    with pytest.raises(concurrency.CircuitOpen):
+        controller.acquire()
+    controller.release(token, failed=True)
+    with pytest.raises(concurrency.CircuitOpen):
+        controller.acquire()
+
+    clock.now = 20
+    controller.release(controller.acquire())
+    assert controller.state == concurrency.CLOSED
+    assert controller.snapshot() == {'concurrencyLimit': 4, 'circuitOpen': 0}
+
+
+def test_success_resets_failures():
+    controller = concurrency.Controller(4, failure_threshold=2)
+
+    for _ in range(3):
+        controller.release(controller.acquire(), failed=True)
+        controller.release(controller.acquire())
+    assert controller.state == concurrency.CLOSED
+
+
+def test_throttled_probe_resets_failures():
+    clock = Clock()
+    controller = concurrency.Controller(4, failure_threshold=3, cooldown=10, clock=clock)
+
+    for _ in range(3):
+        controller.release(controller.acquire(), failed=True)
+    clock.now = 10
+    controller.release(controller.acquire(), throttled=True)
+    assert controller.state == concurrency.CLOSED
+
+    # A closed circuit needs a full run of failures again before it opens
+    for _ in range(2):
+        controller.release(controller.acquire(), failed=True)
+    assert controller.state == concurrency.CLOSED
+    controller.release(controller.acquire(), failed=True)
+    assert controller.state == concurrency.OPEN
+
+
+def test_send_to_all_adapts_and_sheds(capsys, monkeypatch):
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD', '2')
+    errors = {
+        'conn-0=': client_error('LimitExceededException', 429),
+        'conn-1=': client_error('BadRequestException', 400),
+    }
+    errors.update({f'conn-{i}=': client_error('InternalServerErrorException', 500) for i in range(2, 4)})
+    apig_management_client = StubManagementApi(errors=errors)
+
+    @metrics.instrumented('test')
+    def broadcast_twice():
+        first = broadcast.send_to_all(apig_management_client, connection_ids(4), 'hello', workers=1)
+        second = broadcast.send_to_all(apig_management_client, connection_ids(6)[4:], 'hello')
+        return first, second
+
+    first, second = broadcast_twice()
+
+    assert first.summary() == {'delivered': 0, 'gone': 0, 'throttled': 1, 'failed': 3}
+    # The controller is kept per client, its circuit opened during the first broadcast
+    assert second.summary() == {'delivered': 0, 'gone': 0, 'throttled': 0, 'failed': 2}
+    assert apig_management_client.posted == []
+    record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert record['shed'] == 2
+    assert record['circuitOpen'] == 1
+    assert record['concurrencyLimit'] == 1
+
+
+def test_controller_is_per_client():
+    first, second = StubManagementApi(), StubManagementApi()
+
+    assert concurrency.controller(first, 8) is concurrency.controller(first, 8)
+    assert concurrency.controller(first, 8) is not concurrency.controller(second, 8)
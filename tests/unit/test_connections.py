@@ -0,0 +1,326 @@
+import boto3
+import os
+import pytest
+import time
+
+from moto import mock_dynamodb2
+from chat_common import connections
+from chat_common.storage import dynamodb as dynamodb_storage
+from scripts import reset_connection_count
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'connectionId',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'connectionId',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        for i in range(60):
+            connections.register(dynamodb, f'conn-{i}=', f'user-{i}')
+        return dynamodb
+    return dynamodb_client
+
+
+def connection_items(ids, room='global'):
+    return [{'connectionId': {'S': connection_id}, 'room': {'S': room}} for connection_id in ids]
+
+
+@mock_dynamodb2
+def test_purge(use_moto, connections_stream):
+    ddb = connections_stream(use_moto())
+
+    unremoved = connections.purge(ddb, connection_items(f'conn-{i}=' for i in range(55)))
+
+    items = ddb.scan(TableName=os.environ.get('CONNECTION_TABLE_NAME'))['Items']
+    assert unremoved == []
+    assert sorted(item['connectionId']['S'] for item in items) == sorted(f'conn-{i}=' for i in range(55, 60))
+    assert connections.count(ddb) == 5
+
+
+@mock_dynamodb2
+def test_purge_after_unregister(use_moto, connections_stream):
+    ddb = connections_stream(use_moto())
+    connections.get_connections(ddb)
+
+    connections.unregister(ddb, 'conn-1=')
+    unremoved = connections.purge(ddb, connection_items(['conn-1=', 'conn-2=', 'conn-2=']))
+
+    assert unremoved == []
+    assert connections.count(ddb) == 58
+    assert len(connections.get_connections(ddb)) == 58
+
+
+@mock_dynamodb2
+def test_cache_survives_stream_lag(use_moto, monkeypatch):
+    ddb = use_moto()
+    connections.get_connections(ddb)
+
+    def mock_query(dynamodb, room):
+        raise AssertionError('the cache already left the removed connections out')
+
+    # Without the stream the live count still holds the removed connections
+    connections.unregister(ddb, 'conn-1=')
+    connections.purge(ddb, connection_items(['conn-2=']))
+    monkeypatch.setattr(connections, 'query', mock_query)
+
+    assert connections.count(ddb) == 60
+    assert len(connections.get_connections(ddb)) == 58
+    assert len(connections.get_connections(ddb, live=58)) == 58
+
+
+def test_purge_retries_unprocessed_items(monkeypatch):
+    monkeypatch.setattr(dynamodb_storage, 'BACKOFF_BASE', 0)
+    table_name = os.environ.get('CONNECTION_TABLE_NAME')
+    calls = []
+
+    class Struct(object):
+        def batch_write_item(self, RequestItems):
+            calls.append(RequestItems)
+            if len(calls) == 1:
+                return {'UnprocessedItems': {table_name: RequestItems[table_name][:2]}}
+            return {'UnprocessedItems': {}}
+
+    unremoved = connections.purge(Struct(), connection_items(f'conn-{i}=' for i in range(30)))
+
+    assert unremoved == []
+    assert [len(call[table_name]) for call in calls] == [25, 2, 5]
+
+
+def test_purge_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(dynamodb_storage, 'BACKOFF_BASE', 0)
+
+    class Struct(object):
+        def update_item(self, **kwargs):
+            raise AssertionError('the live count is taken down by the connections table stream')
+
+        def batch_write_item(self, RequestItems):
+            return {'UnprocessedItems': RequestItems}
+
+    unremoved = connections.purge(Struct(), connection_items(['conn-1=']))
+
+    assert unremoved == ['conn-1=']
+
+
+@mock_dynamodb2
+def test_get_connections_uses_cache(use_moto, monkeypatch):
+    ddb = use_moto()
+    scans = []
+    query = connections.query
+
+    def mock_query(dynamodb, room):
+        scans.append(room)
+        return query(dynamodb, room)
+
+    monkeypatch.setattr(connections, 'query', mock_query)
+
+    assert len(connections.get_connections(ddb)) == 60
+    assert len(connections.get_connections(ddb)) == 60
+    assert len(scans) == 1
+
+    # local registrations update the cache incrementally
+    connections.register(ddb, 'conn-new=', 'new')
+    assert len(connections.get_connections(ddb)) == 61
+    assert len(scans) == 1
+
+
+@mock_dynamodb2
+def test_get_connections_refreshes_when_count_changes(use_moto):
+    ddb = use_moto()
+    assert len(connections.get_connections(ddb)) == 60
+
+    # another container registers a connection
+    ddb.put_item(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        Item={'connectionId': {'S': 'conn-other='}, 'username': {'S': 'other'}, 'room': {'S': 'global'}}
+    )
+    connections.counters.add(ddb, connections.live_count(), 1)
+
+    assert len(connections.get_connections(ddb)) == 61
+
+
+@mock_dynamodb2
+def test_get_connections_refreshes_after_ttl(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('CONNECTION_CACHE_TTL', '0')
+    scans = []
+    query = connections.query
+
+    def mock_query(dynamodb, room):
+        scans.append(room)
+        return query(dynamodb, room)
+
+    monkeypatch.setattr(connections, 'query', mock_query)
+    connections.get_connections(ddb)
+    connections.get_connections(ddb)
+
+    assert len(scans) == 2
+
+
+@mock_dynamodb2
+def test_get_many(use_moto):
+    ddb = use_moto()
+    ddb.update_item(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        Key={'connectionId': {'S': 'conn-1='}},
+        UpdateExpression="SET #agent = :agent",
+        ExpressionAttributeNames={'#agent': 'agent'},
+        ExpressionAttributeValues={':agent': {'S': 'not read by the functions'}}
+    )
+
+    found = connections.get_many(ddb, [f'conn-{i}=' for i in range(150)] + ['conn-1=', 'conn-gone='])
+
+    assert sorted(found) == sorted(f'conn-{i}=' for i in range(60))
+    assert set(found['conn-1=']) == {'connectionId', 'username', 'room', 'connectedAt', 'expires'}
+    assert found['conn-1=']['username'] == {'S': 'user-1'}
+    assert connections.get(ddb, 'conn-gone=') is None
+
+
+@mock_dynamodb2
+def test_get_uses_cache(use_moto, monkeypatch):
+    ddb = use_moto()
+    connections.get_connections(ddb)
+
+    def mock_batch_get_item(RequestItems):
+        raise AssertionError('the connection is cached')
+
+    monkeypatch.setattr(ddb, 'batch_get_item', mock_batch_get_item)
+
+    assert connections.get(ddb, 'conn-7=')['username']['S'] == 'user-7'
+
+
+def test_get_many_retries_unprocessed_keys(monkeypatch):
+    monkeypatch.setattr(dynamodb_storage, 'BACKOFF_BASE', 0)
+    table_name = os.environ.get('CONNECTION_TABLE_NAME')
+    calls = []
+
+    class Struct(object):
+        def batch_get_item(self, RequestItems):
+            keys = RequestItems[table_name]['Keys']
+            calls.append(len(keys))
+            if len(calls) == 1:
+                return {'Responses': {table_name: connection_items(k['connectionId']['S'] for k in keys[2:])},
+                        'UnprocessedKeys': {table_name: dict(RequestItems[table_name], Keys=keys[:2])}}
+            return {'Responses': {table_name: connection_items(k['connectionId']['S'] for k in keys)}}
+
+    found = connections.get_many(Struct(), [f'conn-{i}=' for i in range(5)])
+
+    assert sorted(found) == [f'conn-{i}=' for i in range(5)]
+    assert calls == [5, 2]
+
+
+@mock_dynamodb2
+def test_unregister(use_moto, connections_stream):
+    ddb = connections_stream(use_moto())
+    connections.get_connections(ddb)
+
+    item = connections.unregister(ddb, 'conn-1=')
+
+    assert item['username']['S'] == 'user-1'
+    assert connections.count(ddb) == 59
+    assert 'conn-1=' not in [c['connectionId']['S'] for c in connections.get_connections(ddb)]
+    assert connections.unregister(ddb, 'conn-1=') is None
+    assert connections.count(ddb) == 59
+
+
+@mock_dynamodb2
+def test_expired_connections(use_moto, connections_stream):
+    ddb = connections_stream(use_moto())
+    connections.register(ddb, 'conn-old=', 'old', 'lobby', now=time.time() - connections.connection_ttl() - 1)
+    connections.register(ddb, 'conn-new=', 'new', 'lobby')
+
+    item = ddb.get_item(TableName=os.environ.get('CONNECTION_TABLE_NAME'), Key={'connectionId': {'S': 'conn-new='}})
+    assert int(item['Item']['expires']['N']) > time.time() + connections.connection_ttl() - 60
+    assert connections.get(ddb, 'conn-old=') is None
+    assert 'conn-old=' not in [c['connectionId']['S'] for c in connections.scan(ddb)]
+    assert connections.count(ddb, 'lobby') == 2
+
+    # The room read removes the connection the TTL has not reaped yet and takes it off the live count
+    assert [c['username']['S'] for c in connections.get_connections(ddb, 'lobby')] == ['new']
+    assert connections.count(ddb, 'lobby') == 1
+    assert connections.unregister(ddb, 'conn-old=') is None
+
+
+@mock_dynamodb2
+def test_reset_connection_count(use_moto):
+    ddb = use_moto()
+    connections.counters.add(ddb, connections.live_count(), 7)
+    ddb.put_item(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        Item={'connectionId': {'S': 'conn-legacy='}, 'username': {'S': 'legacy'}}
+    )
+    connections.register(ddb, 'conn-lobby=', 'lobby', 'lobby')
+
+    assert reset_connection_count.reset_connection_count(ddb) == {'global': 61, 'lobby': 1}
+    assert connections.count(ddb) == 61
+    assert len(connections.get_connections(ddb)) == 61
+
+
+@mock_dynamodb2
+def test_rooms(use_moto, connections_stream):
+    ddb = connections_stream(use_moto())
+    connections.register(ddb, 'conn-a=', 'alice', 'lobby')
+    connections.register(ddb, 'conn-b=', 'bob', 'lobby')
+    connections.register(ddb, 'conn-c=', 'carol', 'games')
+
+    lobby = connections.get_connections(ddb, 'lobby')
+    assert sorted(c['username']['S'] for c in lobby) == ['alice', 'bob']
+    assert connections.count(ddb, 'lobby') == 2
+    assert connections.count(ddb, 'games') == 1
+    assert connections.count(ddb) == 60
+
+    connections.purge(ddb, lobby[:1] + connections.get_connections(ddb, 'games'))
+
+    assert connections.count(ddb, 'lobby') == 1
+    assert connections.count(ddb, 'games') == 0
+    assert len(connections.get_connections(ddb, 'lobby')) == 1
@@ -0,0 +1,106 @@
+import boto3
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import counters
+from chat_common.storage import dynamodb as dynamodb_storage
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+        return dynamodb
+    return dynamodb_client
+
+
+@mock_dynamodb2
+def test_total_empty(use_moto):
+    ddb = use_moto()
+
+    assert counters.total(ddb, 'test') == 0
+
+
+@mock_dynamodb2
+def test_add_spreads_over_shards(use_moto):
+    ddb = use_moto()
+
+    for _ in range(40):
+        counters.add(ddb, 'test', 1)
+    counters.add(ddb, 'test', -5)
+
+    items = ddb.scan(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'))['Items']
+    assert counters.total(ddb, 'test') == 35
+    assert len(items) > 1
+    assert {item['myid']['S'] for item in items} <= {'test#0', 'test#1', 'test#2', 'test#3'}
+
+
+@mock_dynamodb2
+def test_shard_count(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('COUNTER_SHARDS', '2')
+
+    assert counters.shard_keys('test') == ['test#0', 'test#1']
+    counters.add(ddb, 'test', 3)
+    assert counters.total(ddb, 'test') == 3
+
+
+@mock_dynamodb2
+def test_totals(use_moto):
+    ddb = use_moto()
+    counters.add(ddb, 'test', 3)
+    counters.add(ddb, 'test#2', 4)
+
+    assert counters.totals(ddb, ['test', 'test#2', 'other']) == {'test': 3, 'test#2': 4, 'other': 0}
+
+
+def test_totals_retries_unprocessed_keys(monkeypatch):
+    monkeypatch.setattr(dynamodb_storage, 'BACKOFF_BASE', 0)
+    table_name = os.environ.get('MSG_COUNTER_TABLE_NAME')
+    calls = []
+
+    class Struct(object):
+        def batch_get_item(self, RequestItems):
+            keys = RequestItems[table_name]['Keys']
+            calls.append(len(keys))
+            items = [dict(key, count={'N': '1'}) for key in keys]
+            if len(calls) == 1:
+                return {'Responses': {table_name: items[1:]},
+                        'UnprocessedKeys': {table_name: dict(RequestItems[table_name], Keys=keys[:1])}}
+            return {'Responses': {table_name: items}}
+
+    assert counters.total(Struct(), 'messages') == 4
+    assert calls == [4, 1]
+
+
+def test_totals_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(dynamodb_storage, 'BACKOFF_BASE', 0)
+    calls = []
+
+    class Struct(object):
+        def batch_get_item(self, RequestItems):
+            calls.append(RequestItems)
+            return {'Responses': {}, 'UnprocessedKeys': RequestItems}
+
+    with pytest.raises(RuntimeError):
+        counters.total(Struct(), 'messages')
+    assert len(calls) == dynamodb_storage.MAX_ATTEMPTS
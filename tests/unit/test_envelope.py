@@ -0,0 +1,96 @@
+import json
+import msgpack
+import pytest
+
+from chat_common import envelope
+
+
+def test_validate():
+    assert envelope.validate(None) == 'json'
+    assert envelope.validate('msgpack') == 'msgpack'
+
+    with pytest.raises(ValueError):
+        envelope.validate('xml')
+
+
+def test_of():
+    assert envelope.of({'connectionId': {'S': 'abc123='}}) == 'json'
+    assert envelope.of({'connectionId': {'S': 'abc123='}, 'encoding': {'S': 'msgpack'}}) == 'msgpack'
+
+
+def test_create_and_format():
+    message = envelope.create(7, 'lobby', 'foo', 'hello', 1612770838.718373)
+
+    assert message == {'seq': 7, 'room': 'lobby', 'sender': 'foo', 'timestamp': 1612770838718, 'body': 'hello'}
+    assert envelope.format(message).endswith(' foo] hello')
+
+
+def test_from_item():
+    item = {'myid': {'S': 'lobby#slot#7'}, 'room': {'S': 'lobby'}, 'seq': {'N': '7'},
+            'timestamp': {'N': '1612770838.718373'}, 'sender': {'S': 'foo'}, 'body': {'S': 'hello'}}
+
+    assert envelope.from_item(item) == envelope.create(7, 'lobby', 'foo', 'hello', 1612770838.718373)
+
+
+def test_from_legacy_item():
+    item = {'myid': {'S': 'slot#1'}, 'seq': {'N': '1'}, 'timestamp': {'N': '1612770838.718373'},
+            'data': {'S': '[2021-02-08 07:53:58 Zaki] test 1'}}
+
+    message = envelope.from_item(item)
+    assert message['body'] == '[2021-02-08 07:53:58 Zaki] test 1'
+    assert envelope.format(message) == '[2021-02-08 07:53:58 Zaki] test 1'
+
+
+def test_frame_encodes_once(monkeypatch):
+    calls = []
+    encode = envelope.encode
+
+    def counting_encode(content, encoding='json'):
+        calls.append(encoding)
+        return encode(content, encoding)
+
+    monkeypatch.setattr(envelope, 'encode', counting_encode)
+    frame = envelope.messages([envelope.create(1, 'global', 'foo', 'hello', 0)], welcome='hi')
+
+    payloads = [frame.encoded(encoding) for encoding in ('json', 'msgpack', 'json', 'msgpack')]
+
+    assert calls == ['json', 'msgpack']
+    assert json.loads(payloads[0]) == frame.content
+    assert msgpack.unpackb(payloads[1], raw=False) == frame.content
+    assert len(payloads[1]) < len(payloads[0])
+
+
+@pytest.mark.parametrize('encoding, decode', [
+    ('json', json.loads),
+    ('msgpack', lambda data: msgpack.unpackb(data, raw=False)),
+])
+def test_chunks(encoding, decode):
+    messages = [envelope.create(seq, 'global', 'foo', 'x' * 100, 1612770838.718) for seq in range(1, 201)]
+
+    chunks = list(envelope.chunks(messages, encoding, limit=2048, welcome='hi'))
+
+    assert all(len(chunk) <= 2048 for chunk in chunks)
+    frames = [decode(chunk) for chunk in chunks]
+    assert len(frames) > 1
+    assert [frame['chunk'] for frame in frames] == list(range(len(frames)))
+    assert [frame['last'] for frame in frames] == [False] * (len(frames) - 1) + [True]
+    assert frames[0]['welcome'] == 'hi'
+    assert all('welcome' not in frame for frame in frames[1:])
+    assert [m for frame in frames for m in frame['messages']] == messages
+
+
+def test_chunks_empty():
+    assert [json.loads(chunk) for chunk in envelope.chunks([], welcome='hi')] == [
+        {'welcome': 'hi', 'chunk': 0, 'last': True, 'messages': []}
+    ]
+
+
+def test_text_chunks():
+    lines = [f'line {i} ' + 'é' * 20 for i in range(100)]
+
+    chunks = list(envelope.text_chunks('Welcome\n\n', lines, limit=256))
+
+    assert all(len(chunk.encode('utf-8')) <= 256 for chunk in chunks)
+    assert chunks[0].startswith('Welcome\n\nline 0 ')
+    assert '\n'.join(chunks) == 'Welcome\n\n' + '\n'.join(lines)
+    assert list(envelope.text_chunks('Welcome\n\n', [])) == ['Welcome\n\n']
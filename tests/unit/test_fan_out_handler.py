@@ -0,0 +1,182 @@
+import boto3
+import json
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import connections, fanout
+from fan_out import handler
+from on_disconnect import handler as on_disconnect_handler
+from send_message import handler as send_message_handler
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'connectionId',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'connectionId',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        for i in range(5):
+            connections.register(dynamodb, f'conn-{i}=', f'user-{i}')
+        return dynamodb
+    return dynamodb_client
+
+
+class StubManagementApi(object):
+    def __init__(self, gone=()):
+        self.gone = gone
+        self.posted = []
+
+    def post_to_connection(self, Data, ConnectionId):
+        if ConnectionId in self.gone:
+            raise GoneError()
+        self.posted.append((ConnectionId, Data))
+
+
+class GoneError(Exception):
+    response = {'Error': {'Code': 'GoneException'}, 'ResponseMetadata': {'HTTPStatusCode': 410}}
+
+
+@mock_dynamodb2
+def test_handle(use_moto, mocker, connections_stream, monkeypatch, local_queue, capsys):
+    ddb = connections_stream(use_moto())
+    monkeypatch.setenv('FANOUT_BATCH_SIZE', '2')
+    apig_management_client = StubManagementApi(gone=('conn-3=',))
+    local_queue.send_message(
+        QueueUrl=os.environ.get('FANOUT_QUEUE_URL'),
+        MessageBody=json.dumps({'endpointUrl': 'https://testdomain/test', 'data': 'hello'})
+    )
+
+    result = handler.handle(local_queue.event(), mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client)
+
+    assert sorted(c for c, _ in apig_management_client.posted) == ['conn-0=', 'conn-1=', 'conn-2=', 'conn-4=']
+    assert [batch['size'] for batch in result['batches']] == [2, 2, 1]
+    assert sum(batch['gone'] for batch in result['batches']) == 1
+    assert connections.count(ddb) == 4
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert [line['batch'] for line in lines if line.get('metric') == 'fanout_batch'] == [0, 1, 2]
+
+
+@mock_dynamodb2
+def test_send_message_to_fan_out(use_moto, apigw_event, mocker, monkeypatch, local_queue):
+    ddb = use_moto()
+    apig_management_client = StubManagementApi()
+    apigw_event['requestContext']['connectionId'] = 'conn-0='
+    apigw_event['body'] = '{"message": "Hello world..."}'
+    monkeypatch.setattr(send_message_handler, 'store_messages',
+                        lambda messages, dynamodb=None, room=None, sender=None, timestamp=None: [1])
+
+    send_message_handler.handle(apigw_event, mocker, dynamodb=ddb, sqs=local_queue)
+    assert apig_management_client.posted == []
+    assert local_queue.groups == ['global']
+
+    handler.handle(local_queue.event(), mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client)
+    assert len(apig_management_client.posted) == 5
+    for _, data in apig_management_client.posted:
+        [message] = json.loads(data)['messages']
+        assert message['seq'] == 1
+        assert message['sender'] == 'user-0'
+        assert message['body'] == 'Hello world...'
+
+
+@mock_dynamodb2
+def test_presence_window(use_moto, apigw_event, mocker, local_queue):
+    ddb = use_moto()
+    apig_management_client = StubManagementApi()
+    for connection_id in ('conn-3=', 'conn-4='):
+        apigw_event['requestContext']['connectionId'] = connection_id
+        on_disconnect_handler.handle(apigw_event, mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client,
+                                     sqs=local_queue)
+    connections.register(ddb, 'conn-5=', 'user-4')
+    handler.presence.record(ddb, local_queue, 'https://testdomain/test', 'global', 'user-4', handler.presence.JOINED)
+    handler.presence.record(ddb, local_queue, 'https://testdomain/test', 'global', 'new', handler.presence.JOINED)
+
+    # Only the first leave opened the window and queued its flush
+    assert apig_management_client.posted == []
+    assert local_queue.delays == [2]
+
+    handler.handle(local_queue.event(), mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client)
+    assert sorted(c for c, _ in apig_management_client.posted) == ['conn-0=', 'conn-1=', 'conn-2=', 'conn-5=']
+    assert {data for _, data in apig_management_client.posted} == {'new has joined and user-3 has left the chat room'}
+
+    # A window whose joins and leaves cancel out is not announced
+    apig_management_client.posted = []
+    handler.presence.record(ddb, local_queue, 'https://testdomain/test', 'global', 'user-0', handler.presence.LEFT)
+    handler.presence.record(ddb, local_queue, 'https://testdomain/test', 'global', 'user-0', handler.presence.JOINED)
+    handler.handle(local_queue.event(), mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client)
+    assert apig_management_client.posted == []
+
+
+@mock_dynamodb2
+def test_failed_record_is_delivered_again_with_the_rest(use_moto, mocker, monkeypatch, local_queue):
+    ddb = use_moto()
+    apig_management_client = StubManagementApi()
+    for room in ('global', 'broken', 'global'):
+        fanout.enqueue(local_queue, 'https://testdomain/test', f'hello {room}', room)
+    event = local_queue.event()
+    get_connections = connections.get_connections
+
+    def mock_get_connections(dynamodb, room):
+        if room == 'broken':
+            raise RuntimeError('throttled')
+        return get_connections(dynamodb, room)
+
+    monkeypatch.setattr(connections, 'get_connections', mock_get_connections)
+
+    result = handler.handle(event, mocker, dynamodb=ddb, apigatewaymanagementapi=apig_management_client)
+
+    assert result['batchItemFailures'] == [{'itemIdentifier': '2'}, {'itemIdentifier': '3'}]
+    assert {data for _, data in apig_management_client.posted} == {'hello global'}
+    assert len(apig_management_client.posted) == 5
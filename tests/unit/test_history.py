@@ -0,0 +1,196 @@
+import boto3
+import os
+import pytest
+import time
+
+from moto import mock_dynamodb2
+from chat_common import history
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MESSAGE_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'seq',
+                    'AttributeType': 'N'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'history-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'seq',
+                            'KeyType': 'RANGE'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+        return dynamodb
+    return dynamodb_client
+
+
+@mock_dynamodb2
+def test_next_sequence(use_moto):
+    ddb = use_moto()
+
+    assert [history.next_sequence(ddb) for _ in range(3)] == [1, 2, 3]
+
+
+@mock_dynamodb2
+def test_store_wraps_around_slots(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '3')
+
+    seqs = [history.store(ddb, f'message {i}') for i in range(4)]
+
+    result = ddb.get_item(TableName=os.environ.get('MESSAGE_TABLE_NAME'), Key={'myid': {'S': 'global#slot#1'}})
+    assert seqs == [1, 2, 3, 4]
+    assert result['Item']['seq']['N'] == '4'
+    assert result['Item']['body']['S'] == 'message 3'
+
+
+@mock_dynamodb2
+def test_store_does_not_overwrite_newer_message(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '3')
+    sequences = iter([4, 1])
+    monkeypatch.setattr(history, 'next_sequence', lambda dynamodb, room: next(sequences))
+
+    # the writer holding sequence 1 finishes after the writer holding sequence 4
+    history.store(ddb, 'newer message')
+    history.store(ddb, 'older message')
+
+    result = ddb.get_item(TableName=os.environ.get('MESSAGE_TABLE_NAME'), Key={'myid': {'S': 'global#slot#1'}})
+    assert result['Item']['body']['S'] == 'newer message'
+
+
+@mock_dynamodb2
+def test_latest(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '3')
+
+    for i in range(12):
+        history.store(ddb, f'message {i}')
+
+    messages = history.latest(ddb)
+    assert [m['body']['S'] for m in messages] == ['message 9', 'message 10', 'message 11']
+    assert [m['body']['S'] for m in history.latest(ddb, limit=2)] == ['message 10', 'message 11']
+
+
+@mock_dynamodb2
+def test_latest_empty(use_moto):
+    ddb = use_moto()
+
+    assert history.latest(ddb) == []
+
+
+@mock_dynamodb2
+def test_store_many(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '3')
+    history.store(ddb, 'message 0')
+
+    assert history.store_many(ddb, [f'message {i}' for i in range(1, 6)]) == [2, 3, 4, 5, 6]
+    assert [m['body']['S'] for m in history.latest(ddb)] == ['message 3', 'message 4', 'message 5']
+    assert history.next_sequence(ddb) == 7
+
+
+@mock_dynamodb2
+def test_latest_since(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '3')
+
+    for i in range(1, 8):
+        history.store(ddb, f'message {i}')
+
+    assert [history.cursor(m) for m in history.latest(ddb, since=5)] == [6, 7]
+    assert [history.cursor(m) for m in history.latest(ddb, since=1)] == [5, 6, 7]
+    assert history.latest(ddb, since=7) == []
+
+
+@mock_dynamodb2
+def test_latest_skips_expired(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_TTL', '60')
+    now = time.time()
+
+    monkeypatch.setattr(time, 'time', lambda: now - 120)
+    history.store(ddb, 'expired')
+    monkeypatch.setattr(time, 'time', lambda: now)
+    history.store(ddb, 'current')
+
+    item = ddb.get_item(TableName=os.environ.get('MESSAGE_TABLE_NAME'), Key={'myid': {'S': 'global#slot#2'}})['Item']
+    assert item['expires'] == {'N': str(int(now) + 60)}
+    assert [m['body']['S'] for m in history.latest(ddb)] == ['current']
+
+
+@mock_dynamodb2
+def test_store_without_ttl(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_TTL', '0')
+
+    history.store(ddb, 'kept')
+
+    assert 'expires' not in history.latest(ddb)[0]
+
+
+def test_latest_reads_pages():
+    pages = [
+        {'Items': [{'seq': {'N': '9'}}, {'seq': {'N': '8'}}], 'LastEvaluatedKey': {'seq': {'N': '8'}}},
+        {'Items': [{'seq': {'N': '7'}}]},
+    ]
+    calls = []
+
+    class Struct(object):
+        def query(self, **kwargs):
+            calls.append(kwargs)
+            return pages[len(calls) - 1]
+
+    assert [history.cursor(m) for m in history.latest(Struct(), limit=5)] == [7, 8, 9]
+    assert [call['Limit'] for call in calls] == [5, 3]
+    assert calls[1]['ExclusiveStartKey'] == {'seq': {'N': '8'}}
@@ -0,0 +1,106 @@
+import boto3
+import json
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import metrics
+
+
+def lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+
+
+def test_instrumented_emits_one_line(capsys):
+    @metrics.instrumented('test_function')
+    def handle(event, context):
+        with metrics.phase('store'):
+            pass
+        with metrics.phase('broadcast'):
+            metrics.count('delivered', 3)
+        with metrics.phase('broadcast'):
+            metrics.count('delivered', 2)
+        return {}
+
+    assert handle({}, None) == {}
+
+    [line] = lines(capsys)
+    assert line['function'] == 'test_function'
+    assert line['delivered'] == 5
+    assert set(line) >= {'durationMs', 'storeMs', 'broadcastMs'}
+    definition = line['_aws']['CloudWatchMetrics'][0]
+    assert definition['Namespace'] == 'SimpleChat'
+    assert definition['Dimensions'] == [['function']]
+    assert {'Name': 'storeMs', 'Unit': 'Milliseconds'} in definition['Metrics']
+    assert {'Name': 'delivered', 'Unit': 'Count'} in definition['Metrics']
+    assert metrics.current() is None
+
+
+def test_instrumented_records_error(capsys):
+    @metrics.instrumented('test_function')
+    def handle(event, context):
+        raise KeyError('username')
+
+    with pytest.raises(KeyError):
+        handle({}, None)
+
+    [line] = lines(capsys)
+    assert line['error'] == 'KeyError'
+    assert metrics.current() is None
+
+
+def test_instrumented_disabled(capsys, monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', 'false')
+
+    @metrics.instrumented('test_function')
+    def handle(event, context):
+        with metrics.phase('store'):
+            return {}
+
+    assert handle({}, None) == {}
+    assert lines(capsys) == []
+
+
+@mock_dynamodb2
+def test_instrument_counts_aws_calls(capsys):
+    dynamodb = metrics.instrument(boto3.client('dynamodb'))
+    dynamodb.create_table(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        KeySchema=[
+            {
+                'AttributeName': 'connectionId',
+                'KeyType': 'HASH'
+            },
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'connectionId',
+                'AttributeType': 'S'
+            },
+        ],
+    )
+
+    @metrics.instrumented('test_function')
+    def handle(event, context):
+        for connection_id in ('a', 'b'):
+            dynamodb.get_item(
+                TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+                Key={'connectionId': {'S': connection_id}}
+            )
+        dynamodb.scan(TableName=os.environ.get('CONNECTION_TABLE_NAME'))
+        return {}
+
+    handle({}, None)
+
+    [line] = lines(capsys)
+    assert line['dynamodb.GetItem'] == 2
+    assert line['dynamodb.Scan'] == 1
+    assert 'dynamodb.CreateTable' not in line
+
+
+def test_instrument_ignores_stubs():
+    class Struct(object):
+        pass
+
+    stub = Struct()
+    assert metrics.instrument(stub) is stub
@@ -0,0 +1,158 @@
+import boto3
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import counters, history
+from scripts import migrate_messages
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the legacy table keyed by (myid, timestamp)
+        dynamodb.create_table(
+            TableName='LegacyMessageTable',
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': 'timestamp',
+                    'KeyType': 'RANGE'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'timestamp',
+                    'AttributeType': 'N'
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MESSAGE_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'seq',
+                    'AttributeType': 'N'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'history-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'seq',
+                            'KeyType': 'RANGE'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        # timestamps 9.5 and 10.5 sort differently as strings and as numbers
+        for i, timestamp in enumerate(['8.5', '9.5', '10.5', '11.5']):
+            dynamodb.put_item(
+                TableName='LegacyMessageTable',
+                Item={'myid': {'S': f'uuid-{i}'},
+                      'timestamp': {'N': timestamp},
+                      'data': {'S': f'test {i}'}}
+            )
+        return dynamodb
+    return dynamodb_client
+
+
+@mock_dynamodb2
+def test_migrate(use_moto):
+    ddb = use_moto()
+
+    count = migrate_messages.migrate(
+        ddb, 'LegacyMessageTable', os.environ.get('MESSAGE_TABLE_NAME'), os.environ.get('MSG_COUNTER_TABLE_NAME'), 3
+    )
+
+    assert count == 3
+    assert [m['data']['S'] for m in history.latest(ddb)] == ['test 1', 'test 2', 'test 3']
+    assert history.next_sequence(ddb) == 4
+
+
+@mock_dynamodb2
+def test_upgrade_ring(use_moto):
+    ddb = use_moto()
+    ddb.put_item(
+        TableName=os.environ.get('MESSAGE_TABLE_NAME'),
+        Item={'myid': {'S': 'slot#1'}, 'seq': {'N': '1'}, 'timestamp': {'N': '8.5'}, 'data': {'S': 'test 1'}}
+    )
+    ddb.put_item(
+        TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+        Item={'myid': {'S': 'sequence'}, 'seq': {'N': '1'}}
+    )
+
+    count = migrate_messages.upgrade_ring(
+        ddb, os.environ.get('MESSAGE_TABLE_NAME'), os.environ.get('MSG_COUNTER_TABLE_NAME')
+    )
+
+    items = ddb.scan(TableName=os.environ.get('MESSAGE_TABLE_NAME'))['Items']
+    assert count == 1
+    assert [item['myid']['S'] for item in items] == ['global#slot#1']
+    assert [m['data']['S'] for m in history.latest(ddb)] == ['test 1']
+    assert history.next_sequence(ddb) == 2
+
+
+@mock_dynamodb2
+def test_migrate_message_count(use_moto):
+    ddb = use_moto()
+    ddb.put_item(
+        TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+        Item={'myid': {'S': 'counter'}, 'msgCount': {'N': '42'}}
+    )
+    counters.add(ddb, counters.MESSAGE_COUNT, 3)
+
+    assert migrate_messages.migrate_message_count(ddb, os.environ.get('MSG_COUNTER_TABLE_NAME')) == 42
+    assert migrate_messages.migrate_message_count(ddb, os.environ.get('MSG_COUNTER_TABLE_NAME')) == 0
+    assert counters.total(ddb, counters.MESSAGE_COUNT) == 45
@@ -3,6 +3,7 @@ import os
 import pytest
 
 from moto import mock_dynamodb2
+from chat_common import connections
 from on_connect import handler
 
 
@@ -26,6 +27,40 @@ def use_moto():
                     'AttributeName': 'connectionId',
                     'AttributeType': 'S'
                 },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
             ],
         )
         return dynamodb
@@ -46,6 +81,7 @@ def test_handle(apigw_event, mocker, use_moto):
 
     assert result['Item']['connectionId']['S'] == connection_id
     assert result['Item']['username']['S'] == 'foo'
+    assert connections.count(ddb) == 1
 
 
 @mock_dynamodb2
@@ -56,3 +92,36 @@ def test_handle_with_exception(use_moto, mocker):
         handler.handle('', mocker)
 
     assert e.type.__name__ == 'TypeError'
+
+
+@mock_dynamodb2
+def test_handle_with_room(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    apigw_event['queryStringParameters'] = {'username': 'foo', 'room': 'lobby'}
+    handler.handle(apigw_event, mocker)
+
+    assert [c['username']['S'] for c in connections.get_connections(ddb, 'lobby')] == ['foo']
+    assert connections.count(ddb, 'lobby') == 1
+    assert connections.count(ddb) == 0
+
+
+@mock_dynamodb2
+def test_handle_with_invalid_room(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    apigw_event['queryStringParameters'] = {'username': 'foo', 'room': 'no spaces allowed'}
+
+    assert handler.handle(apigw_event, mocker)['statusCode'] == 400
+    assert connections.scan(ddb) == []
+
+
+@mock_dynamodb2
+def test_handle_with_encoding(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    apigw_event['queryStringParameters'] = {'username': 'foo', 'encoding': 'msgpack'}
+    handler.handle(apigw_event, mocker)
+
+    [item] = connections.scan(ddb)
+    assert item['encoding']['S'] == 'msgpack'
+
+    apigw_event['queryStringParameters'] = {'username': 'foo', 'encoding': 'xml'}
+    assert handler.handle(apigw_event, mocker)['statusCode'] == 400
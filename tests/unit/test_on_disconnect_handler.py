@@ -3,6 +3,7 @@ import os
 import pytest
 
 from moto import mock_dynamodb2
+from chat_common import connections
 from on_disconnect import handler
 
 
@@ -26,37 +27,74 @@ def use_moto():
                     'AttributeName': 'connectionId',
                     'AttributeType': 'S'
                 },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
             ],
         )
 
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}}
+            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}}
         )
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
+        )
+        dynamodb.put_item(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            Item={'myid': {'S': 'connections:global#0'}, 'count': {'N': '2'}}
         )
         return dynamodb
     return dynamodb_client
 
 
 @mock_dynamodb2
-def test_handle(apigw_event, mocker, use_moto, monkeypatch):
-    ddb = use_moto()
+def test_handle(apigw_event, mocker, use_moto, monkeypatch, connections_stream):
+    ddb = connections_stream(use_moto())
 
-    def mock_return(apig_management_client, connection_ids, data):
+    def mock_return(dynamodb, apig_management_client, connection_ids, data):
         expected_connection_ids = [
-            {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-            {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+            {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
         ]
 
         assert data == 'foo has left the chat room'
         assert connection_ids == expected_connection_ids
         return None
 
-    monkeypatch.setattr(handler, "send_to_all", mock_return)
-    handler.handle(apigw_event, mocker)
+    monkeypatch.setattr(connections, "send_to_all", mock_return)
+    handler.handle(apigw_event, mocker, dynamodb=ddb)
 
     connection_id = 'abc123='
     result = ddb.get_item(
@@ -66,22 +104,18 @@ def test_handle(apigw_event, mocker, use_moto, monkeypatch):
 
     # assert data deleted
     assert not(result.get('Item', None))
+    assert connections.count(ddb) == 1
 
 
 @mock_dynamodb2
-def test_send_to_all(use_moto, monkeypatch):
+def test_handle_unknown_connection(apigw_event, mocker, use_moto, monkeypatch):
     ddb = use_moto()
-    connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
-    ]
-    data = 'foo has left the chat room'
-
-    def mock_post_to_connection(Data, ConnectionId):
-        assert Data == data
-        assert ConnectionId == connection_ids[0]['connectionId']['S'] or ConnectionId == connection_ids[1]['connectionId']['S']
-        return None
+    apigw_event['requestContext']['connectionId'] = 'unknown='
+
+    def mock_return(dynamodb, apig_management_client, connection_ids, data):
+        raise AssertionError('nothing should be broadcast')
+
+    monkeypatch.setattr(connections, "send_to_all", mock_return)
+    handler.handle(apigw_event, mocker)
 
-    apig_management_client = boto3.client('apigatewaymanagementapi')
-    monkeypatch.setattr(apig_management_client, 'post_to_connection', mock_post_to_connection)
-    handler.send_to_all(apig_management_client, connection_ids, data)
+    assert connections.count(ddb) == 2
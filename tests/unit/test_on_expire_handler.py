@@ -0,0 +1,70 @@
+import boto3
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import connections
+from on_expire import handler
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        for room, count in (('global', 3), ('lobby', 2)):
+            dynamodb.put_item(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+                              Item={'myid': {'S': f"{connections.live_count(room)}#0"}, 'count': {'N': str(count)}})
+        return dynamodb
+    return dynamodb_client
+
+
+def remove_record(connection_id, room, principal_id=handler.TTL_PRINCIPAL):
+    record = {
+        'eventName': 'REMOVE',
+        'dynamodb': {'OldImage': {'connectionId': {'S': connection_id}, 'username': {'S': 'foo'}, 'room': {'S': room}}}
+    }
+    if principal_id:
+        record['userIdentity'] = {'type': 'Service', 'principalId': principal_id}
+    return record
+
+
+@mock_dynamodb2
+def test_handle(use_moto, mocker):
+    ddb = use_moto()
+    event = {'Records': [
+        remove_record('conn-0=', 'global'),
+        remove_record('conn-1=', 'global'),
+        remove_record('conn-2=', 'lobby'),
+        # Deletes of $disconnect and purge are counted here too
+        remove_record('conn-3=', 'lobby', principal_id=None),
+        {'eventName': 'INSERT', 'dynamodb': {'NewImage': {'connectionId': {'S': 'conn-4='}}}},
+    ]}
+
+    assert handler.handle(event, mocker, dynamodb=ddb) == {'removed': 4, 'reaped': 3}
+    assert connections.count(ddb, 'global') == 1
+    assert connections.count(ddb, 'lobby') == 0
+
+
+def test_handle_without_deletes(mocker):
+    event = {'Records': [{'eventName': 'MODIFY', 'dynamodb': {'OldImage': {'connectionId': {'S': 'conn-0='}}}}]}
+
+    assert handler.handle(event, mocker, dynamodb=object()) == {'removed': 0, 'reaped': 0}
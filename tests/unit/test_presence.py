@@ -0,0 +1,95 @@
+import boto3
+import json
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import presence
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+        return dynamodb
+    return dynamodb_client
+
+
+def test_enabled(monkeypatch, local_queue):
+    assert presence.enabled()
+    monkeypatch.setenv('PRESENCE_WINDOW', '0')
+    assert not presence.enabled()
+
+
+def test_disabled_without_queue():
+    assert not presence.enabled()
+
+
+def test_text():
+    assert presence.text(['foo'], []) == 'foo has joined the chat room'
+    assert presence.text([], ['foo']) == 'foo has left the chat room'
+    assert presence.text([f'user-{i}' for i in range(12)], ['a', 'b', 'c']) == \
+        '12 users joined and 3 users left the chat room'
+
+
+@mock_dynamodb2
+def test_record_and_flush(use_moto, monkeypatch, local_queue):
+    ddb = use_moto()
+    monkeypatch.setenv('PRESENCE_WINDOW', '5')
+
+    opened = [presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', f'user-{i}', presence.JOINED)
+              for i in range(100)]
+    for i in range(50):
+        presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', f'user-{i}', presence.LEFT)
+    presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', 'gone', presence.LEFT)
+
+    assert opened == [True] + [False] * 99
+    assert local_queue.delays == [5]
+    assert json.loads(local_queue.messages[0]) == {'endpointUrl': 'https://testdomain/test', 'room': 'lobby',
+                                                   'presence': True}
+    assert presence.flush(ddb, 'lobby') == '50 users joined and gone has left the chat room'
+
+    # The flush closed the window, the next event opens a new one
+    assert presence.flush(ddb, 'lobby') is None
+    assert presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', 'late', presence.JOINED)
+    assert len(local_queue.delays) == 2
+
+
+class FailingQueue(object):
+    def send_message(self, **kwargs):
+        raise RuntimeError('queue unavailable')
+
+
+@mock_dynamodb2
+def test_lost_flush_is_queued_again(use_moto, monkeypatch, local_queue):
+    ddb = use_moto()
+    monkeypatch.setenv('PRESENCE_WINDOW', '5')
+
+    with pytest.raises(RuntimeError):
+        presence.record(ddb, FailingQueue(), 'https://testdomain/test', 'lobby', 'foo', presence.JOINED, now=100)
+    # The window is left stale, the next event queues its flush right away
+    assert presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', 'bar', presence.JOINED, now=101)
+    assert not presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', 'baz', presence.JOINED, now=102)
+    assert local_queue.delays == [0]
+
+    # A flush that never arrived, the window has been open for twice PRESENCE_WINDOW
+    assert presence.record(ddb, local_queue, 'https://testdomain/test', 'lobby', 'qux', presence.JOINED, now=111)
+    assert local_queue.delays == [0, 0]
+    assert presence.flush(ddb, 'lobby') == '4 users joined the chat room'
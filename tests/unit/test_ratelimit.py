@@ -0,0 +1,157 @@
+import boto3
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import connections, ratelimit
+from chat_common.storage.sqlite import SQLiteStorage
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+        return dynamodb
+    return dynamodb_client
+
+
+@mock_dynamodb2
+def test_acquire_burst_then_refill(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '2')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '3')
+
+    assert [ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', now=100.0) for _ in range(3)] == [0, 0, 0]
+    assert ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', now=100.0) == pytest.approx(0.5)
+    assert ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', now=100.5) == 0
+    assert ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', now=100.5) == pytest.approx(0.5)
+
+
+@mock_dynamodb2
+def test_acquire_shared_between_containers(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_ROOM_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_ROOM_BURST', '2')
+
+    assert ratelimit.acquire(ddb, ratelimit.ROOM, 'lobby', now=100.0) == 0
+    # A second container with its own copy of the bucket
+    copy = dict(ratelimit._buckets)
+    assert ratelimit.acquire(ddb, ratelimit.ROOM, 'lobby', now=100.0) == 0
+    ratelimit._buckets.clear()
+    ratelimit._buckets.update(copy)
+
+    # The stale copy still shows a token, the conditional update fails and the bucket is read again
+    assert ratelimit.acquire(ddb, ratelimit.ROOM, 'lobby', now=100.0) == pytest.approx(1)
+
+
+@mock_dynamodb2
+def test_empty_bucket_rejects_without_ddb(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '1')
+    ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', now=100.0)
+
+    class Struct(object):
+        pass
+
+    assert ratelimit.acquire(Struct(), ratelimit.CONNECTION, 'abc123=', now=100.1) == pytest.approx(0.9)
+
+
+@mock_dynamodb2
+def test_disabled(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '0')
+
+    assert all(ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=') == 0 for _ in range(20))
+    assert ddb.scan(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'))['Items'] == []
+
+
+@mock_dynamodb2
+def test_check(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '10')
+    monkeypatch.setenv('RATE_LIMIT_ROOM_BURST', '2')
+
+    assert ratelimit.check(ddb, 'abc123=', 'lobby') is None
+    assert ratelimit.check(ddb, 'def123=', 'lobby') is None
+    reply = ratelimit.check(ddb, 'ghi123=', 'lobby')
+    assert reply['error'] == 'throttled'
+    assert reply['scope'] == 'room'
+    assert reply['retryAfter'] > 0
+
+
+def test_batches_do_not_exceed_rate(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '5')
+    sqlite = SQLiteStorage(':memory:')
+
+    # A batch of 25 every 5 seconds for 10 minutes
+    accepted = 0
+    for second in range(0, 600, 5):
+        if ratelimit.acquire(sqlite, ratelimit.CONNECTION, 'abc123=', cost=25, now=100.0 + second) == 0:
+            accepted += 25
+
+    # 1 message per second, at most one bucket and the debt of the last batch above it
+    assert 600 - 25 <= accepted <= 600 + 5 + 20
+    # The last batch at 675 left the bucket 20 tokens in debt
+    assert ratelimit.acquire(sqlite, ratelimit.CONNECTION, 'abc123=', now=695.0) == pytest.approx(1)
+
+
+@mock_dynamodb2
+def test_room_rejection_gives_connection_tokens_back(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '3')
+    monkeypatch.setenv('RATE_LIMIT_ROOM_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_ROOM_BURST', '2')
+
+    assert ratelimit.check(ddb, 'abc123=', 'lobby', cost=2) is None
+    assert ratelimit.check(ddb, 'abc123=', 'lobby')['scope'] == ratelimit.ROOM
+    assert ratelimit.check(ddb, 'abc123=', 'lobby')['scope'] == ratelimit.ROOM
+
+    # Both rejected sends left the sender's last token in its bucket
+    assert ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=') == 0
+
+
+@mock_dynamodb2
+def test_bucket_expires_once_refilled(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '2')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '3')
+
+    ratelimit.acquire(ddb, ratelimit.CONNECTION, 'abc123=', cost=3, now=100.0)
+
+    item = ddb.get_item(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+                        Key={'myid': {'S': ratelimit.bucket_key(ratelimit.CONNECTION, 'abc123=')}})['Item']
+    assert item['expires'] == {'N': '102'}
+
+
+@mock_dynamodb2
+def test_bucket_copies_are_bounded(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setattr(ratelimit, 'MAX_CACHED_BUCKETS', 2)
+
+    for name in ('abc123=', 'def123=', 'ghi123='):
+        ratelimit.acquire(ddb, ratelimit.CONNECTION, name, now=100.0)
+    assert list(ratelimit._buckets) == [ratelimit.bucket_key(ratelimit.CONNECTION, name)
+                                        for name in ('def123=', 'ghi123=')]
+
+    connections.forget(['ghi123='])
+    assert list(ratelimit._buckets) == [ratelimit.bucket_key(ratelimit.CONNECTION, 'def123=')]
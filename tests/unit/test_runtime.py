@@ -0,0 +1,69 @@
+import boto3
+import os
+import pytest
+
+from moto import mock_dynamodb2
+from chat_common import runtime
+from on_connect import handler
+
+
+def test_dynamodb_client_is_cached():
+    assert runtime.dynamodb() is runtime.dynamodb()
+
+
+def test_apigatewaymanagementapi_client_per_endpoint(apigw_event):
+    client = runtime.apigatewaymanagementapi(apigw_event)
+    other_event = {'requestContext': {'domainName': 'otherdomain', 'stage': 'test'}}
+
+    assert client is runtime.apigatewaymanagementapi(apigw_event)
+    assert client is not runtime.apigatewaymanagementapi(other_event)
+    assert client.meta.endpoint_url == 'https://testdomain/test'
+
+
+def test_config(monkeypatch):
+    monkeypatch.setenv('BROADCAST_MAX_WORKERS', '32')
+    config = runtime.config()
+
+    assert config.max_pool_connections == 32
+    assert config.tcp_keepalive
+    assert config.retries == {'mode': 'standard', 'max_attempts': 3}
+
+
+def test_reset():
+    client = runtime.dynamodb()
+    runtime.reset()
+
+    assert client is not runtime.dynamodb()
+
+
+@mock_dynamodb2
+def test_handle_with_injected_client(apigw_event, mocker, monkeypatch):
+    ddb = boto3.client('dynamodb')
+    ddb.create_table(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        KeySchema=[{'AttributeName': 'connectionId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'connectionId', 'AttributeType': 'S'},
+            {'AttributeName': 'room', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'room-index',
+            'KeySchema': [{'AttributeName': 'room', 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'},
+        }],
+    )
+    ddb.create_table(
+        TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+        KeySchema=[{'AttributeName': 'myid', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'myid', 'AttributeType': 'S'}],
+    )
+
+    def fail():
+        pytest.fail('cached client should not be used')
+
+    monkeypatch.setattr(runtime, 'dynamodb', fail)
+    apigw_event['queryStringParameters'] = {'username': 'foo'}
+    handler.handle(apigw_event, mocker, dynamodb=ddb)
+
+    result = ddb.get_item(TableName=os.environ.get('CONNECTION_TABLE_NAME'), Key={'connectionId': {'S': 'abc123='}})
+    assert result['Item']['username']['S'] == 'foo'
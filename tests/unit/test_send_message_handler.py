@@ -1,9 +1,11 @@
 import boto3
+import json
+import msgpack
 import os
 import pytest
 
-from datetime import datetime
 from moto import mock_dynamodb2
+from chat_common import connections, counters, envelope, history
 from send_message import handler
 
 
@@ -27,6 +29,24 @@ def use_moto():
                     'AttributeName': 'connectionId',
                     'AttributeType': 'S'
                 },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
             ],
         )
 
@@ -53,10 +73,6 @@ def use_moto():
                     'AttributeName': 'myid',
                     'KeyType': 'HASH'
                 },
-                {
-                    'AttributeName': 'timestamp',
-                    'KeyType': 'RANGE'
-                },
             ],
             AttributeDefinitions=[
                 {
@@ -64,50 +80,53 @@ def use_moto():
                     'AttributeType': 'S'
                 },
                 {
-                    'AttributeName': 'timestamp',
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'seq',
                     'AttributeType': 'N'
                 },
             ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'history-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'seq',
+                            'KeyType': 'RANGE'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
         )
 
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}}
+            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}}
         )
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
         )
         return dynamodb
     return dynamodb_client
 
 
-@mock_dynamodb2
-def test_send_to_all(use_moto, monkeypatch):
-    ddb = use_moto()
-    connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
-    ]
-    data = 'foo has left the chat room'
-
-    def mock_post_to_connection(Data, ConnectionId):
-        assert Data == data
-        assert ConnectionId == connection_ids[0]['connectionId']['S'] or ConnectionId == connection_ids[1]['connectionId']['S']
-        return None
-
-    apig_management_client = boto3.client('apigatewaymanagementapi')
-    monkeypatch.setattr(apig_management_client, 'post_to_connection', mock_post_to_connection)
-    handler.send_to_all(apig_management_client, connection_ids, data)
-
-
 @mock_dynamodb2
 def test_increment_message_first_time(use_moto):
     ddb = use_moto()
     handler.increment_message()
+    counters.flush(ddb)
 
-    result = ddb.get_item(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'), Key={'myid': {'S': 'counter'}})
-    assert result['Item']['msgCount']['N'] == '1'
+    assert counters.total(ddb, 'messages') == 1
 
 
 @mock_dynamodb2
@@ -116,27 +135,36 @@ def test_increment_message_existing(use_moto):
 
     ddb.put_item(
         TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
-        Item={'myid': {'S': 'counter'}, 'msgCount': {'N': '55'}}
+        Item={'myid': {'S': 'messages#2'}, 'count': {'N': '55'}}
     )
 
     handler.increment_message()
+    counters.flush(ddb)
 
-    result = ddb.get_item(TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'), Key={'myid': {'S': 'counter'}})
-    assert result['Item']['msgCount']['N'] == '56'
+    assert counters.total(ddb, 'messages') == 56
+
+
+@mock_dynamodb2
+def test_increment_message_buffered(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('COUNTER_FLUSH_INTERVAL', '60')
+    counters.reset()
+
+    handler.increment_message()
+    handler.increment_message()
+
+    assert counters.flush(ddb) == {}
+    assert counters.total(ddb, 'messages') == 0
+    assert counters.flush(ddb, force=True) == {'messages': 2}
+    assert counters.total(ddb, 'messages') == 2
 
 
 @mock_dynamodb2
 def test_store_message_not_exceed_20(use_moto):
     ddb = use_moto()
-    ddb.put_item(
-        TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-        Item={'myid': {'S': 'uuid-1'},
-              'timestamp': {'N': '1612770838.718373'},
-              'data': {'S': '[2021-02-08 07:53:58 Zaki] test 1'}}
-    )
 
-    data = '[2021-02-08 07:54:04 Zaki] test 2'
-    handler.store_message(data)
+    handler.store_message('[2021-02-08 07:53:58 Zaki] test 1')
+    handler.store_message('[2021-02-08 07:54:04 Zaki] test 2')
 
     _messages = []
     paginator = ddb.get_paginator('scan')
@@ -150,19 +178,8 @@ def test_store_message_not_exceed_20(use_moto):
 def test_store_message_exceed_20(use_moto):
     ddb = use_moto()
 
-    for i in range(19):
-        ddb.put_item(
-            TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-            Item={'myid': {'S': f'uuid-{i}'},
-                  'timestamp': {'N': str(datetime.now().timestamp())},
-                  'data': {'S': f'[2021-02-08 07:53:58 Zaki] test {i}'}}
-        )
-
-    data = '[2021-02-08 07:54:04 Zaki] test 2'
-
-    # call store 2 times
-    handler.store_message(data)
-    handler.store_message(data)
+    for i in range(25):
+        handler.store_message(f'[2021-02-08 07:53:58 Zaki] test {i}')
 
     _messages = []
     paginator = ddb.get_paginator('scan')
@@ -170,6 +187,22 @@ def test_store_message_exceed_20(use_moto):
         _messages.extend(page['Items'])
 
     assert len(_messages) == 20
+    assert sorted(int(m['seq']['N']) for m in _messages) == list(range(6, 26))
+
+    counters.flush(ddb)
+    assert counters.total(ddb, 'messages') == 25
+
+
+@mock_dynamodb2
+def test_store_message_configurable_size(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '5')
+
+    for i in range(8):
+        handler.store_message(f'[2021-02-08 07:53:58 Zaki] test {i}')
+
+    _messages = ddb.scan(TableName=os.environ.get('MESSAGE_TABLE_NAME'))['Items']
+    assert sorted(m['body']['S'] for m in _messages) == [f'[2021-02-08 07:53:58 Zaki] test {i}' for i in range(3, 8)]
 
 
 @mock_dynamodb2
@@ -177,21 +210,163 @@ def test_handle(apigw_event, mocker, use_moto, monkeypatch):
     ddb = use_moto()
     apigw_event['body'] = '{"message": "Hello world..."}'
     expected_connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}},
+        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
     ]
 
-    def mock_store_message(data):
-        assert 'Hello world...' in data
-        assert 'foo' in data
-        return None
+    def mock_store_messages(messages, dynamodb=None, room=None, sender=None, timestamp=None):
+        assert messages == ['Hello world...']
+        assert sender == 'foo'
+        return [1]
 
-    def mock_send_to_all(apig_management_client, connection_ids, data):
-        assert 'Hello world...' in data
-        assert 'foo' in data
+    def mock_send_to_all(dynamodb, apig_management_client, connection_ids, data):
+        [message] = data.content['messages']
+        assert message['body'] == 'Hello world...'
+        assert message['sender'] == 'foo'
+        assert message['seq'] == 1
         assert connection_ids == expected_connection_ids
         return None
 
-    monkeypatch.setattr(handler, 'store_message', mock_store_message)
-    monkeypatch.setattr(handler, "send_to_all", mock_send_to_all)
+    monkeypatch.setattr(handler, 'store_messages', mock_store_messages)
+    monkeypatch.setattr(connections, "send_to_all", mock_send_to_all)
     handler.handle(apigw_event, mocker)
+
+
+@mock_dynamodb2
+def test_handle_enqueues_broadcast(apigw_event, mocker, use_moto, monkeypatch, local_queue):
+    ddb = use_moto()
+    apigw_event['body'] = '{"message": "Hello world..."}'
+
+    def mock_send_to_all(dynamodb, apig_management_client, connection_ids, data):
+        raise AssertionError('broadcast belongs to the fan-out worker')
+
+    monkeypatch.setattr(connections, "send_to_all", mock_send_to_all)
+    handler.handle(apigw_event, mocker, sqs=local_queue)
+
+    message = json.loads(local_queue.messages[0])
+    assert len(local_queue.messages) == 1
+    assert message['endpointUrl'] == 'https://testdomain/test'
+    assert message['frame']['messages'][0]['body'] == 'Hello world...'
+    assert counters.total(ddb, 'messages') == 1
+
+
+@mock_dynamodb2
+def test_handle_broadcasts_to_room(apigw_event, mocker, use_moto, monkeypatch):
+    ddb = use_moto()
+    connections.register(ddb, 'ghi123=', 'baz', 'lobby')
+    connections.register(ddb, 'jkl123=', 'qux', 'lobby')
+    apigw_event['requestContext']['connectionId'] = 'ghi123='
+    apigw_event['body'] = '{"message": "Hello lobby..."}'
+    posted = []
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            posted.append(ConnectionId)
+
+    handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    assert sorted(posted) == ['ghi123=', 'jkl123=']
+    messages = history.latest(ddb, 'lobby')
+    assert len(messages) == 1
+    assert messages[0]['body']['S'] == 'Hello lobby...'
+    assert messages[0]['sender']['S'] == 'baz'
+    assert history.latest(ddb) == []
+
+
+@mock_dynamodb2
+def test_handle_batch(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    apigw_event['body'] = json.dumps({'action': 'sendmessage', 'messages': ['first', 'say "hi"', 'third']})
+    posted = []
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            posted.append((ConnectionId, Data))
+
+    handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    assert sorted(connection_id for connection_id, _ in posted) == ['abc123=', 'def123=']
+    assert posted[0][1] == posted[1][1]
+    frame = json.loads(posted[0][1])['messages']
+    assert [message['body'] for message in frame] == ['first', 'say "hi"', 'third']
+    assert [message['seq'] for message in frame] == [1, 2, 3]
+    assert {message['sender'] for message in frame} == {'foo'}
+    assert {message['room'] for message in frame} == {'global'}
+    assert [envelope.from_item(m) for m in history.latest(ddb)] == frame
+    assert counters.total(ddb, 'messages') == 3
+
+
+@mock_dynamodb2
+def test_handle_invalid_batch(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+
+    for messages in ([], [1, 2], ['spam'] * (handler.MAX_BATCH + 1)):
+        apigw_event['body'] = json.dumps({'action': 'sendmessage', 'messages': messages})
+        assert handler.handle(apigw_event, mocker)['statusCode'] == 400
+
+    assert history.latest(ddb) == []
+
+
+@mock_dynamodb2
+def test_handle_msgpack(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    connections.register(ddb, 'ghi123=', 'baz', 'lobby', 'msgpack')
+    connections.register(ddb, 'jkl123=', 'qux', 'lobby')
+    apigw_event['requestContext']['connectionId'] = 'ghi123='
+    apigw_event['body'] = '{"message": "Hello lobby..."}'
+    posted = {}
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            posted[ConnectionId] = Data
+
+    handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    assert msgpack.unpackb(posted['ghi123='], raw=False) == json.loads(posted['jkl123='])
+    assert json.loads(posted['jkl123='])['messages'][0]['body'] == 'Hello lobby...'
+
+
+@mock_dynamodb2
+def test_handle_throttled(apigw_event, mocker, use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '2')
+    apigw_event['body'] = '{"message": "spam"}'
+    posted = []
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            posted.append((ConnectionId, Data))
+
+    for _ in range(2):
+        assert handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct()) == {}
+    posted.clear()
+
+    response = handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    assert response['statusCode'] == 429
+    assert [connection_id for connection_id, _ in posted] == ['abc123=']
+    reply = json.loads(posted[0][1])
+    assert reply['error'] == 'throttled'
+    assert reply['scope'] == 'connection'
+    assert 0 < reply['retryAfter'] <= 1
+    assert len(history.latest(ddb)) == 2
+    assert counters.total(ddb, 'messages') == 2
+
+
+@mock_dynamodb2
+def test_handle_batch_costs_a_token_per_message(apigw_event, mocker, use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '3')
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            pass
+
+    apigw_event['body'] = '{"messages": ["one", "two"]}'
+    assert handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct()) == {}
+    response = handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    assert response['statusCode'] == 429
+    assert len(history.latest(ddb)) == 2
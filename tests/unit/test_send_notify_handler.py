@@ -1,8 +1,10 @@
 import boto3
+import json
 import os
 import pytest
 
 from moto import mock_dynamodb2
+from chat_common import connections, history
 from send_notify import handler
 
 
@@ -26,6 +28,24 @@ def use_moto():
                     'AttributeName': 'connectionId',
                     'AttributeType': 'S'
                 },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
             ],
         )
 
@@ -52,10 +72,6 @@ def use_moto():
                     'AttributeName': 'myid',
                     'KeyType': 'HASH'
                 },
-                {
-                    'AttributeName': 'timestamp',
-                    'KeyType': 'RANGE'
-                },
             ],
             AttributeDefinitions=[
                 {
@@ -63,23 +79,53 @@ def use_moto():
                     'AttributeType': 'S'
                 },
                 {
-                    'AttributeName': 'timestamp',
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'seq',
                     'AttributeType': 'N'
                 },
             ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'history-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'seq',
+                            'KeyType': 'RANGE'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
         )
 
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}}
+            Item={'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}}
         )
         dynamodb.put_item(
             TableName=os.environ.get('CONNECTION_TABLE_NAME'),
-            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+            Item={'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
+        )
+        dynamodb.put_item(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            Item={'myid': {'S': 'messages#0'}, 'count': {'N': '0'}}
         )
         dynamodb.put_item(
             TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
-            Item={'myid': {'S': 'counter'}, 'msgCount': {'N': '0'}}
+            Item={'myid': {'S': 'connections:global#0'}, 'count': {'N': '1'}}
+        )
+        dynamodb.put_item(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            Item={'myid': {'S': 'connections:global#3'}, 'count': {'N': '1'}}
         )
         return dynamodb
     return dynamodb_client
@@ -90,17 +136,17 @@ def test_handle(apigw_event, mocker, use_moto, monkeypatch):
     ddb = use_moto()
     apig_management_client = boto3.client('apigatewaymanagementapi')
     expected_connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}},
+        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
     ]
     expected_data = f"Welcome to Simple Chat\n"\
                     f"There are {len(expected_connection_ids)} users connected.\n" \
                     f"Total of {0} messages recorded as of today.\n\n"
 
-    def mock_get_messages():
+    def mock_get_messages(dynamodb=None, room=None):
         return []
 
-    def mock_send_to_all(apig_management_client, connection_ids, data):
+    def mock_send_to_all(dynamodb, apig_management_client, connection_ids, data):
         assert data == 'foo has joined the chat room'
         assert connection_ids == expected_connection_ids
         return None
@@ -111,7 +157,7 @@ def test_handle(apigw_event, mocker, use_moto, monkeypatch):
         return None
 
     monkeypatch.setattr(handler, 'get_messages', mock_get_messages)
-    monkeypatch.setattr(handler, "send_to_all", mock_send_to_all)
+    monkeypatch.setattr(connections, "send_to_all", mock_send_to_all)
     monkeypatch.setattr(handler, "send_to_self", mock_send_to_self)
     handler.handle(apigw_event, mocker)
 
@@ -123,23 +169,23 @@ def test_handle_with_messages(apigw_event, mocker, use_moto, monkeypatch):
 
     ddb.put_item(
         TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
-        Item={'myid': {'S': 'counter'}, 'msgCount': {'N': '2'}}
+        Item={'myid': {'S': 'messages#1'}, 'count': {'N': '2'}}
     )
     expected_connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
+        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}},
+        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}, 'room': {'S': 'global'}}
     ]
     expected_data = f"Welcome to Simple Chat\n"\
                     f"There are {len(expected_connection_ids)} users connected.\n" \
                     f"Total of {2} messages recorded as of today.\n\n"
 
-    def mock_get_messages():
+    def mock_get_messages(dynamodb=None, room=None):
         return ['[2021-02-08 07:53:58 Zaki] test 1', '[2021-02-08 07:54:04 Zaki] test 2']
 
     messages = mock_get_messages()
     expected_data = expected_data + '\n'.join(messages)
 
-    def mock_send_to_all(apig_management_client, connection_ids, data):
+    def mock_send_to_all(dynamodb, apig_management_client, connection_ids, data):
         assert data == 'foo has joined the chat room'
         assert connection_ids == expected_connection_ids
         return None
@@ -150,34 +196,15 @@ def test_handle_with_messages(apigw_event, mocker, use_moto, monkeypatch):
         return None
 
     monkeypatch.setattr(handler, 'get_messages', mock_get_messages)
-    monkeypatch.setattr(handler, "send_to_all", mock_send_to_all)
+    monkeypatch.setattr(connections, "send_to_all", mock_send_to_all)
     monkeypatch.setattr(handler, "send_to_self", mock_send_to_self)
     handler.handle(apigw_event, mocker)
 
 
-@mock_dynamodb2
-def test_send_to_all(use_moto, monkeypatch):
-    ddb = use_moto()
-    connection_ids = [
-        {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}},
-        {'connectionId': {'S': 'def123='}, 'username': {'S': 'bar'}}
-    ]
-    data = 'foo has left the chat room'
-
-    def mock_post_to_connection(Data, ConnectionId):
-        assert Data == data
-        assert ConnectionId == connection_ids[0]['connectionId']['S'] or ConnectionId == connection_ids[1]['connectionId']['S']
-        return None
-
-    apig_management_client = boto3.client('apigatewaymanagementapi')
-    monkeypatch.setattr(apig_management_client, 'post_to_connection', mock_post_to_connection)
-    handler.send_to_all(apig_management_client, connection_ids, data)
-
-
 @mock_dynamodb2
 def test_send_to_self(use_moto, monkeypatch):
     ddb = use_moto()
-    connection_id = {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}}
+    connection_id = {'connectionId': {'S': 'abc123='}, 'username': {'S': 'foo'}, 'room': {'S': 'global'}}
     data = 'test message'
 
     def mock_post_to_connection(Data, ConnectionId):
@@ -196,13 +223,17 @@ def test_get_messages(use_moto):
 
     ddb.put_item(
         TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-        Item={'myid': {'S': 'uuid-1'},
+        Item={'myid': {'S': 'slot#1'},
+              'room': {'S': 'global'},
+              'seq': {'N': '1'},
               'timestamp': {'N': '1612770838.718373'},
               'data': {'S': '[2021-02-08 07:53:58 Zaki] test 1'}}
     )
     ddb.put_item(
         TableName=os.environ.get('MESSAGE_TABLE_NAME'),
-        Item={'myid': {'S': 'uuid-2'},
+        Item={'myid': {'S': 'slot#0'},
+              'room': {'S': 'global'},
+              'seq': {'N': '20'},
               'timestamp': {'N': '1612770844.578127'},
               'data': {'S': '[2021-02-08 07:54:04 Zaki] test 2'}}
     )
@@ -217,3 +248,58 @@ def test_get_messages_empty(use_moto):
 
     messages = handler.get_messages()
     assert messages == []
+
+
+@mock_dynamodb2
+def test_handle_since(apigw_event, mocker, use_moto):
+    ddb = use_moto()
+    for i in range(1, 5):
+        history.store(ddb, f'[2021-02-08 07:53:58 Zaki] test {i}')
+    apigw_event['body'] = json.dumps({'action': 'sendnotify', 'since': 2})
+    posted = {}
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            posted.setdefault(ConnectionId, []).append(Data)
+
+    handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+    reply = json.loads(posted['abc123='][0])
+    assert reply['welcome'].startswith('Welcome to Simple Chat')
+    assert [(m['seq'], m['body']) for m in reply['messages']] == [
+        (3, '[2021-02-08 07:53:58 Zaki] test 3'),
+        (4, '[2021-02-08 07:53:58 Zaki] test 4'),
+    ]
+    assert posted['def123='] == ['foo has joined the chat room']
+
+
+@mock_dynamodb2
+def test_handle_invalid_since(apigw_event, mocker, use_moto):
+    use_moto()
+
+    for since in ('yesterday', -1, True):
+        apigw_event['body'] = json.dumps({'action': 'sendnotify', 'since': since})
+        assert handler.handle(apigw_event, mocker)['statusCode'] == 400
+
+
+@mock_dynamodb2
+def test_handle_chunks_history(apigw_event, mocker, use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('MESSAGE_HISTORY_SIZE', '100')
+    monkeypatch.setenv('HISTORY_CHUNK_BYTES', '1024')
+    for i in range(1, 101):
+        history.store(ddb, f'test {i} ' + 'x' * 100, sender='Zaki')
+    posted = []
+
+    class Struct(object):
+        def post_to_connection(self, Data, ConnectionId):
+            if ConnectionId == 'abc123=':
+                posted.append(Data)
+
+    for body in (json.dumps({'action': 'sendnotify', 'since': 0}), None):
+        apigw_event['body'] = body
+        handler.handle(apigw_event, mocker, apigatewaymanagementapi=Struct())
+
+        assert len(posted) > 10
+        assert all(len(data.encode('utf-8')) <= 1024 for data in posted)
+        posted.clear()
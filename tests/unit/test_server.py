@@ -0,0 +1,243 @@
+import asyncio
+import boto3
+import json
+import os
+import pytest
+import server
+
+from moto import mock_dynamodb2
+from chat_common import connections, runtime, storage
+from websockets.asyncio.client import connect
+from websockets.exceptions import InvalidStatus
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'connectionId',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'connectionId',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MESSAGE_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'seq',
+                    'AttributeType': 'N'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'history-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'seq',
+                            'KeyType': 'RANGE'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        return dynamodb
+    return dynamodb_client
+
+
+async def receive(ws):
+    return await asyncio.wait_for(ws.recv(), 5)
+
+
+def chat(ddb, scenario, fan_out=False):
+    async def run():
+        gateway = server.Gateway(dynamodb=ddb)
+        gateway_server = await gateway.start('localhost', 0)
+        try:
+            return await scenario(f"ws://{gateway.domain_name}", gateway)
+        finally:
+            gateway_server.close()
+            await gateway_server.wait_closed()
+
+    return asyncio.run(run())
+
+
+@mock_dynamodb2
+def test_gateway(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('METRICS_ENABLED', 'false')
+
+    async def scenario(url, gateway):
+        async with connect(f"{url}/?username=foo") as foo, connect(f"{url}/?username=bar") as bar:
+            await foo.send(json.dumps({'action': 'sendnotify', 'since': 0}))
+            welcome = json.loads(await receive(foo))
+            assert welcome['welcome'].startswith('Welcome to Simple Chat\nThere are 2 users connected.')
+            for ws in (foo, bar):
+                assert await receive(ws) == 'foo has joined the chat room'
+
+            await bar.send(json.dumps({'action': 'sendmessage', 'message': 'Hello foo...'}))
+            for ws in (foo, bar):
+                [message] = json.loads(await receive(ws))['messages']
+                assert (message['sender'], message['body']) == ('bar', 'Hello foo...')
+
+            await foo.send(json.dumps({'action': 'unknown'}))
+            assert json.loads(await receive(foo))['message'] == 'Forbidden'
+
+            await bar.close()
+            assert await receive(foo) == 'bar has left the chat room'
+
+        with pytest.raises(InvalidStatus) as e:
+            async with connect(f"{url}/?username=baz&room=no%20spaces"):
+                pass
+        assert e.value.response.status_code == 400
+
+    chat(ddb, scenario)
+    assert ddb.scan(TableName=os.environ.get('CONNECTION_TABLE_NAME'))['Items'] == []
+
+
+@mock_dynamodb2
+def test_gateway_fan_out(use_moto, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('METRICS_ENABLED', 'false')
+    monkeypatch.setenv('FANOUT_QUEUE_URL', server.LOCAL_QUEUE_URL)
+    monkeypatch.setenv('PRESENCE_QUEUE_URL', server.LOCAL_QUEUE_URL)
+    monkeypatch.setenv('PRESENCE_WINDOW', '1')
+
+    async def scenario(url, gateway):
+        async with connect(f"{url}/?username=foo") as foo:
+            await foo.send(json.dumps({'action': 'sendnotify'}))
+            assert (await receive(foo)).startswith('Welcome to Simple Chat')
+
+            await foo.send(json.dumps({'action': 'sendmessage', 'message': 'queued'}))
+            assert json.loads(await receive(foo))['messages'][0]['body'] == 'queued'
+
+            # The join is announced by the fan-out worker once the presence window closes
+            assert await receive(foo) == 'foo has joined the chat room'
+
+    chat(ddb, scenario)
+
+
+def test_gateway_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', 'false')
+    monkeypatch.setenv('STORAGE_BACKEND', storage.SQLITE)
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'chat.db'))
+
+    async def scenario(url, gateway):
+        async with connect(f"{url}/?username=foo") as foo:
+            await foo.send(json.dumps({'action': 'sendmessage', 'message': 'stored'}))
+            assert json.loads(await receive(foo))['messages'][0]['body'] == 'stored'
+
+        async with connect(f"{url}/?username=bar") as bar:
+            await bar.send(json.dumps({'action': 'sendnotify', 'since': 0}))
+            welcome = json.loads(await receive(bar))
+            assert welcome['welcome'].startswith('Welcome to Simple Chat\nThere are 1 users connected.')
+            assert [message['body'] for message in welcome['messages']] == ['stored']
+            assert await receive(bar) == 'bar has joined the chat room'
+
+    chat(None, scenario)
+    assert connections.scan(runtime.dynamodb()) == []
+
+
+def test_gateway_queues_posts_during_handshake(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', 'false')
+    monkeypatch.setenv('STORAGE_BACKEND', storage.SQLITE)
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'chat.db'))
+
+    class Socket(object):
+        remote_address = ('127.0.0.1', 0)
+
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, data):
+            self.sent.append(data)
+
+    async def scenario(url, gateway):
+        socket = Socket()
+        gateway.api.connections['pending'] = server.PendingConnection(socket.remote_address)
+
+        # A broadcast between $connect and the end of the handshake neither fails nor gets lost
+        for data in ('first', 'second'):
+            await asyncio.to_thread(gateway.api.post_to_connection, Data=data, ConnectionId='pending')
+        ip = await asyncio.to_thread(gateway.api.get_connection, ConnectionId='pending')
+        assert ip['identity']['sourceIp'] == '127.0.0.1'
+        assert socket.sent == []
+
+        await gateway.open(socket, 'pending')
+        await asyncio.to_thread(gateway.api.post_to_connection, Data='third', ConnectionId='pending')
+        assert socket.sent == ['first', 'second', 'third']
+        assert gateway.api.connections['pending'] is socket
+
+        with pytest.raises(server.GoneException):
+            gateway.api.post_to_connection(Data='lost', ConnectionId='unknown')
+
+    chat(None, scenario)
@@ -0,0 +1,270 @@
+import boto3
+import os
+import pytest
+import time
+
+from moto import mock_dynamodb2
+from chat_common import connections, counters, history, presence, ratelimit, runtime, storage
+from chat_common.storage.sqlite import SQLiteStorage
+
+
+def create_tables(dynamodb):
+    dynamodb.create_table(
+        TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+        KeySchema=[
+            {
+                'AttributeName': 'connectionId',
+                'KeyType': 'HASH'
+            },
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'connectionId',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'room',
+                'AttributeType': 'S'
+            },
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'room-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'room',
+                        'KeyType': 'HASH'
+                    },
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+            },
+        ],
+    )
+
+    dynamodb.create_table(
+        TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+        KeySchema=[
+            {
+                'AttributeName': 'myid',
+                'KeyType': 'HASH'
+            },
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'myid',
+                'AttributeType': 'S'
+            },
+        ],
+    )
+
+    dynamodb.create_table(
+        TableName=os.environ.get('MESSAGE_TABLE_NAME'),
+        KeySchema=[
+            {
+                'AttributeName': 'myid',
+                'KeyType': 'HASH'
+            },
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'myid',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'room',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'seq',
+                'AttributeType': 'N'
+            },
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'history-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'room',
+                        'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'seq',
+                        'KeyType': 'RANGE'
+                    },
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+            },
+        ],
+    )
+
+
+@pytest.fixture(params=[storage.DYNAMODB, storage.SQLITE])
+def backend(request, connections_stream):
+    """
+    The same chat_common calls against moto DynamoDB, with its connections table stream, and an in-memory SQLite
+    database
+    """
+    if request.param == storage.SQLITE:
+        sqlite = SQLiteStorage(':memory:')
+        yield sqlite
+        sqlite.close()
+        return
+
+    with mock_dynamodb2():
+        dynamodb = boto3.client('dynamodb')
+        create_tables(dynamodb)
+        yield connections_stream(dynamodb)
+
+
+def test_of():
+    sqlite = SQLiteStorage(':memory:')
+
+    assert storage.of(sqlite) is sqlite
+    assert type(storage.of(object())).__name__ == 'DynamoDBStorage'
+
+
+def test_incomplete_backend_cannot_be_created():
+    class Incomplete(storage.Storage):
+        def put_connection(self, item):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_connections(backend):
+    now = int(time.time())
+    for i in range(5):
+        connections.register(backend, f'conn-{i}=', f'user-{i}', 'lobby' if i % 2 else 'global',
+                             'msgpack' if i == 1 else None, now=now)
+
+    assert sorted(item['connectionId']['S'] for item in connections.query(backend, 'lobby')) == ['conn-1=', 'conn-3=']
+    assert len(connections.scan(backend)) == 5
+    assert connections.count(backend, 'global') == 3
+    assert connections.get(backend, 'conn-1=') == {
+        'connectionId': {'S': 'conn-1='}, 'username': {'S': 'user-1'}, 'room': {'S': 'lobby'},
+        'encoding': {'S': 'msgpack'}, 'connectedAt': {'N': str(now)}, 'expires': {'N': str(now + 7200)}}
+    assert sorted(connections.get_many(backend, ['conn-0=', 'conn-gone=', 'conn-4='])) == ['conn-0=', 'conn-4=']
+
+    assert connections.unregister(backend, 'conn-3=')['username']['S'] == 'user-3'
+    assert connections.unregister(backend, 'conn-3=') is None
+    assert connections.purge(backend, [connections.get(backend, 'conn-0='), connections.get(backend, 'conn-2=')]) == []
+
+    assert sorted(item['connectionId']['S'] for item in connections.scan(backend)) == ['conn-1=', 'conn-4=']
+    # Already gone, the live counts are not taken down twice
+    assert connections.purge(backend, [{'connectionId': {'S': 'conn-3='}, 'room': {'S': 'lobby'}}]) == []
+    assert counters.totals(backend, [connections.live_count('global'), connections.live_count('lobby')]) == \
+        {connections.live_count('global'): 1, connections.live_count('lobby'): 1}
+
+
+def test_history(backend):
+    assert [history.next_sequence(backend, 'lobby') for _ in range(3)] == [1, 2, 3]
+    assert history.next_sequence(backend, 'lobby', 4) == 7
+
+    sequences = history.store_many(backend, [f'message {i}' for i in range(25)], 'lobby', sender='foo', timestamp=1)
+    history.store(backend, 'elsewhere', 'global')
+    # A slow writer does not replace the newer message in its slot
+    history.store(backend, 'too late', 'lobby', sequences[-1] - history.history_size())
+
+    items = history.latest(backend, 'lobby')
+    assert [item['body']['S'] for item in items] == [f'message {i}' for i in range(5, 25)]
+    assert [history.cursor(item) for item in items] == sequences[5:]
+    assert items[0]['sender'] == {'S': 'foo'}
+    assert float(items[0]['timestamp']['N']) == 1
+    assert [item['body']['S'] for item in history.latest(backend, 'lobby', limit=2, since=sequences[-3])] == \
+        ['message 23', 'message 24']
+    assert 'sender' not in history.latest(backend, 'global')[0]
+
+
+def test_rate_limit_buckets(backend, monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_RATE', '1')
+    monkeypatch.setenv('RATE_LIMIT_CONNECTION_BURST', '2')
+
+    assert ratelimit.acquire(backend, ratelimit.CONNECTION, 'conn-1=', now=100) == 0
+    ratelimit.reset()
+    assert ratelimit.acquire(backend, ratelimit.CONNECTION, 'conn-1=', now=100) == 0
+    ratelimit.reset()
+    assert ratelimit.acquire(backend, ratelimit.CONNECTION, 'conn-1=', now=100) == 1
+
+    bucket = storage.of(backend).get_bucket(ratelimit.bucket_key(ratelimit.CONNECTION, 'conn-1='))
+    key = ratelimit.bucket_key(ratelimit.CONNECTION, 'conn-1=')
+    assert not storage.of(backend).put_bucket(key, '2', '101')
+    assert not storage.of(backend).put_bucket(key, '2', '101', ('1.000000', bucket[1]))
+    assert storage.of(backend).put_bucket(key, '2', '101', bucket)
+    assert storage.of(backend).get_bucket(key) == ('2', '101')
+
+
+def test_presence(backend, local_queue):
+    assert presence.record(backend, local_queue, 'https://testdomain/test', 'lobby', 'foo', presence.JOINED)
+    assert not presence.record(backend, local_queue, 'https://testdomain/test', 'lobby', 'bar', presence.JOINED)
+    presence.record(backend, local_queue, 'https://testdomain/test', 'lobby', 'bar', presence.LEFT)
+    presence.record(backend, local_queue, 'https://testdomain/test', 'lobby', 'baz', presence.LEFT)
+
+    assert len(local_queue.messages) == 1
+    assert presence.flush(backend, 'lobby') == 'foo has joined and baz has left the chat room'
+    assert presence.flush(backend, 'lobby') is None
+    assert presence.record(backend, local_queue, 'https://testdomain/test', 'lobby', 'late', presence.JOINED)
+
+    key = presence.window_key('lobby')
+    opened, created = storage.of(backend).add_presence(key, 'later', presence.JOINED, 1)
+    assert not created
+    assert not storage.of(backend).reopen_presence(key, opened + 1, 0)
+    assert storage.of(backend).reopen_presence(key, opened, 0)
+    assert storage.of(backend).add_presence(key, 'latest', presence.JOINED, 1) == (0, False)
+
+
+def test_sqlite_file_is_shared(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    writer, reader = SQLiteStorage(path), SQLiteStorage(path)
+
+    connections.register(writer, 'conn-1=', 'foo')
+    history.store(writer, 'hello')
+
+    assert writer.read("PRAGMA journal_mode") == [('wal',)]
+    assert connections.scan(reader)[0]['username'] == {'S': 'foo'}
+    assert history.latest(reader)[0]['body'] == {'S': 'hello'}
+
+
+def test_sqlite_adds_new_columns(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / 'chat.db')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE connections (connection_id TEXT PRIMARY KEY, username TEXT NOT NULL, room TEXT NOT NULL, "
+               "encoding TEXT, expires INTEGER)")
+    db.execute("INSERT INTO connections VALUES ('conn-old=', 'old', 'global', NULL, NULL)")
+    db.commit()
+    db.close()
+
+    now = int(time.time())
+    sqlite = SQLiteStorage(path)
+    connections.register(sqlite, 'conn-new=', 'new', now=now)
+
+    assert 'connectedAt' not in connections.get(sqlite, 'conn-old=')
+    assert connections.get(sqlite, 'conn-new=')['connectedAt'] == {'N': str(now)}
+
+
+def test_runtime_opens_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setenv('STORAGE_BACKEND', storage.SQLITE)
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'chat.db'))
+
+    sqlite = runtime.dynamodb()
+
+    assert isinstance(sqlite, SQLiteStorage)
+    assert runtime.dynamodb() is sqlite
+    assert sqlite.path == str(tmp_path / 'chat.db')
+
+
+@pytest.mark.parametrize('segments', [1, 3])
+def test_scan_connections(backend, segments):
+    for i in range(10):
+        connections.register(backend, f'conn-{i}=', f'user-{i}')
+
+    parts = [storage.of(backend).scan_connections(segment, segments) for segment in range(segments)]
+
+    assert sorted({item['connectionId']['S'] for part in parts for item in part}) == \
+        sorted(f'conn-{i}=' for i in range(10))
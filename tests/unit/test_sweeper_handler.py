@@ -0,0 +1,149 @@
+import boto3
+import json
+import os
+import pytest
+import time
+
+from moto import mock_dynamodb2
+from chat_common import connections, liveness
+from sweeper import handler
+
+
+@pytest.fixture
+def use_moto():
+    @mock_dynamodb2
+    def dynamodb_client():
+        dynamodb = boto3.client('dynamodb')
+
+        # Create the table
+        dynamodb.create_table(
+            TableName=os.environ.get('CONNECTION_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'connectionId',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'connectionId',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'room',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'room-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'room',
+                            'KeyType': 'HASH'
+                        },
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                },
+            ],
+        )
+
+        dynamodb.create_table(
+            TableName=os.environ.get('MSG_COUNTER_TABLE_NAME'),
+            KeySchema=[
+                {
+                    'AttributeName': 'myid',
+                    'KeyType': 'HASH'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'myid',
+                    'AttributeType': 'S'
+                },
+            ],
+        )
+
+        connected = time.time() - 120
+        for i in range(6):
+            connections.register(dynamodb, f'conn-{i}=', f'user-{i}', 'lobby' if i % 2 else 'global', now=connected)
+        return dynamodb
+    return dynamodb_client
+
+
+class StubManagementApi(object):
+    def __init__(self, gone=(), throttled=()):
+        self.gone = gone
+        self.throttled = throttled
+        self.checked = []
+
+    def get_connection(self, ConnectionId):
+        self.checked.append(ConnectionId)
+        if ConnectionId in self.gone:
+            raise ApiError('GoneException', 410)
+        if ConnectionId in self.throttled:
+            raise ApiError('LimitExceededException', 429)
+        return {'identity': {'sourceIp': '127.0.0.1'}}
+
+
+class ApiError(Exception):
+    def __init__(self, code, status_code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status_code}}
+
+
+@mock_dynamodb2
+def test_handle(use_moto, mocker, connections_stream, capsys):
+    ddb = connections_stream(use_moto())
+    # Still in its $connect, the management API would not know it yet
+    connections.register(ddb, 'conn-new=', 'new')
+    apig_management_client = StubManagementApi(gone=('conn-1=', 'conn-2=', 'conn-3=', 'conn-new='),
+                                               throttled=('conn-4=',))
+
+    result = handler.handle({'source': 'aws.events'}, mocker, dynamodb=ddb,
+                            apigatewaymanagementapi=apig_management_client)
+
+    assert sorted(apig_management_client.checked) == [f'conn-{i}=' for i in range(6)]
+    assert {name: result[name] for name in ('swept', 'alive', 'removed', 'failed')} == \
+        {'swept': 6, 'alive': 2, 'removed': 3, 'failed': 1}
+    assert sorted(c['connectionId']['S'] for c in connections.scan(ddb)) == \
+        ['conn-0=', 'conn-4=', 'conn-5=', 'conn-new=']
+    assert connections.count(ddb, 'global') == 3
+    assert connections.count(ddb, 'lobby') == 1
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    [sweep] = [line for line in lines if line.get('metric') == 'sweep']
+    assert sweep['removed'] == 3
+
+
+@mock_dynamodb2
+def test_handle_all_alive(use_moto, mocker, monkeypatch):
+    ddb = use_moto()
+    monkeypatch.setenv('SWEEP_SEGMENTS', '3')
+
+    def mock_batch_write_item(RequestItems):
+        raise AssertionError('nothing is gone')
+
+    monkeypatch.setattr(ddb, 'batch_write_item', mock_batch_write_item)
+
+    result = handler.handle({}, mocker, dynamodb=ddb, apigatewaymanagementapi=StubManagementApi())
+
+    assert (result['swept'], result['alive'], result['removed']) == (6, 6, 0)
+
+
+def test_settled_uses_connect_time(monkeypatch):
+    now = 1000000
+    item = {'connectionId': {'S': 'conn-new='}, 'connectedAt': {'N': str(now)}, 'expires': {'N': str(now + 7200)}}
+    # The expiry alone would date the connection a day back once CONNECTION_TTL changed
+    monkeypatch.setenv('CONNECTION_TTL', '93600')
+
+    assert not liveness.settled(item, now + 30)
+    assert liveness.settled(item, now + 60)
+
+    # Items stored before connectedAt was written are dated by their expiry
+    monkeypatch.setenv('CONNECTION_TTL', '7200')
+    del item['connectedAt']
+    assert not liveness.settled(item, now + 30)
+    assert liveness.settled(item, now + 60)